@@ -1,11 +1,15 @@
 import tkinter as tk
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import requests
-import json
 import datetime
 import pickle
 import os.path
-import threading
+
+from tb_client import ThingsBoardClient
+from calendar_sync import AttributeSync
+from google_sync import GoogleCalendarSync
+from ics_stream import HORIZON, events_payload, window
+from upload_jobs import UploadJobs
 
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -15,57 +19,56 @@ from googleapiclient.discovery import build
 THINGSBOARD_URL = "http://demo.thingsboard.io"
 TB_USERNAME = "youareaverygoodpersontrustme@gmail.com"
 TB_PASSWORD = "Thingsboard"
-TB_DEVICE_ID = "8aa29b50-658a-11f0-83dd-65e1b21422bc"
+TB_DEVICE_IDS = ["8aa29b50-658a-11f0-83dd-65e1b21422bc"]  # Every calendar is uploaded to all of these devices
 GOOGLE_CREDENTIALS_FILE = "credentials.json"
 TOKEN_PICKLE = "token.pickle"
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 SYNC_INTERVAL_MS = 5 * 60 * 1000  # 5 minutes
+TOKEN_CACHE_FILE = "tb_token_cache.json"  # JWT shared with the servers
+UPLOAD_WINDOW_DAYS = 365  # Only events that haven't ended and start within this many days are uploaded
+SYNC_SNAPSHOT_FILE = "calendar_sync.json"  # What each source last uploaded, so only changes are sent
+GOOGLE_SYNC_FILE = "google_sync.json"  # Local copy of the Google calendar + its sync token
+UPLOAD_WORKERS = 4  # Calendars read and device uploads running at the same time
+POLL_INTERVAL_MS = 100  # How often the window picks up upload progress
 # -------------------------------------
 
-def get_jwt_token(username, password):
-    try:
-        response = requests.post(
-            f"{THINGSBOARD_URL}/api/auth/login",
-            json={"username": username, "password": password},
-            timeout=10
-        )
-        if response.status_code == 200:
-            return response.json()["token"]
-        else:
-            print(f"Failed to get JWT token: {response.text}")
-            return None
-    except Exception as e:
-        print(f"Error getting token: {e}")
-        return None
-
-def upload_events_to_thingsboard(payload):
-    jwt = get_jwt_token(TB_USERNAME, TB_PASSWORD)
-    if not jwt:
-        return
-
-    headers = {
-        "Content-Type": "application/json",
-        "X-Authorization": f"Bearer {jwt}"
-    }
-    url = f"{THINGSBOARD_URL}/api/plugins/telemetry/DEVICE/{TB_DEVICE_ID}/SHARED_SCOPE"
-
-    try:
-        response = requests.post(url, data=json.dumps(payload), headers=headers, timeout=10)
-        if response.status_code == 200:
-            print(f"Uploaded {len(payload)} events successfully to ThingsBoard.")
+# Dropped .ics files with recurring events: their occurrences are uploaded up to
+# the gateways' 2 h look-ahead (+ one sync interval) and re-expanded on every sync
+recurring_files = set()
+
+# Shared pooled client for the periodic sync and drag-and-drop uploads; the JWT is
+# cached (and refreshed) instead of logging in on every sync
+tb = ThingsBoardClient(THINGSBOARD_URL, pool_size=UPLOAD_WORKERS, token_cache=TOKEN_CACHE_FILE)
+
+# Each source (the Google calendar, each dropped file) uploads only added/changed events
+# and deletes the ones it uploaded before that are gone
+attribute_sync = AttributeSync(tb, SYNC_SNAPSHOT_FILE)
+
+# Syncs and drops run on worker threads, never on the Tk main loop; each calendar is
+# read once and uploaded to all TB_DEVICE_IDS in parallel
+jobs = UploadJobs(attribute_sync, TB_DEVICE_IDS, workers=UPLOAD_WORKERS,
+                  login=lambda: tb.login(TB_USERNAME, TB_PASSWORD))
+
+# Built on the first sync and reused: the Calendar API client and the incremental sync engine
+calendar_service = None
+google_sync = None
+
+def print_result(source, result):
+    # Outcome of a finished upload job, per device
+    for device_id, outcome in result["devices"].items():
+        if isinstance(outcome, requests.exceptions.HTTPError):
+            print(f"Upload of {source} to {device_id} failed: {outcome.response.status_code}\n{outcome.response.text}")
+        elif isinstance(outcome, Exception):
+            print(f"Upload exception ({source} → {device_id}): {outcome}")
         else:
-            print(f"Upload failed: {response.status_code}\n{response.text}")
-    except Exception as e:
-        print(f"Upload exception: {e}")
-
-def format_datetime(dt_str):
-    try:
-        dt = datetime.datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
-        return dt.strftime("%Y-%m-%d %H:%M")
-    except Exception:
-        return dt_str  # fallback
-
-def fetch_google_calendar_events():
+            print(f"Synced {result['keys']} events from {source} to {device_id}: {outcome['uploaded']} uploaded, "
+                  f"{outcome['unchanged']} unchanged, {outcome['deleted']} removed ({outcome['requests']} requests).")
+
+def get_calendar_service():
+    global calendar_service
+    if calendar_service is not None:
+        return calendar_service
+
     creds = None
     if os.path.exists(TOKEN_PICKLE):
         with open(TOKEN_PICKLE, 'rb') as token:
@@ -79,43 +82,44 @@ def fetch_google_calendar_events():
         with open(TOKEN_PICKLE, 'wb') as token:
             pickle.dump(creds, token)
 
-    service = build('calendar', 'v3', credentials=creds)
-    now = datetime.datetime.utcnow().isoformat() + 'Z'
-    events_result = service.events().list(
-        calendarId='primary',
-        timeMin=now,
-        maxResults=20,
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-    events = events_result.get('items', [])
-
-    payload = {}
-    for event in events:
-        if 'start' in event and 'end' in event and 'summary' in event:
-            raw_start = event['start'].get('dateTime', event['start'].get('date'))
-            raw_end = event['end'].get('dateTime', event['end'].get('date'))
-            start = format_datetime(raw_start)
-            end = format_datetime(raw_end)
-            title = event['summary'].replace(" ", "_").replace(".", "-").replace("$", "-")
-            value = f"Start: {start}\nEnd: {end}"
-            payload[title] = value
-
-    if payload:
-        upload_events_to_thingsboard(payload)
-
-def parse_ics_datetime(dt_str):
-    try:
-        if 'T' in dt_str:
-            dt = datetime.datetime.strptime(dt_str[:15], "%Y%m%dT%H%M%S")
-        else:
-            dt = datetime.datetime.strptime(dt_str, "%Y%m%d")
-        return dt.strftime("%Y-%m-%d %H:%M")
-    except:
-        return dt_str  # fallback
+    # The client refreshes expired credentials itself from here on
+    calendar_service = build('calendar', 'v3', credentials=creds)
+    return calendar_service
+
+def google_payload(stats=None):
+    # Runs on a worker. Only what changed since the last sync is fetched (the whole
+    # calendar the first time); raises if Google can't be reached
+    global google_sync
+    if google_sync is None:
+        google_sync = GoogleCalendarSync(get_calendar_service(), "primary", GOOGLE_SYNC_FILE)
+    result = google_sync.sync()
+    print(f"Google Calendar: {result['items']} changed events in {result['pages']} page(s)"
+          f"{' (full sync)' if result['full'] else ''}.")
+
+    start, end = window(UPLOAD_WINDOW_DAYS)
+    horizon_end = start + HORIZON + datetime.timedelta(milliseconds=SYNC_INTERVAL_MS)
+    return google_sync.payload(start, end, horizon_end, stats)
+
+def ics_payload(filepath, stats=None):
+    # Recurring events only up to the next sync + the gateways' look-ahead
+    now = datetime.datetime.now(datetime.timezone.utc)
+    horizon_end = now + HORIZON + datetime.timedelta(milliseconds=SYNC_INTERVAL_MS)
+    return events_payload(filepath, *window(UPLOAD_WINDOW_DAYS), stats=stats, horizon_end=horizon_end)
+
+def ics_source(filepath):
+    return f"ics:{os.path.abspath(filepath)}"
+
+def dropped_payload(filepath, stats):
+    # A dropped file's payload, or None if it has no events at all
+    payload = ics_payload(filepath, stats)
+    return payload if stats["events"] else None
 
 def schedule_calendar_sync(app_instance):
-    threading.Thread(target=fetch_google_calendar_events, daemon=True).start()
+    # The Google calendar and the recurring dropped files; a source still syncing is skipped
+    jobs.submit(("sync", "google:primary"), "google:primary", google_payload)
+    for filepath in recurring_files:
+        jobs.submit(("sync", filepath), ics_source(filepath),
+                    lambda stats, filepath=filepath: ics_payload(filepath, stats))
     app_instance.after(SYNC_INTERVAL_MS, lambda: schedule_calendar_sync(app_instance))
 
 class App(TkinterDnD.Tk):
@@ -136,41 +140,56 @@ class App(TkinterDnD.Tk):
         # Start calendar sync loop
         self.after(1000, lambda: schedule_calendar_sync(self))
 
+        # Dropped files still uploading, and what the finished ones found
+        self.dropped = set()
+        self.uploaded = 0
+        self.series = 0
+        self.failed = 0
+        self.after(POLL_INTERVAL_MS, self.poll_uploads)
+
     def handle_drop(self, event):
-        filepath = event.data.strip('{}')
-        if filepath.endswith('.ics'):
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-
-                payload = {}
-                current_event = {}
-                for line in lines:
-                    line = line.strip()
-                    if line.startswith("SUMMARY:"):
-                        current_event['summary'] = line.split("SUMMARY:")[1]
-                    elif line.startswith("DTSTART"):
-                        current_event['start'] = line.split(":")[1]
-                    elif line.startswith("DTEND"):
-                        current_event['end'] = line.split(":")[1]
-                    elif line.startswith("END:VEVENT"):
-                        if 'summary' in current_event and 'start' in current_event and 'end' in current_event:
-                            key = current_event['summary'].replace(" ", "_")
-                            start = parse_ics_datetime(current_event['start'])
-                            end = parse_ics_datetime(current_event['end'])
-                            value = f"Start: {start}\nEnd: {end}"
-                            payload[key] = value
-                        current_event = {}
-
-                if payload:
-                    upload_events_to_thingsboard(payload)
-                    self.label.config(text="Upload complete.")
-                else:
-                    self.label.config(text="No events found.")
-            except Exception as e:
-                self.label.config(text=f"Error: {e}")
-        else:
+        filepaths = [path for path in self.tk.splitlist(event.data) if path.endswith('.ics')]
+        if not filepaths:
             self.label.config(text="Only .ics files are supported.")
+            return
+        for filepath in filepaths:
+            # Streamed on a worker: folded lines, TZID and all-day events handled, old events skipped
+            if jobs.submit(("drop", filepath), ics_source(filepath),
+                           lambda stats, filepath=filepath: dropped_payload(filepath, stats)):
+                self.dropped.add(filepath)
+        self.label.config(text=f"Uploading {len(self.dropped)} file(s)...")
+
+    def poll_uploads(self):
+        for kind, (action, name), detail in jobs.poll():
+            if kind == "progress":
+                if action == "drop":
+                    self.label.config(text=f"{os.path.basename(name)}: {detail}")
+                continue
+            if kind == "error":
+                print(f"{'Sync' if action == 'sync' else 'Upload'} of {name} failed: {detail}")
+            elif detail["devices"]:
+                print_result(name, detail)
+            if action != "drop":
+                continue
+
+            self.dropped.discard(name)
+            if kind == "error" or any(isinstance(o, Exception) for o in detail["devices"].values()):
+                self.failed += 1
+            elif detail["devices"]:
+                self.uploaded += 1
+                if detail["stats"]["series"]:
+                    recurring_files.add(name)
+                    self.series += detail["stats"]["series"]
+            if not self.dropped:
+                if self.failed:
+                    self.label.config(text=f"{self.failed} upload(s) failed, see the console.")
+                elif not self.uploaded:
+                    self.label.config(text="No events found.")
+                else:
+                    self.label.config(text="Upload complete." if not self.series else
+                                      f"Upload complete, {self.series} recurring event(s) kept in sync.")
+                self.uploaded = self.series = self.failed = 0
+        self.after(POLL_INTERVAL_MS, self.poll_uploads)
 
 if __name__ == "__main__":
     app = App()
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from serial_protocol import SerialDecoder
+
+# asyncio gateway mode for tempServer.py
+#
+# One task reads serial lines into a bounded queue, a parser task decodes them
+# (serial_protocol.SerialDecoder) into GET_MSG triggers and readings, and uploads,
+# provisioning and the GET_MSG cycle each run as their own tasks. Blocking
+# ThingsBoard calls go through thread pools so a slow HTTP response never holds
+# up ser.readline().
+#
+# Backpressure is explicit: the reader never awaits downstream work. A full line
+# queue drops the incoming line, a full upload queue drops its oldest reading and
+# repeated GET_MSG triggers while a cycle is running coalesce into one rerun.
+# Every drop is counted in AsyncGateway.stats.
+
+log = logging.getLogger(__name__)
+
+
+class AsyncGateway:
+    """Runs the serial → ThingsBoard bridge as a set of asyncio tasks.
+
+    provision(mac) -> token, upload(mac, token, device_id, battery, ts) and
+    poll_cycle() are plain blocking callables supplied by the server script.
+    ts is the serial receipt time of the reading in milliseconds.
+    """
+
+    def __init__(self, ser, mac_token_map, provision, upload, poll_cycle,
+                 line_queue_size=256, upload_queue_size=1024,
+                 upload_workers=4, provision_workers=1):
+        self.ser = ser
+        self.mac_token_map = mac_token_map
+        self.provision = provision
+        self.upload = upload
+        self.poll_cycle = poll_cycle
+        self.line_queue_size = line_queue_size
+        self.upload_queue_size = upload_queue_size
+        self.upload_workers = upload_workers
+        self.provision_workers = provision_workers
+        self.decoder = SerialDecoder()
+
+        self.stats = {
+            "lines": 0,
+            "readings": 0,
+            "uploaded": 0,
+            "upload_errors": 0,
+            "provisioned": 0,
+            "provision_errors": 0,
+            "get_msg": 0,
+            "get_msg_coalesced": 0,
+            "dropped_lines": 0,
+            "dropped_readings": 0,
+        }
+
+        self._loop = None
+        self._stop = None
+        self._lines = None
+        self._uploads = None
+        self._provisions = None
+        self._get_msg = None
+        # Readings waiting for their MAC to get a token: { mac: [reading, ...] }
+        self._pending = {}
+
+    # ---------------- lifecycle ----------------
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._lines = asyncio.Queue(self.line_queue_size)
+        self._uploads = asyncio.Queue(self.upload_queue_size)
+        self._provisions = asyncio.Queue()
+        self._get_msg = asyncio.Event()
+
+        # Separate pools so uploads can't starve the serial reader or the GET_MSG cycle
+        serial_pool = ThreadPoolExecutor(1, thread_name_prefix="serial")
+        poll_pool = ThreadPoolExecutor(1, thread_name_prefix="get-msg")
+        http_pool = ThreadPoolExecutor(self.upload_workers + self.provision_workers,
+                                       thread_name_prefix="tb-http")
+
+        tasks = [
+            asyncio.create_task(self._read_serial(serial_pool)),
+            asyncio.create_task(self._parse_lines()),
+            asyncio.create_task(self._run_get_msg(poll_pool)),
+        ]
+        tasks += [asyncio.create_task(self._upload_worker(http_pool))
+                  for _ in range(self.upload_workers)]
+        tasks += [asyncio.create_task(self._provision_worker(http_pool))
+                  for _ in range(self.provision_workers)]
+
+        try:
+            await self._stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for pool in (serial_pool, poll_pool, http_pool):
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        # Safe to call from any thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def drain(self):
+        # Wait until everything read so far has been parsed, provisioned and uploaded
+        await self._lines.join()
+        await self._provisions.join()
+        await self._uploads.join()
+
+    def queue_depths(self):
+        return {
+            "lines": self._lines.qsize() if self._lines else 0,
+            "uploads": self._uploads.qsize() if self._uploads else 0,
+            "provisions": self._provisions.qsize() if self._provisions else 0,
+            "pending_macs": len(self._pending),
+        }
+
+    # ---------------- tasks ----------------
+
+    async def _read_serial(self, pool):
+        while True:
+            raw = await self._loop.run_in_executor(pool, self.ser.readline)
+            if not raw:
+                continue
+            try:
+                self._lines.put_nowait(raw)
+            except asyncio.QueueFull:
+                self.stats["dropped_lines"] += 1
+
+    async def _parse_lines(self):
+        while True:
+            raw = await self._lines.get()
+            try:
+                self.stats["lines"] += 1
+                for msg in self.decoder.feed(raw):
+                    if msg[0] == "get_msg":
+                        self.stats["get_msg"] += 1
+                        if self._get_msg.is_set():
+                            self.stats["get_msg_coalesced"] += 1
+                        self._get_msg.set()
+                    elif msg[0] == "reading":
+                        self.stats["readings"] += 1
+                        _, mac, device_id, battery = msg
+                        received_ts = int(time.time() * 1000)
+                        self._route_reading(mac, device_id, battery, received_ts)
+            finally:
+                self._lines.task_done()
+
+    def _route_reading(self, mac, device_id, battery, ts):
+        token = self.mac_token_map.get(mac)
+        if token:
+            self._offer_upload((mac, token, device_id, battery, ts))
+            return
+
+        # Unknown MAC: park the reading and provision the device once
+        parked = self._pending.setdefault(mac, [])
+        parked.append((device_id, battery, ts))
+        if len(parked) == 1:
+            self._provisions.put_nowait(mac)
+
+    def _offer_upload(self, item):
+        if self._uploads.full():
+            self._uploads.get_nowait()
+            self._uploads.task_done()
+            self.stats["dropped_readings"] += 1
+        self._uploads.put_nowait(item)
+
+    async def _upload_worker(self, pool):
+        while True:
+            mac, token, device_id, battery, ts = await self._uploads.get()
+            try:
+                await self._loop.run_in_executor(pool, self.upload, mac, token, device_id, battery, ts)
+                self.stats["uploaded"] += 1
+            except Exception as e:
+                self.stats["upload_errors"] += 1
+                log.error(f"❌ Upload error for MAC {mac}: {e}")
+            finally:
+                self._uploads.task_done()
+
+    async def _provision_worker(self, pool):
+        while True:
+            mac = await self._provisions.get()
+            try:
+                token = await self._loop.run_in_executor(pool, self.provision, mac)
+                self.stats["provisioned"] += 1
+                for device_id, battery, ts in self._pending.pop(mac, []):
+                    self._offer_upload((mac, token, device_id, battery, ts))
+            except Exception as e:
+                self.stats["provision_errors"] += 1
+                dropped = self._pending.pop(mac, [])
+                self.stats["dropped_readings"] += len(dropped)
+                log.error(f"❌ Provisioning error for MAC {mac}: {e}")
+            finally:
+                self._provisions.task_done()
+
+    async def _run_get_msg(self, pool):
+        while True:
+            await self._get_msg.wait()
+            self._get_msg.clear()
+            try:
+                await self._loop.run_in_executor(pool, self.poll_cycle)
+            except Exception as e:
+                log.error(f"❌ GET_MSG cycle error: {e}")
@@ -0,0 +1,139 @@
+import threading
+import time
+
+# In-memory mirror of every device's shared attributes
+#
+# One long-poll thread per device waits on ThingsBoard's attribute update endpoint
+# and applies changes as they arrive, so the GET_MSG cycle can answer from memory
+# instead of doing an HTTP round trip per device. Each device is fully resynced on
+# start, after any poll error and every resync_interval seconds as a fallback for
+# missed updates. staleness() tells how long ago each device was last confirmed
+# up to date.
+
+
+class AttributeMirror:
+    """Keeps { mac: {key: value} } in sync with the devices' shared attributes."""
+
+    def __init__(self, tb, mac_token_map, poll_timeout=30, resync_interval=300, scan_interval=5):
+        self.tb = tb
+        self.mac_token_map = mac_token_map
+        self.poll_timeout = poll_timeout
+        self.resync_interval = resync_interval
+        self.scan_interval = scan_interval
+
+        self._lock = threading.Lock()
+        self._shared = {}        # { mac: {key: value} }
+        self._confirmed_at = {}  # { mac: monotonic time of last full sync or poll return }
+        self._resync_at = {}     # { mac: monotonic time of last full resync, None: resync next }
+        self._errors = {}        # { mac: last error string }
+        self._threads = {}
+        self._stop = threading.Event()
+        self.stats = {"updates": 0, "resyncs": 0, "errors": 0}
+
+    # ---------------- public API ----------------
+
+    def start(self):
+        threading.Thread(target=self._watch_map, name="attr-mirror", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get(self, mac, max_staleness=None):
+        # Copy of the device's shared attributes, or None if unknown / too stale
+        with self._lock:
+            if mac not in self._shared:
+                return None
+            if max_staleness is not None:
+                # monotonic() counts from boot, so "never" is None rather than 0
+                confirmed_at = self._confirmed_at.get(mac)
+                if confirmed_at is None or time.monotonic() - confirmed_at > max_staleness:
+                    return None
+            return dict(self._shared[mac])
+
+    def discard(self, mac, keys):
+        # Drop keys we just deleted in TB so they aren't re-sent before the
+        # deletion comes back through the long-poll.
+        with self._lock:
+            shared = self._shared.get(mac)
+            if shared is not None:
+                for key in keys:
+                    shared.pop(key, None)
+
+    def resync_all(self):
+        # Force a full fetch on every device's next loop iteration
+        with self._lock:
+            for mac in self._resync_at:
+                self._resync_at[mac] = None
+
+    def staleness(self):
+        # { mac: seconds since the mirror was last confirmed current, None if never }
+        now = time.monotonic()
+        with self._lock:
+            return {mac: (now - self._confirmed_at[mac]) if mac in self._confirmed_at else None
+                    for mac in self.mac_token_map}
+
+    def errors(self):
+        with self._lock:
+            return dict(self._errors)
+
+    # ---------------- threads ----------------
+
+    def _watch_map(self):
+        # Start a poller for every MAC, including ones provisioned after startup
+        while not self._stop.is_set():
+            for mac in list(self.mac_token_map):
+                if mac not in self._threads:
+                    t = threading.Thread(target=self._poll_device, args=(mac,),
+                                         name=f"attr-mirror-{mac}", daemon=True)
+                    self._threads[mac] = t
+                    t.start()
+            self._stop.wait(self.scan_interval)
+
+    def _resync(self, mac, token):
+        shared = self.tb.get_attributes(token).get("shared", {})
+        now = time.monotonic()
+        with self._lock:
+            self._shared[mac] = shared
+            self._confirmed_at[mac] = now
+            self._resync_at[mac] = now
+            self._errors.pop(mac, None)
+        self.stats["resyncs"] += 1
+
+    def _apply(self, mac, update):
+        # Update bodies carry changed keys, plus "deleted": [keys] for removals
+        if isinstance(update.get("shared"), dict):
+            update = update["shared"]
+        with self._lock:
+            shared = self._shared.setdefault(mac, {})
+            for key in update.get("deleted", []) or []:
+                shared.pop(key, None)
+            for key, value in update.items():
+                if key != "deleted":
+                    shared[key] = value
+            self._confirmed_at[mac] = time.monotonic()
+        if update:
+            self.stats["updates"] += 1
+
+    def _poll_device(self, mac):
+        backoff = 1
+        while not self._stop.is_set():
+            token = self.mac_token_map.get(mac)
+            if token is None:
+                break
+            try:
+                with self._lock:
+                    resync_at = self._resync_at.get(mac)
+                    due = resync_at is None or time.monotonic() - resync_at >= self.resync_interval
+                if due:
+                    self._resync(mac, token)
+                self._apply(mac, self.tb.wait_attribute_updates(token, self.poll_timeout))
+                backoff = 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                with self._lock:
+                    self._errors[mac] = str(e)
+                    # Updates may have been missed while disconnected
+                    self._resync_at[mac] = None
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+        self._threads.pop(mac, None)
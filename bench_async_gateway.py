@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import statistics
+import threading
+import time
+
+from async_gateway import AsyncGateway
+
+# Benchmark: serial read latency of the legacy blocking loop vs the asyncio gateway
+# while the ThingsBoard stand-in answers slowly.
+#
+#   python bench_async_gateway.py --readings 200 --rate 50 --delays 0 50 200
+#
+# "Read lag" is how long a line sat in the (fake) serial buffer after it became
+# available before readline() picked it up. A flat lag means ingest keeps up.
+
+
+class FakeSerial:
+    """Replays receiver output on a fixed timeline and records read lag per line."""
+
+    def __init__(self, readings, rate, get_msg_every=10):
+        self.lines = []
+        interval = 1.0 / rate
+        t = 0.0
+        for i in range(readings):
+            mac = f"AA:BB:CC:00:{i % 64 // 16:02X}:{i % 16:02X}"
+            for line in (f"MAC:{mac}", f"ID:{i}", f"Battery:{80 + i % 20}%"):
+                self.lines.append((t, (line + "\n").encode()))
+            if get_msg_every and i % get_msg_every == 0:
+                self.lines.append((t, b"GET_MSG\n"))
+            t += interval
+        self.start = None
+        self.pos = 0
+        self.lags = []
+        self.done = threading.Event()
+
+    def readline(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        if self.pos >= len(self.lines):
+            self.done.set()
+            time.sleep(0.01)
+            return b""
+        offset, line = self.lines[self.pos]
+        due = self.start + offset
+        now = time.monotonic()
+        if now < due:
+            time.sleep(due - now)
+        self.lags.append(max(0.0, time.monotonic() - due))
+        self.pos += 1
+        return line
+
+    def write(self, data):
+        return len(data)
+
+
+class SlowThingsBoard:
+    """Stand-in for the HTTP calls: every request just sleeps for `delay` seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.uploads = 0
+        self.lock = threading.Lock()
+
+    def provision(self, mac):
+        time.sleep(self.delay * 5)  # create + counter + credentials + attributes + dashboard
+        return f"token-{mac}"
+
+    def upload(self, mac, token, device_id, battery, ts=None):
+        time.sleep(self.delay)
+        with self.lock:
+            self.uploads += 1
+
+    def poll_cycle(self, macs):
+        for _ in range(macs):
+            time.sleep(self.delay)
+
+
+def run_blocking(ser, tb):
+    # Mirrors the legacy tempServer.py __main__ loop
+    mac_token_map = {}
+    buffer = {"mac": None, "id": None, "battery": None}
+    get_msg_event = threading.Event()
+
+    def worker():
+        while not ser.done.is_set():
+            if get_msg_event.wait(0.1):
+                get_msg_event.clear()
+                tb.poll_cycle(len(mac_token_map))
+
+    threading.Thread(target=worker, daemon=True).start()
+    while not ser.done.is_set():
+        line = ser.readline().decode().strip()
+        if line == "GET_MSG":
+            get_msg_event.set()
+            continue
+        if line.startswith("MAC:"):
+            buffer["mac"] = line[4:]
+        elif line.startswith("ID:"):
+            buffer["id"] = line[3:]
+        elif line.startswith("Battery:"):
+            buffer["battery"] = line[8:].replace("%", "")
+        else:
+            continue
+        if all(buffer.values()):
+            mac = buffer["mac"]
+            if mac not in mac_token_map:
+                mac_token_map[mac] = tb.provision(mac)
+            tb.upload(mac, mac_token_map[mac], buffer["id"], buffer["battery"])
+            buffer = {"mac": None, "id": None, "battery": None}
+
+
+async def run_async(ser, tb):
+    mac_token_map = {}
+
+    def provision(mac):
+        token = tb.provision(mac)
+        mac_token_map[mac] = token
+        return token
+
+    gateway = AsyncGateway(ser, mac_token_map, provision, tb.upload,
+                           lambda: tb.poll_cycle(len(mac_token_map)))
+    runner = asyncio.create_task(gateway.run())
+    while not ser.done.is_set():
+        await asyncio.sleep(0.05)
+    await gateway.drain()
+    gateway.stop()
+    await runner
+    return gateway.stats
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(mode, delay_ms, ser, tb, elapsed):
+    lags_ms = [lag * 1000 for lag in ser.lags]
+    print(f"{mode:<9} {delay_ms:>8} {statistics.median(lags_ms):>9.2f} "
+          f"{percentile(lags_ms, 99):>9.2f} {max(lags_ms):>9.2f} "
+          f"{tb.uploads:>8} {elapsed:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial read lag: blocking loop vs asyncio gateway")
+    parser.add_argument("--readings", type=int, default=150)
+    parser.add_argument("--rate", type=float, default=50.0, help="readings per second")
+    parser.add_argument("--delays", type=int, nargs="+", default=[0, 20, 100],
+                        help="stand-in HTTP latency in ms")
+    parser.add_argument("--skip-blocking", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'mode':<9} {'http_ms':>8} {'p50_ms':>9} {'p99_ms':>9} {'max_ms':>9} "
+          f"{'uploads':>8} {'wall_s':>8}")
+    for delay_ms in args.delays:
+        modes = ["async"] if args.skip_blocking else ["blocking", "async"]
+        for mode in modes:
+            ser = FakeSerial(args.readings, args.rate)
+            tb = SlowThingsBoard(delay_ms / 1000)
+            started = time.monotonic()
+            if mode == "blocking":
+                run_blocking(ser, tb)
+            else:
+                asyncio.run(run_async(ser, tb))
+            report(mode, delay_ms, ser, tb, time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from fake_google_calendar import FakeCalendarService
+from google_sync import GoogleCalendarSync
+
+# Benchmark: incremental Google Calendar sync vs listing the calendar every time
+#
+#   python bench_google_sync.py --events 5000 --series 300 --rounds 10 --changes 20
+#
+# Fills fake_google_calendar with one-off events (a month back to a year ahead) and
+# weekly series, some with cancelled or moved instances. After the first (full)
+# sync, every round makes --changes random edits (new, moved, retitled and deleted
+# events, cancelled and moved instances, the odd deleted series) and syncs again
+# with the sync token; round --expire-round expires all tokens first, so that
+# round shows the 410 → full sync path. Reported per round: API requests and
+# items transferred for the incremental sync, for a full listing of the same
+# calendar (a fresh engine's first sync), and the time of each.
+#
+# The fresh engine is also the correctness check: the incremental engine's
+# payload must equal the fresh one's for the same window and horizon ("ok").
+# The uploader expands recurring events only 2 h (+ one sync) ahead; the default
+# horizon here is a week so that the check covers many occurrences.
+
+ZONE = "Europe/Berlin"
+
+
+def when(dt):
+    return {"dateTime": dt.isoformat(), "timeZone": ZONE}
+
+
+class Calendar:
+    """The fake calendar plus what the edits need to know about it."""
+
+    def __init__(self, now, seed):
+        self.service = FakeCalendarService()
+        self.rng = random.Random(seed)
+        self.now = now
+        self.one_offs = []
+        self.series = {}  # { id: first start (local) }
+
+    def add_event(self):
+        start = (self.now + timedelta(days=self.rng.uniform(-30, 365))).replace(second=0, microsecond=0)
+        start = start.astimezone(ZoneInfo(ZONE))
+        self.one_offs.append(self.service.insert(f"Meeting {self.rng.randint(1, 500)}", when(start),
+                                                 when(start + timedelta(minutes=45))))
+
+    def add_series(self):
+        local = (self.now.astimezone(ZoneInfo(ZONE)) - timedelta(days=self.rng.randint(0, 200)))
+        start = local.replace(hour=self.rng.randint(7, 18), minute=self.rng.choice((0, 30)), second=0, microsecond=0)
+        days = ",".join(self.rng.sample(["MO", "TU", "WE", "TH", "FR"], self.rng.randint(1, 3)))
+        event_id = self.service.insert(f"Standup {len(self.series)}", when(start), when(start + timedelta(minutes=15)),
+                                       recurrence=[f"RRULE:FREQ=WEEKLY;BYDAY={days}"])
+        self.series[event_id] = start
+
+    def instance_start(self, series_id):
+        # A weekly instance on the series' first weekday, up to two weeks ahead
+        first = self.series[series_id]
+        weeks = (self.now.astimezone(first.tzinfo) - first).days // 7 + self.rng.randint(0, 2)
+        local = first + timedelta(weeks=weeks)
+        return local.replace(tzinfo=None).replace(tzinfo=ZoneInfo(ZONE))
+
+    def edit(self):
+        kind = self.rng.random()
+        if kind < 0.25 or not self.one_offs:
+            self.add_event()
+        elif kind < 0.45:
+            start = (self.now + timedelta(hours=self.rng.uniform(-12, 24 * 30))).astimezone(ZoneInfo(ZONE))
+            self.service.update(self.rng.choice(self.one_offs), start=when(start), end=when(start + timedelta(hours=1)))
+        elif kind < 0.55:
+            self.service.update(self.rng.choice(self.one_offs), summary=f"Renamed {self.rng.randint(1, 500)}")
+        elif kind < 0.7:
+            self.service.delete(self.one_offs.pop(self.rng.randrange(len(self.one_offs))))
+        elif kind < 0.85 and self.series:
+            series_id = self.rng.choice(list(self.series))
+            self.service.cancel_instance(series_id, when(self.instance_start(series_id)))
+        elif kind < 0.98 and self.series:
+            series_id = self.rng.choice(list(self.series))
+            original = self.instance_start(series_id)
+            moved = original + timedelta(hours=self.rng.choice((-2, 1, 3)))
+            self.service.move_instance(series_id, when(original), when(moved), when(moved + timedelta(minutes=30)))
+        elif self.series:
+            series_id = self.rng.choice(list(self.series))
+            del self.series[series_id]
+            self.service.delete(series_id)
+
+
+def timed_sync(engine, service):
+    requests, items = service.requests, service.items_sent
+    started = time.perf_counter()
+    engine.sync()
+    return service.requests - requests, service.items_sent - items, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incremental Google Calendar sync vs full listing")
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--series", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--changes", type=int, default=20, help="edits between two syncs")
+    parser.add_argument("--page-size", type=int, default=250)
+    parser.add_argument("--window-days", type=float, default=365.0)
+    parser.add_argument("--horizon-hours", type=float, default=7 * 24.0)
+    parser.add_argument("--expire-round", type=int, default=5, help="round whose sync token has expired (0: none)")
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc)
+    calendar = Calendar(now, seed=1)
+    for _ in range(args.events):
+        calendar.add_event()
+    for _ in range(args.series):
+        calendar.add_series()
+    service = calendar.service
+
+    window_start, window_end = now, now + timedelta(days=args.window_days)
+    horizon_end = now + timedelta(hours=args.horizon_hours)
+    engine = GoogleCalendarSync(service, path=None, page_size=args.page_size)
+
+    print(f"{'round':>5} {'mode':>11} {'requests':>8} {'items':>6} {'ms':>8}   "
+          f"{'full req':>8} {'full items':>10} {'full ms':>8} {'keys':>6} {'check':>6}")
+    mismatches = 0
+    for round_no in range(args.rounds + 1):
+        if round_no:
+            for _ in range(args.changes):
+                calendar.edit()
+            if round_no == args.expire_round:
+                service.expire_tokens()
+        expired = engine.stats["expired_tokens"]
+        requests, items, elapsed = timed_sync(engine, service)
+        mode = ("full" if round_no == 0 else
+                "410 → full" if engine.stats["expired_tokens"] > expired else "incremental")
+
+        fresh = GoogleCalendarSync(service, path=None, page_size=args.page_size)
+        full_requests, full_items, full_elapsed = timed_sync(fresh, service)
+
+        payload = engine.payload(window_start, window_end, horizon_end)
+        ok = payload == fresh.payload(window_start, window_end, horizon_end)
+        mismatches += not ok
+        print(f"{round_no:>5} {mode:>11} {requests:>8} {items:>6} {elapsed * 1000:>8.1f}   "
+              f"{full_requests:>8} {full_items:>10} {full_elapsed * 1000:>8.1f} {len(payload):>6} "
+              f"{'ok' if ok else 'MISMATCH':>6}")
+
+    print(f"\n{engine.stats['syncs']} syncs, {engine.stats['items']} items, "
+          f"{engine.stats['expired_tokens']} expired token(s), {mismatches} mismatch(es)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from ics_stream import attribute_key, attribute_value, events_payload, window
+
+# Benchmark: streaming ics_stream.events_payload vs the old ics.Calendar path
+#
+#   python bench_ics_stream.py --events 10000 100000 250000 --window-days 365
+#
+# Writes a synthetic export per size: years of history up to a year ahead, with a
+# VTIMEZONE, TZID/UTC/all-day events, folded DESCRIPTIONs and VALARMs (250000
+# events is roughly 100 MB). Each parser turns it into the upload payload for the
+# same window. Reported per run: wall time, events/s and peak Python heap
+# (tracemalloc, in a second pass so it does not slow the timing; the payload
+# itself counts too). The ics.Calendar rows are skipped when the `ics` package
+# isn't installed.
+
+
+def write_calendar(path, events, seed=1):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    first = now - timedelta(days=365 * 8)
+    span = (now + timedelta(days=365) - first).total_seconds()
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//bench//EN\r\n"
+                "BEGIN:VTIMEZONE\r\nTZID:Europe/Berlin\r\n"
+                "BEGIN:STANDARD\r\nDTSTART:19701025T030000\r\nTZOFFSETFROM:+0200\r\nTZOFFSETTO:+0100\r\n"
+                "RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU\r\nEND:STANDARD\r\n"
+                "BEGIN:DAYLIGHT\r\nDTSTART:19700329T020000\r\nTZOFFSETFROM:+0100\r\nTZOFFSETTO:+0200\r\n"
+                "RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU\r\nEND:DAYLIGHT\r\nEND:VTIMEZONE\r\n")
+        for i in range(events):
+            start = first + timedelta(seconds=span * i / events)
+            kind = rng.random()
+            f.write(f"BEGIN:VEVENT\r\nUID:bench-{i}@example.com\r\nDTSTAMP:20250101T000000Z\r\n"
+                    f"SUMMARY:Meeting {i % 5000} room {rng.randint(1, 40)}\r\n")
+            if kind < 0.1:
+                f.write(f"DTSTART;VALUE=DATE:{start:%Y%m%d}\r\nDTEND;VALUE=DATE:{start + timedelta(days=1):%Y%m%d}\r\n")
+            elif kind < 0.6:
+                local = start + timedelta(hours=1)
+                f.write(f"DTSTART;TZID=Europe/Berlin:{local:%Y%m%dT%H%M%S}\r\n"
+                        f"DTEND;TZID=Europe/Berlin:{local + timedelta(minutes=45):%Y%m%dT%H%M%S}\r\n")
+            else:
+                f.write(f"DTSTART:{start:%Y%m%dT%H%M%SZ}\r\nDTEND:{start + timedelta(hours=1):%Y%m%dT%H%M%SZ}\r\n")
+            description = f"Agenda item {i}: " + "discussion and notes " * 6
+            line = f"DESCRIPTION:{description}"
+            f.write(line[:75] + "\r\n" + "".join(f" {line[j:j + 74]}\r\n" for j in range(75, len(line), 74)))
+            f.write("BEGIN:VALARM\r\nACTION:DISPLAY\r\nDESCRIPTION:Reminder\r\nTRIGGER:-PT15M\r\nEND:VALARM\r\nEND:VEVENT\r\n")
+        f.write("END:VCALENDAR\r\n")
+
+
+def stream_payload(path, window_start, window_end):
+    return events_payload(path, window_start, window_end)
+
+
+def ics_calendar_payload(path, window_start, window_end):
+    # What ics_uploader.py used to do, plus the same window filter
+    from ics import Calendar
+    with open(path, "r", encoding="utf-8") as f:
+        cal = Calendar(f.read())
+    payload = {}
+    for event in cal.events:
+        start, end = event.begin.datetime, event.end.datetime
+        if end > window_start and start < window_end:
+            payload[attribute_key(event.name)] = attribute_value(start, end)
+    return payload
+
+
+def measure(parse, path, window_start, window_end):
+    started = time.perf_counter()
+    payload = parse(path, window_start, window_end)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    parse(path, window_start, window_end)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming .ics parsing vs ics.Calendar")
+    parser.add_argument("--events", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--window-days", type=float, default=365.0)
+    args = parser.parse_args()
+
+    try:
+        import ics  # noqa: F401
+        parsers = [("stream", stream_payload), ("ics.Calendar", ics_calendar_payload)]
+    except ImportError:
+        print("ics not installed (pip install ics): only the streaming parser is measured")
+        parsers = [("stream", stream_payload)]
+
+    window_start, window_end = window(args.window_days)
+    print(f"{'events':>8} {'MB':>7} {'parser':>13} {'seconds':>8} {'events/s':>10} {'peak MB':>8} {'kept':>6}")
+    with tempfile.TemporaryDirectory() as directory:
+        for events in args.events:
+            path = os.path.join(directory, f"bench_{events}.ics")
+            write_calendar(path, events)
+            size = os.path.getsize(path) / 1e6
+            for name, parse in parsers:
+                elapsed, peak, kept = measure(parse, path, window_start, window_end)
+                print(f"{events:>8} {size:>7.1f} {name:>13} {elapsed:>8.2f} {events / elapsed:>10.0f} "
+                      f"{peak / 1e6:>8.2f} {kept:>6}")
+
+
+if __name__ == "__main__":
+    main()
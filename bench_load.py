@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_thingsboard import FakeThingsBoard
+from serial_simulator import ReceiverSimulator
+
+# Offline load test: tempServer.py against a virtual receiver and a fake ThingsBoard
+#
+#   python bench_load.py --badges 10 100 1000 --rate 50 --duration 30 --latency-ms 20
+#   python bench_load.py --badges 100 --server-args=--async --json results.json
+#   python bench_load.py --badges 300 --receivers 3     # one gateway, three receivers
+#
+# For each badge count the real gateway runs as a subprocess in a scratch
+# directory (fresh registry, schedule, spool), reading from a pty driven by
+# serial_simulator.ReceiverSimulator and talking to fake_thingsboard over
+# loopback (--receivers N: N ptys, badges and rate split evenly, passed to the
+# gateway as SERIAL_PORTS). One-time messages are injected into random devices' shared
+# attributes so GET_MSG cycles have downlink work. Reported per run:
+#
+#   delivered      readings that reached ThingsBoard / readings written
+#   rx_per_s       delivered readings per second of test time
+#   e2e p50..max   serial write → ThingsBoard arrival, per reading (ms)
+#   cycle p50/p95  GET_MSG written → its cycle's "time:" line read back (ms)
+#
+# Linux/macOS only (pty). No network access or real hardware needed.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def inject_messages(tb, rate, stop):
+    # One-time messages on random provisioned devices, `rate` per second
+    n = 0
+    while rate > 0 and not stop.wait(1.0 / rate):
+        with tb.lock:
+            devices = list(tb.devices)
+        if devices:
+            n += 1
+            tb.set_shared(random.choice(devices), {f"msg{n}": f"load test {n}"})
+
+
+def wait_for(predicate, timeout, step=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(step)
+    return predicate()
+
+
+def run_once(args, badges):
+    tb = FakeThingsBoard(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                         error_rate=args.error_rate, error_status=args.error_status).start()
+    n = args.receivers
+    sims = [ReceiverSimulator(max(1, badges // n), args.rate / n, args.get_msg_interval, framed=args.framed,
+                              badge_offset=i * (badges // n), id_offset=i * 10**8)
+            for i in range(n)]
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    log = open(os.path.join(workdir, "server.log"), "w")
+    env = dict(os.environ, SERIAL_PORTS=",".join(sim.port for sim in sims), TB_HOST=tb.url,
+               METRICS_PORT="0", PYTHONUNBUFFERED="1")
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, args.server)] + args.server_args,
+                              cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    stop = threading.Event()
+    try:
+        # The gateway logs in before it opens the serial port
+        if not wait_for(lambda: tb.counts.get("auth"), 15):
+            raise RuntimeError(f"gateway did not start, see {log.name}")
+        time.sleep(1.0)
+
+        threading.Thread(target=inject_messages, args=(tb, args.message_rate, stop), daemon=True).start()
+        started = time.monotonic()
+        runners = [threading.Thread(target=sim.run, args=(args.duration,)) for sim in sims]
+        for runner in runners:
+            runner.start()
+        for runner in runners:
+            runner.join()
+        sent = {k: v for sim in sims for k, v in sim.sent.items()}
+        written = len(sent)
+        wait_for(lambda: len(tb.telemetry) >= written, args.drain_timeout)
+        elapsed = time.monotonic() - started
+    finally:
+        stop.set()
+        server.send_signal(signal.SIGINT)  # flushes the batcher like Ctrl+C
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+        for sim in sims:
+            sim.close()
+        tb.stop()
+
+    latencies = []
+    seen = set()
+    last_arrival = started
+    for arrival, _, record in tb.telemetry_records():
+        reading_id = int(record["values"]["data"])
+        if reading_id in sent and reading_id not in seen:
+            seen.add(reading_id)
+            latencies.append((arrival - sent[reading_id]) * 1000)
+            last_arrival = max(last_arrival, arrival)
+    cycles = [t * 1000 for sim in sims for t in sim.cycle_times]
+    return {
+        "badges": badges,
+        "written": written,
+        "delivered": len(seen),
+        "rx_per_s": len(seen) / max(1e-9, last_arrival - started),
+        "elapsed_s": elapsed,
+        "e2e_ms": {p: percentile(latencies, p) for p in (50, 95, 99)} | {"max": max(latencies, default=None)},
+        "cycles": len(cycles),
+        "cycle_ms": {p: percentile(cycles, p) for p in (50, 95)} | {"max": max(cycles, default=None)},
+        "downlink_lines": sum(len(sim.downlinks) for sim in sims),
+        "write_lag_ms_p99": (percentile([lag for sim in sims for lag in sim.write_lag], 99) or 0) * 1000,
+        "http_requests": dict(tb.counts),
+        "errors_injected": tb.errors_injected,
+        "workdir": workdir,
+    }
+
+
+def fmt(value, spec=".0f"):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the serial → ThingsBoard gateway")
+    parser.add_argument("--badges", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rate", type=float, default=20.0, help="readings per second, all badges")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of traffic per run")
+    parser.add_argument("--get-msg-interval", type=float, default=2.0)
+    parser.add_argument("--message-rate", type=float, default=0.5, help="one-time messages per second")
+    parser.add_argument("--receivers", type=int, default=1, help="virtual receivers (serial ports)")
+    parser.add_argument("--framed", action="store_true", help="send #1: records instead of triplets")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake ThingsBoard latency")
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failed")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--drain-timeout", type=float, default=30.0,
+                        help="seconds to wait for uploads after traffic stops")
+    parser.add_argument("--server", default="tempServer.py")
+    parser.add_argument("--server-args", type=lambda s: s.split(), default=[],
+                        help='extra gateway arguments, e.g. --server-args="--async"')
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    print(f"{' '.join([args.server] + args.server_args)}: {args.rate:g} readings/s over "
+          f"{args.receivers} receiver(s) for {args.duration:g}s, "
+          f"TB latency {args.latency_ms:g}±{args.jitter_ms:g} ms, error rate {args.error_rate:g}")
+    print(f"{'badges':>7} {'delivered':>11} {'rx_per_s':>9} {'e2e_p50':>8} {'e2e_p95':>8} "
+          f"{'e2e_p99':>8} {'e2e_max':>8} {'cycles':>7} {'cyc_p50':>8} {'cyc_p95':>8} {'downlink':>9}")
+    results = []
+    for badges in args.badges:
+        r = run_once(args, badges)
+        results.append(r)
+        e2e, cyc = r["e2e_ms"], r["cycle_ms"]
+        print(f"{badges:>7} {r['delivered']:>5}/{r['written']:<5} {r['rx_per_s']:>9.1f} "
+              f"{fmt(e2e[50]):>8} {fmt(e2e[95]):>8} {fmt(e2e[99]):>8} {fmt(e2e['max']):>8} "
+              f"{r['cycles']:>7} {fmt(cyc[50]):>8} {fmt(cyc[95]):>8} {r['downlink_lines']:>9}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2, default=str)
+        print(f"Results written to {args.json}")
+    print(f"Server logs: {', '.join(r['workdir'] for r in results)}")
+    if any(r["delivered"] < r["written"] for r in results):
+        print("⚠ Not every reading reached ThingsBoard within the drain timeout")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_thingsboard import FakeThingsBoard
+from serial_simulator import ReceiverSimulator
+
+# Throughput scaling of the process-sharded gateway (tempServer.py --shards N)
+#
+#   python bench_sharded.py --shards 0 1 2 4 --badges 2000 --receivers 2 --rate 20000 --duration 20
+#
+# Shard count 0 is the normal single-process gateway. For every shard count the
+# gateway runs as a subprocess in a scratch directory. The ThingsBoard stand-in
+# and each virtual receiver run in processes of their own, so on a multi-core
+# machine the benchmark's own GIL isn't what gets measured.
+#
+# All badges are provisioned in a warm-up phase first. Then the receivers offer
+# --rate readings/s in total for --duration seconds. Reported per run:
+#
+#   offered/s    readings the receivers managed to write per second; below --rate
+#                means the gateway stopped draining the serial ports (backpressure)
+#   delivered/s  readings that reached ThingsBoard per second, first write to last arrival
+#   lag_p99      how late the receivers' writes were vs their schedule (ms)
+#
+# Scaling needs free cores: on an N-core machine expect gains up to roughly N-2
+# shards (one core for the front process, some for the stand-ins).
+#
+# Before that, a restart check runs for every shard count: a few badges are
+# provisioned, the gateway is stopped, each device gets a one-time message and
+# the gateway is started again in the same directory (devices only known from
+# the registry). Each GET_MSG cycle must fetch every device's attributes exactly
+# once and every message must reach the display exactly once.
+
+
+def serve_thingsboard(conn, latency_ms):
+    tb = FakeThingsBoard(latency_ms=latency_ms).start()
+    conn.send(tb.url)
+    while True:
+        cmd = conn.recv()
+        if cmd == "stop":
+            break
+        if cmd == "notes":
+            # One one-time message per device, each under its own key
+            for i, device_id in enumerate(list(tb.devices)):
+                tb.set_shared(device_id, {f"note_{i}": "hello"})
+        with tb.lock:
+            last = tb.telemetry[-1][0] if tb.telemetry else None
+            conn.send({"telemetry": len(tb.telemetry), "last_arrival": last,
+                       "devices": len(tb.devices), "auth": tb.counts.get("auth", 0),
+                       "attribute_gets": tb.counts.get("GET device/attributes", 0)})
+    tb.stop()
+
+
+def serve_receiver(conn, badges, badge_offset, id_offset, get_msg_interval):
+    sim = ReceiverSimulator(badges, 1.0, get_msg_interval, framed=True,
+                            badge_offset=badge_offset, id_offset=id_offset)
+    conn.send(sim.port)
+    while True:
+        cmd = conn.recv()
+        if cmd == "stop":
+            break
+        rate, duration = cmd
+        sim.rate = rate
+        sim.sent.clear()
+        sim.write_lag.clear()
+        with sim._lock:
+            sim.downlinks.clear()
+        started = time.monotonic()
+        sim.run(duration)
+        finished = time.monotonic()
+        time.sleep(min(get_msg_interval, 1.0))  # the last cycle's downlink
+        sim.id_offset += len(sim.sent)  # next phase continues the reading IDs
+        lags = sorted(sim.write_lag)
+        with sim._lock:
+            downlinks = [line for _, line in sim.downlinks]
+        conn.send({"sent": len(sim.sent), "started": started, "finished": finished,
+                   "lag_p99": lags[int(len(lags) * 0.99)] if lags else 0.0, "downlinks": downlinks})
+    sim.close()
+
+
+class Helper:
+    """A helper process and the pipe to talk to it."""
+
+    def __init__(self, target, *args):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=target, args=(child,) + args, daemon=True)
+        self.process.start()
+        self.info = self.conn.recv()
+
+    def ask(self, cmd):
+        self.conn.send(cmd)
+        return self.conn.recv()
+
+    def stop(self):
+        self.conn.send("stop")
+        self.process.join(5)
+
+
+def wait_for(predicate, timeout, step=0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(step)
+    return predicate()
+
+
+def start_gateway(workdir, tb_url, ports, shards):
+    log = open(os.path.join(workdir, "server.log"), "a")
+    env = dict(os.environ, SERIAL_PORTS=",".join(ports), TB_HOST=tb_url,
+               METRICS_PORT="0", LOG_LEVEL="WARNING", PYTHONUNBUFFERED="1")
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tempServer.py")]
+    if shards:
+        cmd += ["--shards", str(shards)]
+    return subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT), log
+
+
+def stop_gateway(server, log):
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+    log.close()
+
+
+def check_restart(args, shards):
+    # Restarted gateway vs devices it only knows from the registry: attribute GETs per
+    # GET_MSG cycle and one-time messages delivered more than once
+    badges = args.check_badges
+    tb = Helper(serve_thingsboard, 0.0)
+    receiver = Helper(serve_receiver, badges, 0, 0, 1.0)
+    workdir = tempfile.mkdtemp(prefix="bench_sharded_restart_")
+    try:
+        server, log = start_gateway(workdir, tb.info, [receiver.info], shards)
+        try:
+            if not wait_for(lambda: tb.ask("stats")["auth"], 30):
+                raise RuntimeError(f"gateway did not start, see {log.name}")
+            time.sleep(1.0 + shards * 0.5)
+            receiver.ask((20.0, badges / 20.0))
+            wait_for(lambda: tb.ask("stats")["devices"] >= badges, args.drain_timeout)
+        finally:
+            stop_gateway(server, log)
+
+        tb.ask("notes")
+        server, log = start_gateway(workdir, tb.info, [receiver.info], shards)
+        try:
+            time.sleep(2.0 + shards * 0.5)  # the JWT is cached now: no login to wait for
+            before = tb.ask("stats")["attribute_gets"]
+            result = receiver.ask((1.0, 2.5))  # GET_MSG at 0, 1 and 2 s
+            gets = tb.ask("stats")["attribute_gets"] - before
+        finally:
+            stop_gateway(server, log)
+    finally:
+        for helper in (receiver, tb):
+            helper.stop()
+
+    cycles = sum(line.startswith("time:") for line in result["downlinks"])
+    notes = [line for line in result["downlinks"] if line.endswith(":hello")]
+    per_cycle = gets / cycles if cycles else float("nan")
+    duplicates = len(notes) - len(set(notes))
+    ok = cycles > 0 and per_cycle == badges and len(set(notes)) == badges and not duplicates
+    return {"shards": shards, "devices": badges, "cycles": cycles, "gets_per_cycle": per_cycle,
+            "notes": len(set(notes)), "duplicates": duplicates, "ok": ok, "workdir": workdir}
+
+
+def run_once(args, shards):
+    tb = Helper(serve_thingsboard, args.latency_ms)
+    per_receiver = args.badges // args.receivers
+    receivers = [Helper(serve_receiver, per_receiver, i * per_receiver, i * 10**8, args.get_msg_interval)
+                 for i in range(args.receivers)]
+    workdir = tempfile.mkdtemp(prefix="bench_sharded_")
+    server, log = start_gateway(workdir, tb.info, [r.info for r in receivers], shards)
+    try:
+        if not wait_for(lambda: tb.ask("stats")["auth"], 30):
+            raise RuntimeError(f"gateway did not start, see {log.name}")
+        time.sleep(1.0 + shards * 0.5)  # worker processes start and log in
+
+        # Warm-up: every badge once, at a pace provisioning keeps up with
+        for r in receivers:
+            r.conn.send((args.warmup_rate / args.receivers, per_receiver / (args.warmup_rate / args.receivers)))
+        for r in receivers:
+            r.conn.recv()
+        wait_for(lambda: tb.ask("stats")["devices"] >= per_receiver * args.receivers, args.drain_timeout)
+        warm = per_receiver * args.receivers
+        wait_for(lambda: tb.ask("stats")["telemetry"] >= warm, args.drain_timeout)
+        before = tb.ask("stats")["telemetry"]
+
+        # Measured phase
+        for r in receivers:
+            r.conn.send((args.rate / args.receivers, args.duration))
+        results = [r.conn.recv() for r in receivers]
+        sent = sum(res["sent"] for res in results)
+        wait_for(lambda: tb.ask("stats")["telemetry"] - before >= sent, args.drain_timeout)
+        stats = tb.ask("stats")
+    finally:
+        stop_gateway(server, log)
+        for helper in receivers + [tb]:
+            helper.stop()
+
+    started = min(res["started"] for res in results)
+    finished = max(res["finished"] for res in results)
+    delivered = stats["telemetry"] - before
+    return {
+        "shards": shards,
+        "sent": sent,
+        "delivered": delivered,
+        "offered_per_s": sent / (finished - started),
+        "delivered_per_s": delivered / max(1e-9, (stats["last_arrival"] or finished) - started),
+        "lag_p99_ms": max(res["lag_p99"] for res in results) * 1000,
+        "workdir": workdir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of tempServer.py --shards N vs worker count")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="worker process counts to compare (0 = single process)")
+    parser.add_argument("--badges", type=int, default=2000)
+    parser.add_argument("--receivers", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=20000.0, help="offered readings per second, all receivers")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup-rate", type=float, default=200.0, help="readings/s while badges are provisioned")
+    parser.add_argument("--get-msg-interval", type=float, default=2.0)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="fake ThingsBoard latency")
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--check-badges", type=int, default=4, help="devices in the restart check (0 = skip it)")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    checks = []
+    if args.check_badges:
+        print(f"Restart check, {args.check_badges} devices with a one-time message each:")
+        print(f"{'shards':>6} {'cycles':>6} {'GETs/cycle':>10} {'messages':>8} {'duplicates':>10} {'check':>6}")
+        for shards in args.shards:
+            c = check_restart(args, shards)
+            checks.append(c)
+            print(f"{shards:>6} {c['cycles']:>6} {c['gets_per_cycle']:>10.1f} {c['notes']:>8} "
+                  f"{c['duplicates']:>10} {'ok' if c['ok'] else 'FAIL':>6}")
+        print()
+
+    print(f"{args.badges} badges on {args.receivers} receiver(s), {args.rate:g} readings/s offered "
+          f"for {args.duration:g}s, {os.cpu_count()} CPU(s)")
+    print(f"{'shards':>6} {'delivered':>15} {'offered/s':>10} {'delivered/s':>12} {'lag_p99':>8} {'speedup':>8}")
+    results = []
+    for shards in args.shards:
+        r = run_once(args, shards)
+        results.append(r)
+        speedup = r["delivered_per_s"] / results[0]["delivered_per_s"]
+        print(f"{shards:>6} {r['delivered']:>7}/{r['sent']:<7} {r['offered_per_s']:>10.0f} "
+              f"{r['delivered_per_s']:>12.0f} {r['lag_p99_ms']:>8.0f} {speedup:>7.2f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "cpus": os.cpu_count(), "restart_checks": checks,
+                       "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+    print(f"Server logs: {', '.join(r['workdir'] for r in results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import threading
+import time
+
+from telemetry_batcher import TelemetryBatcher
+
+# Benchmark: telemetry throughput and per-reading latency for different batch sizes.
+#
+#   python bench_telemetry_batcher.py --readings 2000 --devices 20 --rtt 30 --batch-sizes 1 10 50
+#
+# The stand-in post_batch sleeps for one HTTP round trip per request, regardless of
+# how many records the request carries. batch size 1 is the old one-POST-per-reading path.
+
+
+class StandInPoster:
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.requests = 0
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, token, records):
+        time.sleep(self.rtt)
+        with self.lock:
+            self.requests += 1
+            self.records += len(records)
+
+
+def run(readings, devices, rate, rtt, batch_size, max_age):
+    poster = StandInPoster(rtt)
+    batcher = TelemetryBatcher(poster, max_batch=batch_size, max_age=max_age)
+    interval = 1.0 / rate if rate else 0.0
+
+    started = time.monotonic()
+    for i in range(readings):
+        batcher.add(f"token-{i % devices}", {"data": float(i), "battery": 90.0})
+        if interval:
+            time.sleep(interval)
+    batcher.close()
+    elapsed = time.monotonic() - started
+
+    pct = batcher.latency_percentiles()
+    return {
+        "requests": poster.requests,
+        "posted": batcher.stats["posted"],
+        "throughput": batcher.stats["posted"] / elapsed,
+        "p50": pct[50],
+        "p99": pct[99],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched telemetry throughput/latency")
+    parser.add_argument("--readings", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0.0, help="readings/s offered, 0 = as fast as possible")
+    parser.add_argument("--rtt", type=float, default=20.0, help="stand-in round trip in ms")
+    parser.add_argument("--max-age", type=float, default=0.5, help="batch age threshold in s")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 50])
+    args = parser.parse_args()
+
+    print(f"{'batch':>6} {'requests':>9} {'posted':>7} {'readings/s':>11} {'p50_ms':>9} {'p99_ms':>9}")
+    for size in args.batch_sizes:
+        r = run(args.readings, args.devices, args.rate, args.rtt / 1000, size, args.max_age)
+        print(f"{size:>6} {r['requests']:>9} {r['posted']:>7} {r['throughput']:>11.1f} "
+              f"{r['p50'] * 1000:>9.1f} {r['p99'] * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
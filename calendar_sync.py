@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from token_manager import FileLock
+
+# Differential upload of calendar events as shared attributes
+#
+# The uploaders used to POST their whole payload on every sync and never removed
+# anything, so events deleted or moved in the source stayed in ThingsBoard and
+# every GET_MSG poll on the gateway had more keys to go through. AttributeSync
+# remembers, per device and source (the Google calendar, one dropped .ics file),
+# the keys it uploaded last time with a hash of each value. A sync compares the
+# new payload with that snapshot and sends only:
+#
+#   added + changed keys   POSTed in chunks of at most max_keys / max_bytes
+#   removed keys           one multi-key DELETE (chunked to max_keys)
+#
+# Keys another source uploaded are never touched. The snapshot is only advanced
+# for requests that succeeded, so a failed chunk or delete is retried on the next
+# sync, and it is saved atomically to a JSON file so a restart doesn't re-upload
+# everything. In case ThingsBoard was changed behind our back (a key deleted on
+# the dashboard), a source is uploaded in full once every full_sync_interval.
+#
+# Both uploaders share the file. Under a lock file, a sync first takes its
+# source's entry from disk and a save re-reads the file and writes back only the
+# sources this process synced, so one app never wipes the other's snapshot.
+
+log = logging.getLogger(__name__)
+
+
+def value_hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def chunk_payload(payload, max_keys=100, max_bytes=32768):
+    # Split { key: value } into dicts of at most max_keys keys and ~max_bytes of JSON each
+    chunk, size = {}, 2
+    for key, value in payload.items():
+        item = len(json.dumps({key: value})) - 1
+        if chunk and (len(chunk) >= max_keys or size + item > max_bytes):
+            yield chunk
+            chunk, size = {}, 2
+        chunk[key] = value
+        size += item
+    if chunk:
+        yield chunk
+
+
+class AttributeSync:
+    """Uploads each source's shared attributes as a diff against its last upload."""
+
+    def __init__(self, tb, path="calendar_sync.json", max_keys=100, max_bytes=32768,
+                 full_sync_interval=24 * 3600):
+        self.tb = tb
+        self.path = path
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self.full_sync_interval = full_sync_interval
+
+        # { device_id: { source: {"hashes": { key: hash }, "full_sync": unix time} } }
+        self._state = {}
+        self._lock = threading.Lock()
+        self._source_locks = {}  # one sync at a time per (device, source)
+        self._save_lock = threading.Lock()
+        self._dirty = set()  # (device_id, source) synced since the last save
+        self.stats = {"syncs": 0, "uploaded": 0, "deleted": 0, "unchanged": 0, "requests": 0}
+        self._load()
+
+    def sync(self, device_id, source, payload, full=False):
+        # Makes `source`'s keys on the device equal to `payload`. Returns the counts of this
+        # sync; raises the first failed request's error after keeping what did go through.
+        with self._lock:
+            source_lock = self._source_locks.setdefault((device_id, source), threading.Lock())
+        with source_lock:
+            stored = self._read_entry(device_id, source)  # the other uploader may have synced it
+            with self._lock:
+                entry = self._state.setdefault(device_id, {}).setdefault(source, {"hashes": {}, "full_sync": 0})
+                if stored is not None:
+                    entry["hashes"] = dict(stored["hashes"])
+                    entry["full_sync"] = stored["full_sync"]
+                previous = dict(entry["hashes"])
+            full = full or time.time() - entry["full_sync"] >= self.full_sync_interval
+
+            hashes = {key: value_hash(value) for key, value in payload.items()}
+            upload = {key: value for key, value in payload.items() if full or previous.get(key) != hashes[key]}
+            removed = [key for key in previous if key not in payload]
+            result = {"uploaded": 0, "deleted": 0, "unchanged": len(payload) - len(upload), "requests": 0}
+
+            try:
+                for chunk in chunk_payload(upload, self.max_keys, self.max_bytes):
+                    result["requests"] += 1
+                    self.tb.save_shared_attributes(device_id, chunk)
+                    self._record(entry, {key: hashes[key] for key in chunk})
+                    result["uploaded"] += len(chunk)
+                for i in range(0, len(removed), self.max_keys):
+                    keys = removed[i:i + self.max_keys]
+                    result["requests"] += 1
+                    self.tb.delete_shared_attributes(device_id, keys)
+                    self._record(entry, dict.fromkeys(keys))
+                    result["deleted"] += len(keys)
+                if full:
+                    with self._lock:
+                        entry["full_sync"] = time.time()
+            finally:
+                with self._lock:
+                    self.stats["syncs"] += 1
+                    for name in ("uploaded", "deleted", "unchanged", "requests"):
+                        self.stats[name] += result[name]
+                    self._dirty.add((device_id, source))
+                self._save()
+            return result
+
+    def _record(self, entry, changes):
+        # { key: hash } uploaded, { key: None } deleted
+        with self._lock:
+            for key, digest in changes.items():
+                if digest is None:
+                    entry["hashes"].pop(key, None)
+                else:
+                    entry["hashes"][key] = digest
+
+    # ---------------- persistence ----------------
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            log.warning(f"⚠ Could not load calendar sync snapshot {self.path}: {e}")
+            return {}
+
+    def _load(self):
+        self._state = self._read()
+
+    def _read_entry(self, device_id, source):
+        if not self.path:
+            return None
+        with FileLock(self.path):
+            entry = self._read().get(device_id, {}).get(source)
+        return entry if isinstance(entry, dict) and "hashes" in entry else None
+
+    def _save(self):
+        # Merge this process's synced sources into the file; everything else stays as on disk
+        if not self.path:
+            return
+        with self._save_lock, FileLock(self.path):
+            state = self._read()
+            with self._lock:
+                for device_id, source in self._dirty:
+                    entry = self._state[device_id][source]
+                    state.setdefault(device_id, {})[source] = {"hashes": dict(entry["hashes"]),
+                                                               "full_sync": entry["full_sync"]}
+                saved = set(self._dirty)
+                self._dirty.clear()
+            tmp = f"{self.path}.tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                log.error(f"❌ Could not save calendar sync snapshot {self.path}: {e}")
+                with self._lock:
+                    self._dirty |= saved
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import math
+
+# Change detection for the GET_MSG cycle
+#
+# Remembers, per device, a fingerprint of the last shared-attribute payload and,
+# per key, the value last processed plus the time its outcome can next change
+# (a calendar event entering the look-ahead window, starting or ending). A key is
+# only re-processed when its value changed or that time has come; a device whose
+# payload fingerprint is unchanged and has nothing coming due is skipped whole.
+
+
+def fingerprint(shared):
+    data = json.dumps(shared, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(data.encode(), digest_size=16).digest()
+
+
+class ChangeTracker:
+    """Tracks which shared attributes still need processing on each device."""
+
+    def __init__(self):
+        self._fingerprints = {}  # { mac: digest }
+        self._keys = {}          # { mac: { key: (value, recheck_at) } }
+        self._next_check = {}    # { mac: earliest recheck_at over its keys }
+        self.stats = {"device_hits": 0, "device_misses": 0, "key_hits": 0, "key_misses": 0}
+
+    def device_unchanged(self, mac, shared, now):
+        # True if nothing on this device can need work this cycle
+        fp = fingerprint(shared)
+        if self._fingerprints.get(mac) == fp and now < self._next_check.get(mac, 0):
+            self.stats["device_hits"] += 1
+            return True
+        self._fingerprints[mac] = fp
+        self.stats["device_misses"] += 1
+        return False
+
+    def changed_items(self, mac, shared, now):
+        # (key, value) pairs that are new, edited or due for a time-based recheck
+        known = self._keys.setdefault(mac, {})
+        for key in list(known):
+            if key not in shared:
+                # Gone from TB: forget it, so a reappearing key is treated as new
+                del known[key]
+        changed = []
+        for key, value in shared.items():
+            seen = known.get(key)
+            if seen is not None and seen[0] == value and now < seen[1]:
+                self.stats["key_hits"] += 1
+                continue
+            self.stats["key_misses"] += 1
+            changed.append((key, value))
+        return changed
+
+    def mark(self, mac, key, value, recheck_at=math.inf):
+        # Record that key was processed; recheck_at is when its outcome can change
+        self._keys.setdefault(mac, {})[key] = (value, recheck_at)
+
+    def finish_device(self, mac):
+        known = self._keys.get(mac, {})
+        self._next_check[mac] = min((r for _, r in known.values()), default=math.inf)
+
+    def forget(self, mac):
+        # Force the device to be fully re-processed next cycle (e.g. after an error)
+        self._fingerprints.pop(mac, None)
+        self._keys.pop(mac, None)
+        self._next_check.pop(mac, None)
+
+
+def next_calendar_recheck(start_ts, end_ts, now_ts, horizon=2 * 3600):
+    # The next moment a calendar value's handling changes: it enters the
+    # look-ahead window, it starts, or it ends.
+    boundaries = [start_ts - horizon, start_ts + 1, end_ts + 1]
+    return min((b for b in boundaries if b > now_ts), default=math.inf)
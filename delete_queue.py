@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# Deferred, batched shared-scope deletes
+#
+# The GET_MSG cycle enqueues keys it has finished with (expired calendar events,
+# delivered one-time messages) instead of deleting them inline. flush() is called
+# once the cycle's serial writes are done; a background thread then coalesces the
+# queued keys into one multi-key DELETE per device (chunked to max_keys) and
+# retries failures with backoff. Until a key is confirmed deleted it stays
+# "pending" so the cycle can skip it and never re-send it to the display; deleted
+# keys are remembered for tombstone_ttl seconds more in case an attribute fetch
+# raced the delete. The pending set is saved to disk so this holds across restarts.
+
+log = logging.getLogger(__name__)
+
+
+class SharedDeleteQueue:
+    """Queues (device_id, key) deletes and sends them in coalesced batches."""
+
+    def __init__(self, delete_keys, path=None, max_keys=50, retry_delay=5, max_retry_delay=300,
+                 tombstone_ttl=60, on_deleted=None, owns=None):
+        # delete_keys(device_id, [keys]) performs one DELETE request
+        self.delete_keys = delete_keys
+        self.path = path
+        self.max_keys = max_keys
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.tombstone_ttl = tombstone_ttl
+        self.on_deleted = on_deleted  # on_deleted(mac, [keys]) after a confirmed delete
+        self.owns = owns              # owns(mac): MACs this process is responsible for (None: all)
+
+        # { (mac, key): device_id }
+        self._pending = {}
+        # { (mac, key): monotonic time the delete was confirmed }
+        self._deleted = {}
+        self._cond = threading.Condition()
+        self._flush_requested = False
+        self._next_retry = None
+        self._failures = 0
+        self.stats = {"enqueued": 0, "deleted": 0, "requests": 0, "failed_requests": 0}
+
+        self._load()
+        self._thread = threading.Thread(target=self._run, name="tb-deletes", daemon=True)
+        self._thread.start()
+
+    # ---------------- public API ----------------
+
+    def enqueue(self, device_id, key, mac=None):
+        with self._cond:
+            if (mac, key) not in self._pending:
+                self._pending[(mac, key)] = device_id
+                self.stats["enqueued"] += 1
+
+    def is_pending(self, mac, key):
+        # True while the delete is queued, in flight or only just confirmed
+        with self._cond:
+            if (mac, key) in self._pending:
+                return True
+            deleted_at = self._deleted.get((mac, key))
+            if deleted_at is None:
+                return False
+            if time.monotonic() - deleted_at > self.tombstone_ttl:
+                del self._deleted[(mac, key)]
+                return False
+            return True
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self):
+        # Hand the queued keys to the background sender; returns immediately
+        with self._cond:
+            self._save()
+            self._flush_requested = True
+            self._cond.notify()
+
+    # ---------------- persistence ----------------
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        skipped = 0
+        try:
+            with open(self.path, "r") as f:
+                for item in json.load(f):
+                    if self.owns is not None and item["mac"] is not None and not self.owns(item["mac"]):
+                        skipped += 1
+                        continue
+                    self._pending[(item["mac"], item["key"])] = item["device_id"]
+        except Exception as e:
+            log.warning(f"⚠ Could not load pending deletes from {self.path}: {e}")
+        if skipped:
+            log.warning(f"⚠ Skipped {skipped} pending delete(s) for devices of another shard")
+
+    def _save(self):
+        if not self.path:
+            return
+        items = [{"mac": mac, "key": key, "device_id": device_id}
+                 for (mac, key), device_id in self._pending.items()]
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(items, f)
+        os.replace(tmp, self.path)
+
+    # ---------------- sender thread ----------------
+
+    def _batches(self):
+        # [(device_id, [(mac, key), ...])] with at most max_keys keys per request
+        by_device = {}
+        for (mac, key), device_id in self._pending.items():
+            by_device.setdefault(device_id, []).append((mac, key))
+        batches = []
+        for device_id, items in by_device.items():
+            for i in range(0, len(items), self.max_keys):
+                batches.append((device_id, items[i:i + self.max_keys]))
+        return batches
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    retry_due = self._next_retry is not None and time.monotonic() >= self._next_retry
+                    if self._pending and (self._flush_requested or retry_due):
+                        break
+                    timeout = None
+                    if self._pending and self._next_retry is not None:
+                        timeout = max(0.0, self._next_retry - time.monotonic())
+                    self._cond.wait(timeout)
+                self._flush_requested = False
+                batches = self._batches()
+
+            failed = False
+            for device_id, items in batches:
+                keys = sorted({key for _, key in items})
+                self.stats["requests"] += 1
+                try:
+                    self.delete_keys(device_id, keys)
+                except Exception as e:
+                    failed = True
+                    self.stats["failed_requests"] += 1
+                    log.warning(f"⚠ Failed to delete {len(keys)} TB key(s), will retry: {e}")
+                    continue
+
+                with self._cond:
+                    now = time.monotonic()
+                    for item in items:
+                        self._pending.pop(item, None)
+                        self._deleted[item] = now
+                    self.stats["deleted"] += len(items)
+                log.info(f"🗑 Deleted TB keys {keys}")
+                if self.on_deleted:
+                    by_mac = {}
+                    for mac, key in items:
+                        by_mac.setdefault(mac, []).append(key)
+                    for mac, mac_keys in by_mac.items():
+                        self.on_deleted(mac, mac_keys)
+
+            with self._cond:
+                if failed:
+                    self._failures += 1
+                    delay = min(self.retry_delay * 2 ** (self._failures - 1), self.max_retry_delay)
+                    self._next_retry = time.monotonic() + delay
+                else:
+                    self._failures = 0
+                    self._next_retry = None
+                cutoff = time.monotonic() - self.tombstone_ttl
+                for item, deleted_at in list(self._deleted.items()):
+                    if deleted_at < cutoff:
+                        del self._deleted[item]
+                self._save()
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+# SQLite-backed registry of provisioned devices
+#
+# One row per receiver-side MAC: ThingsBoard access token, device id and the
+# lora_N display name it was created with. The next N lives in the same database,
+# so reserving a name and adding a device are each one transaction (WAL mode; a
+# crash leaves either the old or the new state, never a half-written file).
+#
+# All rows are loaded into two dicts at startup (a single SELECT, fast even for
+# tens of thousands of devices), giving O(1) lookups MAC → device and token → MAC.
+# The registry is itself a read-only Mapping of MAC → token, so it drops in
+# wherever the old device_mac_token_map.json dict was used.
+#
+# On first use an existing device_mac_token_map.json / device_counter.txt pair is
+# imported; legacy entries get the lora_N name their map position used to give.
+
+log = logging.getLogger(__name__)
+
+
+class DeviceRegistry(Mapping):
+    """MAC → token mapping with device ids and display names, persisted in SQLite."""
+
+    def __init__(self, path, legacy_map_file=None, legacy_counter_file=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS devices (
+                mac       TEXT PRIMARY KEY,
+                token     TEXT NOT NULL UNIQUE,
+                device_id TEXT,
+                name      TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+
+        self._by_mac = {}    # { mac: (token, device_id, name) }
+        self._by_token = {}  # { token: mac }
+        for mac, token, device_id, name in self._conn.execute(
+                "SELECT mac, token, device_id, name FROM devices"):
+            self._by_mac[mac] = (token, device_id, name)
+            self._by_token[token] = mac
+
+        if not self._by_mac and legacy_map_file and os.path.exists(legacy_map_file):
+            self._import_legacy(legacy_map_file, legacy_counter_file)
+
+    # ---------------- Mapping: mac → token ----------------
+
+    def __getitem__(self, mac):
+        return self._by_mac[mac][0]
+
+    def __iter__(self):
+        # Snapshot, so provisioning threads can add devices while others iterate
+        return iter(list(self._by_mac))
+
+    def __len__(self):
+        return len(self._by_mac)
+
+    def __contains__(self, mac):
+        return mac in self._by_mac
+
+    # ---------------- lookups ----------------
+
+    def name(self, mac):
+        entry = self._by_mac.get(mac)
+        return entry[2] if entry else None
+
+    def device_id(self, mac):
+        entry = self._by_mac.get(mac)
+        return entry[1] if entry else None
+
+    def mac_for_token(self, token):
+        return self._by_token.get(token)
+
+    # ---------------- writes ----------------
+
+    def reserve_number(self):
+        # Next lora_N index, persisted before the device is created so concurrent
+        # provisioning never hands out the same name twice
+        with self._transaction():
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'next_number'").fetchone()
+            number = row[0] if row else 1
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_number', ?)",
+                               (number + 1,))
+        return number
+
+    def add(self, mac, token, device_id, name):
+        with self._transaction():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO devices (mac, token, device_id, name) VALUES (?, ?, ?, ?)",
+                (mac, token, device_id, name))
+        # Memory follows only once the row is committed
+        old = self._by_mac.get(mac)
+        if old is not None:
+            self._by_token.pop(old[0], None)
+        self._by_mac[mac] = (token, device_id, name)
+        self._by_token[token] = mac
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # ---------------- internals ----------------
+
+    @contextmanager
+    def _transaction(self):
+        # One writer at a time; commits on success, rolls back on any error
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _import_legacy(self, map_file, counter_file):
+        with open(map_file, "r") as f:
+            legacy = json.load(f)
+        next_number = len(legacy) + 1
+        if counter_file and os.path.exists(counter_file):
+            with open(counter_file, "r") as f:
+                next_number = max(next_number, int(f.read().strip()))
+
+        rows = [(mac, token, None, f"lora_{i + 1}") for i, (mac, token) in enumerate(legacy.items())]
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO devices (mac, token, device_id, name) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_number', ?)",
+                               (next_number,))
+        for mac, token, device_id, name in rows:
+            self._by_mac[mac] = (token, device_id, name)
+            self._by_token[token] = mac
+        log.info(f"📦 Imported {len(rows)} device(s) from {map_file} into {self.path}")
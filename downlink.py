@@ -0,0 +1,69 @@
+import threading
+import time
+
+# Per-cycle downlink writer
+#
+# The GET_MSG cycle adds every line meant for the receiver (one-time messages, due
+# calendar events) to a Downlink and calls send() once at the end. Lines go out
+# in as few ser.write() calls as possible, split into chunks no bigger than the
+# receiver's serial RX buffer; after each chunk we wait for the UART to drain
+# (ser.flush()) so the ESP32 isn't overrun while it is busy. Exactly one
+# "time:<ts>" line is appended last, with the timestamp taken just before that
+# final write so the receiver's clock isn't stale by the cycle's HTTP time.
+
+
+class Downlink:
+    """Collects one cycle's downlink lines and writes them in buffered chunks."""
+
+    def __init__(self, ser, lock=None, max_chunk=240, chunk_gap=0.0, clock=time.time):
+        self.ser = ser
+        self.lock = lock or threading.Lock()
+        self.max_chunk = max_chunk    # bytes; keep below the receiver's RX buffer
+        self.chunk_gap = chunk_gap    # extra pause between chunks (s)
+        self.clock = clock
+        self._lines = []
+
+    def add(self, line):
+        if not line.endswith("\n"):
+            line += "\n"
+        self._lines.append(line.encode())
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _chunks(self, reserve):
+        # Pack whole lines into chunks; the last one keeps `reserve` bytes free
+        chunks, current = [], b""
+        for line in self._lines:
+            if current and len(current) + len(line) > self.max_chunk:
+                chunks.append(current)
+                current = b""
+            current += line
+        if current and len(current) + reserve > self.max_chunk:
+            chunks.append(current)
+            current = b""
+        chunks.append(current)
+        return chunks
+
+    def send(self, time_sync=True):
+        # Returns (lines written, unix time sent or None)
+        time_line_len = len(b"time:0000000000\n")
+        with self.lock:
+            chunks = self._chunks(time_line_len if time_sync else 0)
+            now_ts = None
+            for i, chunk in enumerate(chunks):
+                last = i == len(chunks) - 1
+                if last and time_sync:
+                    now_ts = int(self.clock())
+                    chunk += f"time:{now_ts}\n".encode()
+                if not chunk:
+                    continue
+                self.ser.write(chunk)
+                if not last:
+                    # Let the UART drain before the next chunk (flow control)
+                    self.ser.flush()
+                    if self.chunk_gap:
+                        time.sleep(self.chunk_gap)
+        written = len(self._lines) + (1 if time_sync else 0)
+        self._lines = []
+        return written, now_ts
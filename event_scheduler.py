@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Time-indexed dispatch of scheduled calendar events
+#
+# Two min-heaps over the ScheduleStore, one keyed by start time and one by end
+# time, replace the per-GET_MSG scan of every label of every MAC. Finding what is
+# due or expired pops only those entries (O(log n) each). Entries are never
+# removed from the heaps in place: an entry whose times no longer match the
+# store (event edited or dropped) is simply discarded when it surfaces.
+#
+# A dispatcher thread sleeps until the next start/end time, sends events at their
+# start via on_start(mac, label, rec) and removes them from the store once ended.
+# An event whose send raises stays unsent and is tried again RETRY_DELAY seconds
+# later (until it ends); the other due events are still sent.
+
+log = logging.getLogger(__name__)
+
+
+class EventScheduler:
+    """Heap index over a ScheduleStore with a timer-driven dispatcher."""
+
+    # Upper bound on one sleep so wall-clock jumps (NTP, DST) are noticed
+    MAX_SLEEP = 60
+    # Wait before sending an event again after its send failed (s)
+    RETRY_DELAY = 5
+
+    def __init__(self, store, on_start, on_end=None, clock=time.time):
+        self.store = store
+        self.on_start = on_start
+        self.on_end = on_end
+        self.clock = clock
+
+        # Guards the heaps and the store; hold it for any other store access too
+        self.lock = threading.RLock()
+        self._cond = threading.Condition(self.lock)
+        self._starts = []  # (due, seq, mac, label, start, end), due = start unless a send failed
+        self._ends = []    # (end, seq, mac, label, start)
+        self._seq = itertools.count()
+        self.stats = {"dispatched": 0, "expired": 0, "stale_entries": 0, "send_errors": 0}
+
+    def track(self, mac, label, start, end):
+        # Index an event the store just gained or whose times changed
+        with self._cond:
+            seq = next(self._seq)
+            heapq.heappush(self._starts, (start, seq, mac, label, start, end))
+            heapq.heappush(self._ends, (end, seq, mac, label, start))
+            self._cond.notify()
+
+    def track_all(self):
+        with self.lock:
+            for mac in self.store.macs():
+                for label, rec in self.store.events(mac).items():
+                    self.track(mac, label, rec["start"], rec["end"])
+
+    def _current(self, mac, label, start, end):
+        rec = self.store.events(mac).get(label)
+        if rec is None or rec["start"] != start or rec["end"] != end:
+            self.stats["stale_entries"] += 1
+            return None
+        return rec
+
+    def dispatch_due(self, now=None, on_start=None, commit=True):
+        # Send everything whose start has come, drop everything that has ended.
+        # on_start overrides the default sender, e.g. to add to a cycle's downlink;
+        # commit=False leaves the journal write to the caller (under self.lock).
+        # A send that raises is logged and its event retried RETRY_DELAY s later.
+        now = int(self.clock()) if now is None else now
+        on_start = on_start or self.on_start
+        sent = 0
+        retry = []
+        with self.lock:
+            while self._ends and self._ends[0][0] < now:
+                end, _, mac, label, start = heapq.heappop(self._ends)
+                if self._current(mac, label, start, end) is None:
+                    continue
+                self.store.remove(mac, label)
+                self.stats["expired"] += 1
+                if self.on_end:
+                    self.on_end(mac, label)
+
+            while self._starts and self._starts[0][0] <= now:
+                _, seq, mac, label, start, end = heapq.heappop(self._starts)
+                rec = self._current(mac, label, start, end)
+                if rec is None or rec.get("sent", False):
+                    continue
+                try:
+                    on_start(mac, label, rec)
+                except Exception as e:
+                    log.error(f"❌ Sending event '{label}' for MAC {mac} failed, retrying in {self.RETRY_DELAY}s: {e}")
+                    self.stats["send_errors"] += 1
+                    retry.append((now + self.RETRY_DELAY, seq, mac, label, start, end))
+                    continue
+                self.store.mark_sent(mac, label)
+                self.stats["dispatched"] += 1
+                sent += 1
+            for entry in retry:
+                heapq.heappush(self._starts, entry)
+
+            if commit:
+                self.store.commit()
+        return sent
+
+    def next_deadline(self):
+        with self.lock:
+            deadlines = []
+            if self._starts:
+                deadlines.append(self._starts[0][0])
+            if self._ends:
+                deadlines.append(self._ends[0][0] + 1)  # expired means end < now
+            return min(deadlines) if deadlines else None
+
+    def start(self):
+        threading.Thread(target=self._run, name="event-dispatcher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = self.next_deadline()
+                timeout = self.MAX_SLEEP
+                if deadline is not None:
+                    timeout = min(max(0.0, deadline - self.clock()), self.MAX_SLEEP)
+                if timeout > 0:
+                    self._cond.wait(timeout)
+            try:
+                self.dispatch_due()
+            except Exception as e:
+                log.error(f"❌ Event dispatcher error: {e}")
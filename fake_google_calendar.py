@@ -0,0 +1,171 @@
+import threading
+import uuid
+
+# In-memory Google Calendar events service for offline sync tests
+#
+# Answers service.events().list(**params).execute() the way the Calendar API
+# does for google_sync.GoogleCalendarSync: singleEvents=False listings paged by
+# maxResults/pageToken, a nextSyncToken on the last page, and incremental
+# listings with syncToken that return every event changed since, deleted ones as
+# {"id", "status": "cancelled"} stubs. Cancelled instances of a recurring event
+# are part of every listing, as with the real API. Parameters the API refuses
+# together with a sync token answer 400, and expire_tokens() makes every token
+# handed out so far answer 410 Gone.
+#
+# Calendars are edited with insert/update/delete and, for one instance of a
+# series, cancel_instance/move_instance. requests and items_sent count what the
+# client cost the "API".
+
+SYNC_TOKEN_EXCLUSIVE = ("timeMin", "timeMax", "orderBy", "q", "updatedMin", "iCalUID", "privateExtendedProperty",
+                        "sharedExtendedProperty")
+
+
+class FakeHttpError(Exception):
+    """Stands in for googleapiclient.errors.HttpError (callers only look at .resp.status)."""
+
+    class _Resp:
+        def __init__(self, status):
+            self.status = status
+
+    def __init__(self, status, reason):
+        super().__init__(f"<HttpError {status}: {reason}>")
+        self.resp = self._Resp(status)
+
+
+class _Request:
+    def __init__(self, run):
+        self._run = run
+
+    def execute(self):
+        return self._run()
+
+
+class _Events:
+    def __init__(self, calendar):
+        self._calendar = calendar
+
+    def list(self, **params):
+        return _Request(lambda: self._calendar.list_events(**params))
+
+
+class FakeCalendarService:
+    """In-memory stand-in for build('calendar', 'v3') covering events().list."""
+
+    def __init__(self):
+        self._events = {}      # { id: resource }, deleted series kept as cancelled stubs
+        self._changed = {}     # { id: sequence number of its last change }
+        self._seq = 0
+        self._min_token = 0    # tokens below this answer 410
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.items_sent = 0
+
+    def events(self):
+        return _Events(self)
+
+    # ---------------- API ----------------
+
+    def list_events(self, calendarId="primary", syncToken=None, pageToken=None, maxResults=250,
+                    singleEvents=False, showDeleted=False, **params):
+        with self._lock:
+            self.requests += 1
+            if singleEvents:
+                raise FakeHttpError(400, "the fake only lists with singleEvents=False")
+            if syncToken is not None:
+                refused = [name for name in SYNC_TOKEN_EXCLUSIVE if name in params]
+                if refused:
+                    raise FakeHttpError(400, f"syncToken can't be combined with {', '.join(refused)}")
+
+            if pageToken:
+                # "<since>:<upto>:<offset>": the listing this page continues
+                since, upto, offset = (int(part) for part in pageToken.split(":"))
+                since = None if since < 0 else since
+            else:
+                since = self._token_seq(syncToken) if syncToken is not None else None
+                upto, offset = self._seq, 0
+                if since is not None and since < self._min_token:
+                    raise FakeHttpError(410, "Sync token is no longer valid, a full sync is required.")
+
+            if since is None:
+                # Full listing: deleted events only as cancelled instances of a live series
+                ids = [event_id for event_id, seq in self._changed.items()
+                       if seq <= upto and (showDeleted or self._listed(self._events[event_id]))]
+            else:
+                ids = [event_id for event_id, seq in self._changed.items() if since < seq <= upto]
+            ids.sort(key=self._changed.get)
+            page = [dict(self._events[event_id]) for event_id in ids[offset:offset + maxResults]]
+            self.items_sent += len(page)
+
+            response = {"kind": "calendar#events", "items": page}
+            if offset + maxResults < len(ids):
+                response["nextPageToken"] = f"{-1 if since is None else since}:{upto}:{offset + maxResults}"
+            else:
+                response["nextSyncToken"] = f"seq:{upto}"
+            return response
+
+    def _listed(self, event):
+        if event.get("status") != "cancelled":
+            return True
+        series = self._events.get(event.get("recurringEventId"))
+        return series is not None and series.get("status") != "cancelled"
+
+    @staticmethod
+    def _token_seq(token):
+        try:
+            return int(token.split(":", 1)[1])
+        except (IndexError, ValueError):
+            raise FakeHttpError(410, "Invalid sync token")
+
+    # ---------------- editing ----------------
+
+    def insert(self, summary, start, end, recurrence=None, event_id=None):
+        # start/end: {"dateTime": ..., "timeZone": ...} or {"date": ...}
+        event = {"id": event_id or uuid.uuid4().hex, "status": "confirmed", "summary": summary,
+                 "start": start, "end": end}
+        if recurrence:
+            event["recurrence"] = list(recurrence)
+        self._put(event)
+        return event["id"]
+
+    def update(self, event_id, **fields):
+        event = dict(self._events[event_id])
+        event.update(fields)
+        self._put(event)
+
+    def delete(self, event_id):
+        # A deleted series takes its changed and cancelled instances with it
+        with self._lock:
+            doomed = [event_id] + [other for other, event in self._events.items()
+                                   if event.get("recurringEventId") == event_id]
+        for other in doomed:
+            stub = {"id": other, "status": "cancelled"}
+            if "recurringEventId" in self._events[other]:
+                stub["recurringEventId"] = event_id
+                stub["originalStartTime"] = self._events[other]["originalStartTime"]
+            self._put(stub)
+
+    def cancel_instance(self, series_id, original_start):
+        self._put({"id": self._instance_id(series_id, original_start), "status": "cancelled",
+                   "recurringEventId": series_id, "originalStartTime": original_start})
+
+    def move_instance(self, series_id, original_start, start, end, summary=None):
+        series = self._events[series_id]
+        self._put({"id": self._instance_id(series_id, original_start), "status": "confirmed",
+                   "summary": summary or series.get("summary", ""), "start": start, "end": end,
+                   "recurringEventId": series_id, "originalStartTime": original_start})
+
+    def expire_tokens(self):
+        with self._lock:
+            self._seq += 1
+            self._min_token = self._seq
+
+    def _put(self, event):
+        with self._lock:
+            self._seq += 1
+            self._events[event["id"]] = event
+            self._changed[event["id"]] = self._seq
+
+    @staticmethod
+    def _instance_id(series_id, original_start):
+        stamp = original_start.get("dateTime", original_start.get("date", ""))
+        return f"{series_id}_{''.join(c for c in stamp[:19] if c.isdigit())}"
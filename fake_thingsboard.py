@@ -0,0 +1,223 @@
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local ThingsBoard stand-in for offline load tests
+#
+# Implements the REST and device API calls the gateway scripts make (login and
+# token refresh, device/credentials/dashboard creation, shared attributes and
+# their deletion, attribute long-poll, telemetry) in memory. Every request can
+# be slowed down by a fixed latency plus jitter, and a fraction of them can be
+# failed with a configurable status to exercise retries and the telemetry spool.
+#
+# Telemetry records are timestamped on arrival so the load test can compute
+# end-to-end latency per reading.
+#
+#   python fake_thingsboard.py --port 8080 --latency-ms 50 --error-rate 0.01
+
+
+def fake_jwt(lifetime):
+    def b64(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+    return f"{b64({'alg': 'none'})}.{b64({'exp': int(time.time() + lifetime), 'jti': uuid.uuid4().hex})}.x"
+
+
+class FakeThingsBoard:
+    """In-memory ThingsBoard with injectable latency and errors, served over HTTP."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, jitter_ms=0.0,
+                 error_rate=0.0, error_status=503, jwt_lifetime=3600):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.jwt_lifetime = jwt_lifetime
+
+        self.lock = threading.Lock()
+        self.jwts = set()
+        self.devices = {}        # { device_id: {"name": str, "token": str} }
+        self.shared = {}         # { device_id: {key: value} } (tenant API view)
+        self.token_device = {}   # { token: device_id }
+        self.telemetry = []      # [(arrival_monotonic, token, record)]
+        self.counts = {}         # { endpoint: requests }
+        self.errors_injected = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._handle(self, "GET")
+
+            def do_POST(self):
+                server._handle(self, "POST")
+
+            def do_DELETE(self):
+                server._handle(self, "DELETE")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-tb", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def set_shared(self, device_id, attrs):
+        with self.lock:
+            self.shared.setdefault(device_id, {}).update(attrs)
+
+    def telemetry_records(self):
+        with self.lock:
+            return list(self.telemetry)
+
+    # ---------------- request handling ----------------
+
+    def _handle(self, req, method):
+        parsed = urlparse(req.path)
+        parts = [p for p in parsed.path.split("/") if p]
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(req.headers.get("Content-Length") or 0)
+        body = json.loads(req.rfile.read(length)) if length else None
+
+        if self.latency_ms or self.jitter_ms:
+            time.sleep(max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+        endpoint = self._endpoint(method, parts)
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        if endpoint != "auth" and self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.errors_injected += 1
+            return self._reply(req, self.error_status, {"message": "injected error"})
+
+        try:
+            status, payload = self._route(req, method, parts, query, body)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            status, payload = 400, {"message": str(e)}
+        self._reply(req, status, payload)
+
+    @staticmethod
+    def _endpoint(method, parts):
+        if parts[:2] == ["api", "auth"]:
+            return "auth"
+        if parts[:2] == ["api", "v1"] and len(parts) >= 4:
+            return f"{method} device/{'/'.join(parts[3:])}"
+        return f"{method} {'/'.join(parts[1:2] + parts[-1:] if len(parts) > 2 else parts[1:])}"
+
+    def _reply(self, req, status, payload):
+        data = b"" if payload is None else json.dumps(payload).encode()
+        req.send_response(status)
+        req.send_header("Content-Type", "application/json")
+        req.send_header("Content-Length", str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    def _authorized(self, req):
+        header = req.headers.get("X-Authorization", "")
+        return header.startswith("Bearer ") and header[7:] in self.jwts
+
+    def _issue(self):
+        token = fake_jwt(self.jwt_lifetime)
+        self.jwts.add(token)
+        return 200, {"token": token, "refreshToken": f"refresh-{token}"}
+
+    def _route(self, req, method, parts, query, body):
+        if parts[:2] == ["api", "v1"] and parts[3:] == ["attributes", "updates"]:
+            # Long-poll: nothing ever changes here, answer "no update" (capped at 1 s)
+            time.sleep(min(int(query.get("timeout", "0")) / 1000, 1.0))
+            return 408, None
+
+        with self.lock:
+            # ---- auth ----
+            if parts == ["api", "auth", "login"]:
+                return self._issue()
+            if parts == ["api", "auth", "token"]:
+                if not body["refreshToken"].startswith("refresh-"):
+                    return 401, {"message": "bad refresh token"}
+                return self._issue()
+
+            # ---- device API (access token in the path) ----
+            if parts[:2] == ["api", "v1"]:
+                token = parts[2]
+                device_id = self.token_device.get(token)
+                if device_id is None:
+                    return 401, {"message": "unknown device token"}
+                tail = parts[3:]
+                if tail == ["telemetry"] and method == "POST":
+                    now = time.monotonic()
+                    records = body if isinstance(body, list) else [body]
+                    self.telemetry.extend((now, token, record) for record in records)
+                    return 200, None
+                if tail == ["attributes"] and method == "POST":
+                    return 200, None
+                if tail == ["attributes"] and method == "GET":
+                    return 200, {"client": {}, "shared": dict(self.shared.get(device_id, {}))}
+                return 404, {"message": "not found"}
+
+            # ---- tenant API (JWT) ----
+            if not self._authorized(req):
+                return 401, {"message": "token expired or invalid"}
+            if parts == ["api", "device"] and method == "POST":
+                device_id = str(uuid.uuid4())
+                token = uuid.uuid4().hex[:20]
+                self.devices[device_id] = {"name": body["name"], "token": token}
+                self.token_device[token] = device_id
+                return 200, {"id": {"id": device_id}, "name": body["name"]}
+            if parts[:2] == ["api", "device"] and parts[3:] == ["credentials"]:
+                return 200, {"credentialsId": self.devices[parts[2]]["token"]}
+            if parts == ["api", "dashboard"] and method == "POST":
+                return 200, {"id": {"id": str(uuid.uuid4())}}
+            if parts[:2] == ["api", "dashboard"] and parts[3:] == ["assignToEntity"]:
+                return 200, None
+            if parts[:4] == ["api", "plugins", "telemetry", "DEVICE"] and parts[5:] == ["SHARED_SCOPE"]:
+                device_id = parts[4]
+                if method == "POST":
+                    self.shared.setdefault(device_id, {}).update(body)
+                    return 200, None
+                if method == "DELETE":
+                    keys = query.get("keys", "").split(",")
+                    # The gateways delete by tenant device id; drop the keys wherever they are
+                    for attrs in self.shared.values():
+                        for key in keys:
+                            attrs.pop(key, None)
+                    return 200, None
+            return 404, {"message": "not found"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local ThingsBoard stand-in for offline tests")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests to fail")
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+
+    tb = FakeThingsBoard(port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                         error_rate=args.error_rate, error_status=args.error_status)
+    print(f"Fake ThingsBoard listening on {tb.url} (Ctrl+C to stop)")
+    try:
+        tb.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tb.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
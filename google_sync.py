@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from ics_stream import (Event, attribute_key, attribute_value, lookup_zone, occurrence_key, occurrences,
+                        parse_datetime, parse_recurrence, rrulestr)
+
+# Incremental Google Calendar sync for CalenderUploader.py
+#
+# GoogleCalendarSync keeps a local copy of one calendar, kept current with the
+# Calendar API's sync tokens: the first sync pages through the whole calendar
+# (events.list, maxResults=page_size, following nextPageToken) and stores the
+# nextSyncToken of the last page; every later sync sends that token and gets back
+# only what changed since, deletions included. A token the API no longer accepts
+# (HTTP 410 Gone) triggers one full sync. The service object is built once by the
+# caller and reused; the copy and the token are saved to a JSON file, so a
+# restart continues incrementally.
+#
+# Events are listed with singleEvents=False (sync tokens can't be combined with
+# timeMin/orderBy, and an expanded list of every instance is unbounded): recurring
+# events arrive as their master (RRULE/EXDATE lines) plus one item per changed or
+# cancelled instance. payload() turns the copy into shared attributes the same
+# way dropped .ics files are handled: one-off events in the window under their
+# title, recurring ones expanded lazily by ics_stream up to the horizon, each
+# occurrence under its stable "<title>_<YYYYMMDD-HHMM>" key.
+#
+# One-off events and instance exceptions that ended more than a day ago are not
+# kept; if such an event changes again the API sends it in full.
+
+log = logging.getLogger(__name__)
+
+KEEP_FIELDS = ("id", "status", "summary", "start", "end", "recurrence", "recurringEventId", "originalStartTime")
+PRUNE_AFTER = timedelta(days=1)
+
+
+def http_status(error):
+    # Status of a googleapiclient HttpError (or anything shaped like it), else None
+    resp = getattr(error, "resp", None)
+    return getattr(resp, "status", None)
+
+
+def parse_when(field, stats=None):
+    # {"date": "2025-03-01"} or {"dateTime": "2025-03-01T09:00:00+01:00", "timeZone": "Europe/Berlin"}
+    # → (aware datetime, all_day, floating); timed events are put in their own zone so
+    # recurrences keep their wall time across DST
+    if "date" in field:
+        return parse_datetime(field["date"].replace("-", ""), {"VALUE": "DATE"})
+    dt = datetime.fromisoformat(field["dateTime"].replace("Z", "+00:00"))
+    zone = lookup_zone(field["timeZone"], stats) if field.get("timeZone") else None
+    return (dt.astimezone(zone) if zone is not None else dt), False, False
+
+
+class GoogleCalendarSync:
+    """Local copy of one Google calendar, kept current with incremental sync tokens."""
+
+    def __init__(self, service, calendar_id="primary", path="google_sync.json", page_size=250):
+        self.service = service
+        self.calendar_id = calendar_id
+        self.path = path
+        self.page_size = page_size
+
+        self._events = {}        # { event id: trimmed resource } one-off events, masters and exceptions
+        self._sync_token = None
+        self._lock = threading.Lock()
+        self.stats = {"syncs": 0, "full_syncs": 0, "pages": 0, "items": 0, "expired_tokens": 0}
+        self._load()
+
+    def sync(self, now=None):
+        # One incremental sync (full the first time or after a 410). Returns
+        # {"full": bool, "pages": n, "items": n}; API errors other than 410 propagate
+        # and leave the copy and the token as they were.
+        with self._lock:
+            try:
+                result = self._list(full=self._sync_token is None)
+            except Exception as e:
+                if http_status(e) != 410:
+                    raise
+                log.warning("⚠ Google Calendar sync token expired, doing a full sync")
+                self.stats["expired_tokens"] += 1
+                result = self._list(full=True)
+            self._prune(now or datetime.now(timezone.utc))
+            self._save()
+            return result
+
+    def _list(self, full):
+        # A full sync builds a new copy and only replaces the old one once every page is in
+        events = {} if full else dict(self._events)
+        result = {"full": full, "pages": 0, "items": 0}
+        deleted = set()
+        page_token = None
+        while True:
+            params = {"calendarId": self.calendar_id, "singleEvents": False, "maxResults": self.page_size}
+            if not full:
+                params["syncToken"] = self._sync_token
+            if page_token:
+                params["pageToken"] = page_token
+            response = self.service.events().list(**params).execute()
+            result["pages"] += 1
+            for item in response.get("items", []):
+                result["items"] += 1
+                if item.get("status") == "cancelled" and "recurringEventId" not in item:
+                    # Deleted (a cancelled instance is kept: it hides one occurrence)
+                    events.pop(item["id"], None)
+                    deleted.add(item["id"])
+                else:
+                    events[item["id"]] = {field: item[field] for field in KEEP_FIELDS if field in item}
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+
+        if deleted:
+            # A deleted series takes its changed instances with it
+            events = {event_id: item for event_id, item in events.items()
+                      if item.get("recurringEventId") not in deleted}
+        self._events = events
+        self._sync_token = response.get("nextSyncToken")
+        self.stats["syncs"] += 1
+        self.stats["full_syncs"] += full
+        self.stats["pages"] += result["pages"]
+        self.stats["items"] += result["items"]
+        return result
+
+    def _prune(self, now):
+        cutoff = now - PRUNE_AFTER
+        for event_id, item in list(self._events.items()):
+            if "recurrence" in item:
+                continue
+            try:
+                field = item.get("end") or item.get("originalStartTime")
+                if parse_when(field)[0] < cutoff:
+                    del self._events[event_id]
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    # ---------------- shared attributes ----------------
+
+    def payload(self, window_start, window_end, horizon_end=None, stats=None):
+        # { attribute key: "Start: ...\nEnd: ..." } for events overlapping the window;
+        # recurring events as occurrences up to the earlier of window_end and horizon_end
+        if stats is None:
+            stats = {}
+        for key in ("events", "invalid", "series", "occurrences"):
+            stats.setdefault(key, 0)
+        expand_until = min(window_end, horizon_end) if horizon_end is not None else window_end
+        with self._lock:
+            items = list(self._events.values())
+
+        payload, one_offs, series, overrides, cancelled = {}, [], [], {}, {}
+        for item in items:
+            stats["events"] += 1
+            try:
+                if "recurringEventId" in item:
+                    original, all_day, _ = parse_when(item["originalStartTime"], stats)
+                    if item.get("status") == "cancelled":
+                        cancelled.setdefault(item["recurringEventId"], []).append(original)
+                        continue
+                    event = self._event(item, stats)
+                    event.uid = item["recurringEventId"]
+                    event.recurrence_id = original
+                    event.key = occurrence_key(event.summary, original, all_day)
+                    overrides[(event.uid, original)] = event
+                elif "recurrence" in item:
+                    stats["series"] += 1
+                    series.append(self._event(item, stats))
+                else:
+                    event = self._event(item, stats)
+                    if event.summary and event.end > window_start and event.start < window_end:
+                        one_offs.append(event)
+            except (KeyError, TypeError, ValueError):
+                stats["invalid"] += 1
+
+        # Events sharing a title share a key: the next one to start wins, whatever order they synced in
+        for event in sorted(one_offs, key=lambda event: (event.start, event.uid)):
+            payload.setdefault(event.key, attribute_value(event.start, event.end))
+
+        if rrulestr is None:
+            # Without python-dateutil a series counts as its first occurrence
+            recurring = [m for m in series if m.end > window_start and m.start < window_end]
+        else:
+            for master in series:
+                master.exdates = list(master.exdates) + cancelled.get(master.uid, [])
+            recurring = occurrences([m for m in series if m.start < expand_until], overrides,
+                                    window_start, expand_until, stats)
+        for event in recurring:
+            if event.summary:
+                payload[event.key] = attribute_value(event.start, event.end)
+        return payload
+
+    @staticmethod
+    def _event(item, stats):
+        start, all_day, floating = parse_when(item["start"], stats)
+        end = parse_when(item["end"], stats)[0] if "end" in item else start
+        rrule, rdates, exdates = parse_recurrence(item.get("recurrence", ()), stats)
+        summary = item.get("summary", "")
+        return Event(item["id"], summary, start, end, all_day, floating, attribute_key(summary),
+                     rrule=rrule, rdates=rdates, exdates=exdates)
+
+    # ---------------- persistence ----------------
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("calendar_id") == self.calendar_id:
+                self._events = data["events"]
+                self._sync_token = data.get("sync_token")
+        except Exception as e:
+            log.warning(f"⚠ Could not load Google sync state {self.path}: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"calendar_id": self.calendar_id, "sync_token": self._sync_token,
+                           "events": self._events}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.error(f"❌ Could not save Google sync state {self.path}: {e}")
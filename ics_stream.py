@@ -0,0 +1,442 @@
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python < 3.9: TZID times are read as local time
+    ZoneInfo = None
+    ZoneInfoNotFoundError = KeyError
+
+try:
+    from dateutil.rrule import rruleset, rrulestr
+except ImportError:  # without python-dateutil a recurring event counts as its first occurrence only
+    rrulestr = None
+
+# Streaming .ics reader shared by ics_uploader.py and CalenderUploader.py
+#
+# iter_events(path) is a generator over the file's VEVENTs. It reads one line at
+# a time, unfolds continuation lines (RFC 5545 3.1: CRLF + space/tab) as it
+# goes and keeps only the event being parsed, so memory stays flat whatever the
+# file size. Nested components (VALARM) and everything outside VEVENTs
+# (VTIMEZONE, X- properties) are skipped.
+#
+# Times come out as timezone-aware datetimes:
+#   DTSTART:20250301T090000Z                   UTC
+#   DTSTART;TZID=Europe/Berlin:20250301T090000  that zone (zoneinfo), or local time if unknown
+#   DTSTART:20250301T090000                     floating = local time
+#   DTSTART;VALUE=DATE:20250301                 all-day, local midnight
+# An event without DTEND ends after its DURATION, or one day later if all-day.
+#
+# With window_start/window_end only events overlapping that window are yielded,
+# so a calendar export with years of history turns into a handful of events.
+#
+# Recurring events (RRULE/RDATE/EXDATE, python-dateutil) are expanded lazily and
+# only up to horizon_end, normally now + HORIZON: the gateways only schedule
+# events starting in the next two hours, so later occurrences are left for a
+# later sync instead of being generated now. Series masters are held until the
+# end of the file (a RECURRENCE-ID override may come after its master), then
+# stepped through in order from the window start until the first occurrence past
+# the horizon, so an open-ended series costs no more than its occurrences in the
+# window. A rule without COUNT is restarted a whole number of intervals after
+# DTSTART (MINUTELY to WEEKLY), so years of history aren't stepped through either.
+# Occurrences repeat in the wall time of their DTSTART zone, across DST changes.
+# Each occurrence gets a stable key, "<title>_<YYYYMMDD-HHMM>" of its original
+# start, that stays the same on every sync and for a moved (overridden) instance.
+
+_DURATION = re.compile(r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+_ESCAPE = re.compile(r"\\(.)")
+
+HORIZON = timedelta(hours=2)  # the gateways' look-ahead for scheduling calendar events
+MAX_SCANNED = 100000          # occurrences stepped through per series before giving up
+
+# Whole periods a rule without COUNT can be moved forward by without changing its occurrences
+_PERIODS = {"WEEKLY": timedelta(weeks=1), "DAILY": timedelta(days=1), "HOURLY": timedelta(hours=1),
+            "MINUTELY": timedelta(minutes=1)}
+
+log = logging.getLogger(__name__)
+
+
+class Event:
+    """One VEVENT, or one occurrence of a recurring one, with the fields the uploaders need."""
+
+    __slots__ = ("uid", "summary", "start", "end", "all_day", "floating", "key",
+                 "rrule", "rdates", "exdates", "recurrence_id")
+
+    def __init__(self, uid, summary, start, end, all_day=False, floating=False, key=None,
+                 rrule=None, rdates=(), exdates=(), recurrence_id=None):
+        self.uid = uid
+        self.summary = summary
+        self.start = start
+        self.end = end
+        self.all_day = all_day
+        self.floating = floating            # local wall time (no zone, or all-day)
+        self.key = key or attribute_key(summary)
+        self.rrule = rrule                  # raw RRULE value of a series master
+        self.rdates = rdates
+        self.exdates = exdates
+        self.recurrence_id = recurrence_id  # original start of an occurrence / override
+
+    def __repr__(self):
+        return f"Event({self.key!r}, {self.start:%Y-%m-%d %H:%M} → {self.end:%Y-%m-%d %H:%M})"
+
+    @property
+    def recurring(self):
+        return bool(self.rrule or self.rdates)
+
+
+def unfold(lines):
+    # Physical lines → logical content lines, one pending line held back
+    pending = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t"):
+            if pending is not None:
+                pending += line[1:]
+            continue
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending:
+        yield pending
+
+
+def parse_line(line):
+    # 'DTSTART;TZID="Europe/Berlin":20250301T090000' → ("DTSTART", {"TZID": "Europe/Berlin"}, "20250301T090000")
+    colon = line.find(":")
+    if colon < 0:
+        return None, {}, ""  # no value: not a content line
+    head, value = line[:colon], line[colon + 1:]
+    if '"' in head:
+        # ':' and ';' inside quoted parameter values don't count
+        head, value = _split_quoted(line)
+    name, *parts = head.split(";") if '"' not in head else _split_params(head)
+    params = {}
+    for param in parts:
+        key, _, val = param.partition("=")
+        params[key.upper()] = val.strip('"')
+    return name.upper(), params, value
+
+
+def _split_quoted(line):
+    in_quotes = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            in_quotes = not in_quotes
+        elif ch == ":" and not in_quotes:
+            return line[:i], line[i + 1:]
+    return line, ""
+
+
+def _split_params(head):
+    parts, start, in_quotes = [], 0, False
+    for i, ch in enumerate(head):
+        if ch == '"':
+            in_quotes = not in_quotes
+        elif ch == ";" and not in_quotes:
+            parts.append(head[start:i])
+            start = i + 1
+    parts.append(head[start:])
+    return parts
+
+
+def unescape(text):
+    # RFC 5545 TEXT: \n \N \, \; \\
+    return _ESCAPE.sub(lambda m: "\n" if m.group(1) in "nN" else m.group(1), text)
+
+
+def lookup_zone(tzid, stats=None):
+    # TZID → ZoneInfo, or None if unknown (then the time is read as local time)
+    if ZoneInfo is not None:
+        # Some exporters prefix the Olson name, e.g. /mozilla.org/20070129_1/Europe/Berlin
+        for name in (tzid, "/".join(tzid.split("/")[-2:]), tzid.split("/")[-1]):
+            try:
+                return ZoneInfo(name)
+            except (ZoneInfoNotFoundError, ValueError):
+                continue
+    if stats is not None:
+        stats["unknown_tzid"] = stats.get("unknown_tzid", 0) + 1
+    return None
+
+
+def parse_datetime(value, params, stats=None, zones=None):
+    # → (aware datetime, all_day, floating)
+    value = value.strip()
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        d = datetime.strptime(value[:8], "%Y%m%d")
+        return d.astimezone(), True, True
+
+    dt = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        return dt.replace(tzinfo=timezone.utc), False, False
+    tzid = params.get("TZID")
+    if tzid:
+        if zones is None:
+            zones = {}
+        if tzid not in zones:
+            zones[tzid] = lookup_zone(tzid, stats)
+        if zones[tzid] is not None:
+            return dt.replace(tzinfo=zones[tzid]), False, False
+    return dt.astimezone(), False, True  # floating (or unknown zone): local time
+
+
+def _datetimes(values, stats, zones):
+    # EXDATE/RDATE properties (each may list several values; PERIODs count by their start)
+    return [parse_datetime(v.partition("/")[0], params, stats, zones)[0]
+            for value, params in values for v in value.split(",") if v.strip()]
+
+
+def parse_recurrence(lines, stats=None):
+    # Content lines such as Google Calendar's "recurrence" list
+    # (["RRULE:FREQ=WEEKLY;BYDAY=MO", "EXDATE;TZID=Europe/Berlin:20250303T090000"]) → (rrule, rdates, exdates)
+    rrule, values = None, {"RDATE": [], "EXDATE": []}
+    for line in lines:
+        name, params, value = parse_line(line)
+        if name == "RRULE" and rrule is None:
+            rrule = value
+        elif name in values:
+            values[name].append((value, params))
+    zones = {}
+    return rrule, _datetimes(values["RDATE"], stats, zones), _datetimes(values["EXDATE"], stats, zones)
+
+
+def parse_duration(value):
+    m = _DURATION.match(value.strip())
+    if not m:
+        raise ValueError(f"bad DURATION {value!r}")
+    sign, weeks, days, hours, minutes, seconds = m.groups()
+    delta = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+                      minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -delta if sign == "-" else delta
+
+
+def _build(props, stats, zones):
+    if "DTSTART" not in props:
+        return None
+    start, all_day, floating = parse_datetime(*props["DTSTART"], stats, zones)
+    if "DTEND" in props:
+        end = parse_datetime(*props["DTEND"], stats, zones)[0]
+    elif "DURATION" in props:
+        end = start + parse_duration(props["DURATION"][0])
+    else:
+        end = start + timedelta(days=1) if all_day else start
+    summary = unescape(props["SUMMARY"][0]) if "SUMMARY" in props else ""
+    uid = props["UID"][0] if "UID" in props else None
+    event = Event(uid, summary, start, end, all_day, floating,
+                  rrule=props["RRULE"][0] if "RRULE" in props else None,
+                  rdates=_datetimes(props.get("RDATE", ()), stats, zones),
+                  exdates=_datetimes(props.get("EXDATE", ()), stats, zones))
+    if "RECURRENCE-ID" in props:
+        event.recurrence_id = parse_datetime(*props["RECURRENCE-ID"], stats, zones)[0]
+        event.key = occurrence_key(summary, event.recurrence_id, all_day)
+    return event
+
+
+def iter_events(source, window_start=None, window_end=None, stats=None, horizon_end=None):
+    # source: a path, an open text file or any iterable of lines.
+    # window_start/window_end (aware datetimes, either may be None) keep only events
+    # with end > window_start and start < window_end. Recurring events are expanded
+    # into occurrences up to the earlier of window_end and horizon_end; with neither
+    # set they are yielded once, as their first occurrence. stats (dict) gets counts
+    # of events seen/yielded/skipped, series expanded and bad events.
+    if isinstance(source, str):
+        with open(source, "r", encoding="utf-8", errors="replace", newline="") as f:
+            yield from iter_events(f, window_start, window_end, stats, horizon_end)
+        return
+
+    if stats is None:
+        stats = {}
+    for key in ("events", "yielded", "outside_window", "invalid", "series", "occurrences"):
+        stats.setdefault(key, 0)
+    expand_until = min((t for t in (window_end, horizon_end) if t is not None), default=None)
+    if rrulestr is None:
+        expand_until = None
+    zones = {}      # TZID → ZoneInfo (or None), looked up once per file
+    props = None    # properties of the VEVENT being read: { NAME: (value, params) }
+    depth = 0       # components nested inside it (VALARM)
+    series = []     # recurring masters that may have occurrences before expand_until
+    overrides = {}  # { (uid, original start): overriding VEVENT } near the window
+
+    def in_window(event):
+        return (window_start is None or event.end > window_start) and \
+            (window_end is None or event.start < window_end)
+
+    for line in unfold(source):
+        name, params, value = parse_line(line)
+        if name == "BEGIN":
+            if props is not None:
+                depth += 1
+            elif value.upper() == "VEVENT":
+                props, depth = {}, 0
+            continue
+        if props is None:
+            continue
+        if name == "END":
+            if depth:
+                depth -= 1
+                continue
+            stats["events"] += 1
+            try:
+                event = _build(props, stats, zones)
+            except ValueError:
+                event = None
+            props = None
+            if event is None:
+                stats["invalid"] += 1
+                continue
+
+            if expand_until is not None:
+                if event.recurring:
+                    stats["series"] += 1
+                    if event.start < expand_until:
+                        series.append(event)
+                    continue
+                if event.recurrence_id is not None:
+                    # Kept if it or the instance it replaces is near the window; the rest can't matter
+                    rid = event.recurrence_id
+                    if in_window(event) or (rid < expand_until and
+                                            (window_start is None or rid > window_start - timedelta(days=1))):
+                        overrides[(event.uid, rid)] = event
+                    continue
+
+            if not in_window(event):
+                stats["outside_window"] += 1
+                continue
+            stats["yielded"] += 1
+            yield event
+        elif not depth:
+            if name in ("EXDATE", "RDATE"):
+                props.setdefault(name, []).append((value, params))
+            elif name not in props:
+                props[name] = (value, params) if name in ("DTSTART", "DTEND", "RECURRENCE-ID") else (value,)
+
+    for event in occurrences(series, overrides, window_start, expand_until, stats):
+        stats["yielded"] += 1
+        yield event
+
+
+def occurrences(series, overrides, window_start=None, window_end=None, stats=None):
+    # Occurrences of the recurring masters in `series` that overlap [window_start, window_end),
+    # then the overrides ({ (uid, original start): Event }) none of them claimed: their
+    # series is unknown or their original start lies past window_end
+    if stats is None:
+        stats = {}
+    for master in series:
+        for event in expand(master, window_start, window_end, overrides, stats):
+            stats["occurrences"] = stats.get("occurrences", 0) + 1
+            yield event
+    for event in overrides.values():
+        if (window_start is None or event.end > window_start) and (window_end is None or event.start < window_end):
+            yield event
+
+
+def _wall(dt, master):
+    # dt as a naive wall time in the master's zone (system local time if floating)
+    return (dt.astimezone() if master.floating else dt.astimezone(master.start.tzinfo)).replace(tzinfo=None)
+
+
+def expand(master, window_start, window_end, overrides=None, stats=None):
+    # Lazily yields the occurrences of a recurring event that overlap
+    # [window_start, window_end), in start order. Overridden instances come from
+    # `overrides` ({ (uid, original start): Event }, matches are removed from it).
+    if stats is None:
+        stats = {}
+    duration = master.end - master.start
+    dtstart = _wall(master.start, master)
+    # Occurrences starting before this can't reach the window (a day of slack for DST)
+    scan_from = _wall(window_start - duration, master) - timedelta(days=1) if window_start is not None else None
+    rules = rruleset()
+    rules.rdate(dtstart)  # DTSTART is always the first occurrence
+    if master.rrule:
+        # UNTIL is passed as wall time like DTSTART: dateutil rejects a UTC UNTIL on
+        # a naive DTSTART, and an all-day UNTIL includes that whole day
+        parts = []
+        for part in master.rrule.split(";"):
+            name, _, value = part.partition("=")
+            if name.upper() == "UNTIL":
+                until, all_day, _ = parse_datetime(value, {})
+                if all_day:
+                    until += timedelta(days=1, seconds=-1)
+                part = f"UNTIL={_wall(until, master):%Y%m%dT%H%M%S}"
+            if part:
+                parts.append(part)
+        try:
+            rules.rrule(rrulestr(";".join(parts), dtstart=_fast_forward(parts, dtstart, scan_from)))
+        except (ValueError, TypeError):
+            stats["invalid_rrule"] = stats.get("invalid_rrule", 0) + 1  # DTSTART/RDATEs still count
+    for dt in master.rdates:
+        rules.rdate(_wall(dt, master))
+    for dt in master.exdates:
+        rules.exdate(_wall(dt, master))
+
+    walls = rules.xafter(scan_from, inc=True) if scan_from is not None else iter(rules)
+    for scanned, wall in enumerate(walls):
+        if scanned >= MAX_SCANNED:
+            stats["capped_series"] = stats.get("capped_series", 0) + 1
+            log.warning(f"⚠ Recurring event '{master.summary}' stopped after {MAX_SCANNED} occurrences "
+                        f"from {wall:%Y-%m-%d %H:%M}; later ones are not uploaded")
+            return
+        start = wall.astimezone() if master.floating else wall.replace(tzinfo=master.start.tzinfo)
+        if window_end is not None and start >= window_end:
+            return
+        key = occurrence_key(master.summary, wall, master.all_day)
+        override = overrides.pop((master.uid, start), None) if overrides else None
+        if override is not None:
+            override.key = occurrence_key(override.summary, wall, master.all_day)
+            occurrence = override
+        else:
+            occurrence = Event(master.uid, master.summary, start, start + duration, master.all_day,
+                               master.floating, key, recurrence_id=start)
+        if window_start is None or occurrence.end > window_start:
+            if window_end is None or occurrence.start < window_end:
+                yield occurrence
+
+
+def _fast_forward(parts, dtstart, scan_from):
+    # DTSTART for the rule moved forward by whole intervals to just before scan_from;
+    # a rule with COUNT or another frequency keeps its own
+    rule = dict(part.partition("=")[::2] for part in parts)
+    rule = {name.upper(): value.upper() for name, value in rule.items()}
+    period = _PERIODS.get(rule.get("FREQ"))
+    if scan_from is None or period is None or "COUNT" in rule or scan_from <= dtstart:
+        return dtstart
+    try:
+        step = period * max(int(rule.get("INTERVAL", "1")), 1)
+    except ValueError:
+        return dtstart
+    return dtstart + step * ((scan_from - dtstart) // step)
+
+
+# ---------------- ThingsBoard shared attributes ----------------
+
+def attribute_key(summary):
+    # Event title → shared attribute key (the uploaders' old rule, plus ',' which
+    # would split a multi-key DELETE)
+    return summary.replace(" ", "_").replace(".", "-").replace("$", "-").replace(",", "-")
+
+
+def occurrence_key(summary, original_start, all_day=False):
+    # Stable key of one occurrence: title + its original start in the series' wall time
+    stamp = f"{original_start:%Y%m%d}" if all_day else f"{original_start:%Y%m%d-%H%M}"
+    return f"{attribute_key(summary)}_{stamp}"
+
+
+def attribute_value(start, end):
+    # The "Start:/End:" value the gateways parse, in local time
+    return f"Start: {start.astimezone():%Y-%m-%d %H:%M}\nEnd: {end.astimezone():%Y-%m-%d %H:%M}"
+
+
+def window(days_ahead, days_back=0.0, now=None):
+    # (window_start, window_end) around now as aware datetimes
+    now = now or datetime.now(timezone.utc)
+    return now - timedelta(days=days_back), now + timedelta(days=days_ahead)
+
+
+def events_payload(source, window_start=None, window_end=None, stats=None, horizon_end=None):
+    # { attribute key: "Start: ...\nEnd: ..." } for the events of an .ics file in the window,
+    # recurring ones as their occurrences up to horizon_end
+    payload = {}
+    for event in iter_events(source, window_start, window_end, stats, horizon_end):
+        if event.summary:
+            payload[event.key] = attribute_value(event.start, event.end)
+    return payload
@@ -1,9 +1,14 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from tkinterdnd2 import TkinterDnD, DND_FILES
-from ics import Calendar
 import requests
 import json
+import os
+from datetime import datetime, timedelta, timezone
+from tb_client import ThingsBoardClient
+from calendar_sync import AttributeSync
+from ics_stream import HORIZON, events_payload, window
+from upload_jobs import UploadJobs
 
 # --- Configuration ---
 # The URL of your ThingsBoard instance.
@@ -15,124 +20,88 @@ THINGSBOARD_URL = "http://demo.thingsboard.io"
 # Replace these placeholder values with your actual credentials and device ID.
 TB_USERNAME = "youareaverygoodpersontrustme@gmail.com" # Use your actual ThingsBoard username
 TB_PASSWORD = "Thingsboard" # Use your actual ThingsBoard password
-TB_DEVICE_ID = "8aa29b50-658a-11f0-83dd-65e1b21422bc" # Use the UUID of your ThingsBoard device
+TB_DEVICE_IDS = ["8aa29b50-658a-11f0-83dd-65e1b21422bc"] # UUIDs of the ThingsBoard devices every calendar is uploaded to
+TOKEN_CACHE_FILE = "tb_token_cache.json" # JWT cache shared with the other scripts
+UPLOAD_WINDOW_DAYS = 365 # Only events that haven't ended and start within this many days are uploaded
+RESYNC_INTERVAL_MS = 5 * 60 * 1000 # Recurring events: occurrences are uploaded 2 h ahead, re-expanded this often
+SYNC_SNAPSHOT_FILE = "calendar_sync.json" # What each file last uploaded, so only changes are sent
+UPLOAD_WORKERS = 4 # Files read and device uploads run at the same time
+POLL_INTERVAL_MS = 100 # How often the window picks up upload progress
+
+# Shared pooled client: keeps the connections alive between uploads and reuses the cached JWT
+tb = ThingsBoardClient(THINGSBOARD_URL, pool_size=UPLOAD_WORKERS, token_cache=TOKEN_CACHE_FILE)
+
+# Uploads only added/changed events and deletes the ones gone from the file since its last upload
+attribute_sync = AttributeSync(tb, SYNC_SNAPSHOT_FILE)
+
+# Uploads run on worker threads so the window never waits on ThingsBoard; each
+# file is read once and sent to all TB_DEVICE_IDS in parallel
+jobs = UploadJobs(attribute_sync, TB_DEVICE_IDS, workers=UPLOAD_WORKERS,
+                  login=lambda: tb.login(TB_USERNAME, TB_PASSWORD))
 
 
 # --- Core Functions ---
 
-def get_jwt_token(username, password):
+def recurrence_horizon():
     """
-    Logs into ThingsBoard using a username and password to retrieve a JWT token
-    for authorizing subsequent API calls.
+    Recurring events are expanded only this far ahead: the gateways' 2 h look-ahead
+    plus one resync interval, so every occurrence is uploaded before they need it.
     """
-    login_url = f"{THINGSBOARD_URL}/api/auth/login"
-    credentials = {"username": username, "password": password}
-    headers = {"Content-Type": "application/json", "Accept": "application/json"}
-    
-    try:
-        # Send the login request
-        response = requests.post(login_url, json=credentials, headers=headers, timeout=10)
-        # Raise an exception if the login failed (e.g., 401 Unauthorized)
-        response.raise_for_status()  
-        
-        response_data = response.json()
-        token = response_data.get("token")
-        
-        if not token:
-            messagebox.showerror("Login Error", "Failed to get JWT token from the response. Please check your credentials.")
-            return None
-            
-        return token
-        
-    except requests.exceptions.HTTPError as http_err:
-        error_message = f"HTTP Error: {http_err}\nResponse: {response.text}"
-        messagebox.showerror("Login Failed", error_message)
-        return None
-    except requests.exceptions.RequestException as req_err:
-        messagebox.showerror("Connection Error", f"Could not connect to ThingsBoard: {req_err}")
-        return None
-    except json.JSONDecodeError:
-        error_message = f"Failed to parse login response. The server response was not valid JSON:\n{response.text}"
-        messagebox.showerror("Login Error", error_message)
-        return None
-
-
-def upload_ics_to_thingsboard(file_path):
+    return datetime.now(timezone.utc) + HORIZON + timedelta(milliseconds=RESYNC_INTERVAL_MS)
+
+
+def build_payload(file_path, stats=None):
+    """Shared attributes for an .ics file: events in the upload window, recurring ones expanded."""
+    return events_payload(file_path, *window(UPLOAD_WINDOW_DAYS), stats=stats, horizon_end=recurrence_horizon())
+
+
+def sync_source(file_path):
+    """Key under which a file's uploads are tracked."""
+    return f"ics:{os.path.abspath(file_path)}"
+
+
+def file_payload(file_path, stats):
+    """Runs on a worker: the file's payload, or None if it has no events at all."""
+    payload = build_payload(file_path, stats)
+    return payload if stats["events"] else None
+
+
+def error_message(error):
+    """(title, text) describing why a login or upload failed."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = error.response
+        return "HTTP Error", f"Status Code: {response.status_code}\nResponse: {response.text}"
+    if isinstance(error, json.JSONDecodeError):
+        return "Login Error", "Failed to parse login response. The server response was not valid JSON."
+    if isinstance(error, KeyError):
+        return "Login Error", "Failed to get JWT token from the response. Please check your credentials."
+    if isinstance(error, requests.exceptions.RequestException):
+        return "Connection Error", f"Could not connect to ThingsBoard: {error}"
+    return "File Error", f"Failed to read or parse the .ics file:\n{error}"
+
+
+def upload_report(file_path, result):
     """
-    Parses an .ics file and uploads the events as SHARED attributes
-    to a specific device on ThingsBoard using user authentication.
+    One file's line in the summary shown once a batch of uploads is finished.
+    Returns (text, failed).
     """
-    # Ensure all required constant fields are filled
-    if any(val.startswith("YOUR_") for val in [TB_USERNAME, TB_PASSWORD, TB_DEVICE_ID]):
-        messagebox.showerror("Configuration Error", "Please update the placeholder values for username, password, and device ID in the script.")
-        return
-
-    # 1. Authenticate as a user to get the JWT token
-    jwt_token = get_jwt_token(TB_USERNAME, TB_PASSWORD)
-    if not jwt_token:
-        # The error message is already shown by the get_jwt_token function
-        return 
-
-    # 2. Read the .ics file and parse its events
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            cal = Calendar(f.read())
-
-        if not cal.events:
-            messagebox.showinfo("No Events", "The selected .ics file does not contain any events.")
-            return
-
-        # Prepare the payload for ThingsBoard. Each event becomes an attribute.
-        payload = {}
-        for event in cal.events:
-            # Sanitize the event name to be a valid JSON key for the attribute.
-            # Replace characters that might be problematic.
-            title = event.name.replace(" ", "_").replace(".", "-").replace("$", "-")
-            
-            # Ensure start and end times are formatted as strings
-            start_time_str = event.begin.to("local").format("YYYY-MM-DD HH:mm")
-            end_time_str = event.end.to("local").format("YYYY-MM-DD HH:mm")
-            
-            # Construct the value as a multi-line string compatible with the other script
-            # Ensure description and location are not None, use empty string if they are
-            # description = event.description if event.description else ""
-            # location = event.location if event.location else ""
-
-            value = (
-                f"Start: {start_time_str}\n"
-                f"End: {end_time_str}\n"
-                # f"Description: {description}\n"
-                # f"Location: {location}"
-            )
-            payload[title] = value
-
-    except Exception as e:
-        messagebox.showerror("File Error", f"Failed to read or parse the .ics file:\n{e}")
-        return
-
-    # 3. Construct the request and upload attributes to the SHARED_SCOPE
-    # This is the correct endpoint for setting server-side/shared attributes
-    attributes_url = f"{THINGSBOARD_URL}/api/plugins/telemetry/DEVICE/{TB_DEVICE_ID}/SHARED_SCOPE"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Authorization": f"Bearer {jwt_token}" # Use the JWT for authorization
-    }
-
-    try:
-        # Note: We are no longer json.dumps(payload) because the values are already strings.
-        # However, the overall payload still needs to be JSON encoded.
-        response = requests.post(attributes_url, data=json.dumps(payload), headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            messagebox.showinfo("Success", f"Uploaded {len(payload)} events as shared attributes!\nYou may now close this window.")
+    name = os.path.basename(file_path)
+    stats, devices = result["stats"], result["devices"]
+    if not stats["events"]:
+        return f"{name}: the file does not contain any events.", False
+
+    lines = [f"{name}: {result['keys']} events in the next {UPLOAD_WINDOW_DAYS} days"]
+    for device_id, outcome in devices.items():
+        if isinstance(outcome, Exception):
+            title, text = error_message(outcome)
+            lines.append(f"  {device_id}: {title} - {text}")
         else:
-            messagebox.showerror(
-                "Upload Error", 
-                f"Failed to upload attributes.\nStatus Code: {response.status_code}\nResponse: {response.text}"
-            )
-            
-    except requests.exceptions.RequestException as e:
-        messagebox.showerror("Upload Error", f"An error occurred during the upload request:\n{e}")
+            lines.append(f"  {device_id}: {outcome['uploaded']} uploaded, {outcome['unchanged']} unchanged, "
+                         f"{outcome['deleted']} removed")
+    if stats["series"]:
+        lines.append(f"  {stats['series']} recurring event(s) are uploaded occurrence by occurrence, "
+                     f"shortly before they start, while this window stays open.")
+    return "\n".join(lines), any(isinstance(outcome, Exception) for outcome in devices.values())
 
 
 # --- GUI Application Class ---
@@ -142,7 +111,7 @@ class App(TkinterDnD.Tk):
     def __init__(self):
         super().__init__()
         self.title("Upload Calendar to ThingsBoard (Shared Attributes)")
-        self.geometry("550x250")
+        self.geometry("550x290")
         self.resizable(False, False)
         
         # --- Style ---
@@ -159,7 +128,7 @@ class App(TkinterDnD.Tk):
 
         self.drop_label = tk.Label(
             upload_frame, 
-            text="Drag and drop your .ics file here",
+            text="Drag and drop your .ics files here",
             relief="groove", 
             borderwidth=2, 
             font=("Arial", 12),
@@ -171,27 +140,98 @@ class App(TkinterDnD.Tk):
 
         self.browse_button = ttk.Button(
             upload_frame, 
-            text="Select File Manually", 
+            text="Select Files Manually", 
             command=self.browse_file
         )
         self.browse_button.pack(pady=10)
 
+        # Progress of the uploads running in the background
+        self.status_label = ttk.Label(upload_frame, text="", justify="center")
+        self.status_label.pack(fill="x")
+
         # Register the label as a drop target
         self.drop_label.drop_target_register(DND_FILES)
         self.drop_label.dnd_bind('<<Drop>>', self.on_drop)
 
+        # Files with recurring events, re-expanded every RESYNC_INTERVAL_MS
+        self.recurring_files = set()
+        self.after(RESYNC_INTERVAL_MS, self.resync_recurring)
+
+        # Uploads started from the window: { file path: summary line } once finished
+        self.pending = set()
+        self.reports = {}
+        self.failed = False
+        self.after(POLL_INTERVAL_MS, self.poll_uploads)
+
+    def upload(self, file_paths):
+        """Queues files for upload on the worker pool; results arrive in poll_uploads."""
+        # Ensure all required constant fields are filled
+        if any(val.startswith("YOUR_") for val in [TB_USERNAME, TB_PASSWORD, *TB_DEVICE_IDS]):
+            messagebox.showerror("Configuration Error", "Please update the placeholder values for username, password, and device IDs in the script.")
+            return
+
+        for file_path in file_paths:
+            if jobs.submit(("upload", file_path), sync_source(file_path),
+                           lambda stats, path=file_path: file_payload(path, stats)):
+                self.pending.add(file_path)
+        self.status_label.config(text=f"Uploading {len(self.pending)} file(s)...")
+
+    def poll_uploads(self):
+        """Shows the workers' progress; once every queued file is done, one summary."""
+        for kind, (action, file_path), detail in jobs.poll():
+            if action == "resync":
+                if kind == "error":
+                    print(f"Resync of {file_path} failed: {detail}")
+                elif kind == "done":
+                    for device_id, outcome in detail["devices"].items():
+                        if isinstance(outcome, Exception):
+                            print(f"Resync of {file_path} to {device_id} failed: {outcome}")
+                continue
+
+            if kind == "progress":
+                self.status_label.config(text=f"{os.path.basename(file_path)}: {detail}")
+                continue
+            self.pending.discard(file_path)
+            if kind == "error":
+                title, text = error_message(detail)
+                self.reports[file_path] = f"{os.path.basename(file_path)}: {title} - {text}"
+                self.failed = True
+            else:
+                self.reports[file_path], failed = upload_report(file_path, detail)
+                self.failed = self.failed or failed
+                if detail["stats"].get("series"):
+                    self.recurring_files.add(file_path)
+
+        if self.reports and not self.pending:
+            summary = "\n\n".join(self.reports.values())
+            self.status_label.config(text=f"{len(self.reports)} file(s) done.")
+            if self.failed:
+                messagebox.showerror("Upload Error", summary)
+            else:
+                messagebox.showinfo("Success", f"{summary}\n\nYou may now close this window."
+                                    if not self.recurring_files else summary)
+            self.reports, self.failed = {}, False
+        self.after(POLL_INTERVAL_MS, self.poll_uploads)
+
+    def resync_recurring(self):
+        """Uploads the next occurrences of the recurring events in the files dropped so far."""
+        for file_path in self.recurring_files:
+            jobs.submit(("resync", file_path), sync_source(file_path),
+                        lambda stats, path=file_path: build_payload(path, stats))
+        self.after(RESYNC_INTERVAL_MS, self.resync_recurring)
+
     def browse_file(self):
-        """Opens a file dialog to select an .ics file."""
-        file_path = filedialog.askopenfilename(filetypes=[("ICS files", "*.ics")])
-        if file_path:
-            upload_ics_to_thingsboard(file_path)
+        """Opens a file dialog to select one or more .ics files."""
+        file_paths = filedialog.askopenfilenames(filetypes=[("ICS files", "*.ics")])
+        if file_paths:
+            self.upload(file_paths)
 
     def on_drop(self, event):
-        """Handles the file drop event."""
+        """Handles the file drop event; every dropped .ics file is uploaded."""
         # tkinterdnd2 can wrap paths in curly braces, so we use splitlist
-        file_path = self.tk.splitlist(event.data)[0]
-        if file_path.lower().endswith(".ics"):
-            upload_ics_to_thingsboard(file_path)
+        file_paths = [path for path in self.tk.splitlist(event.data) if path.lower().endswith(".ics")]
+        if file_paths:
+            self.upload(file_paths)
         else:
             messagebox.showerror("Invalid File", "Please drop a .ics calendar file.")
 
@@ -0,0 +1,40 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Non-blocking logging for the gateway
+#
+# Log calls only put the record on a bounded in-memory queue (QueueHandler); a
+# QueueListener thread formats and writes them to stdout. A slow console or a
+# burst of per-reading debug lines therefore never stalls the serial loop; if
+# the queue is full the record is dropped and counted instead of blocking.
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level="INFO", max_queue=10000, stream=None, prefix=""):
+    # Routes the root logger through a queue; returns the handler (for .dropped)
+    # and the listener (call .stop() on shutdown to flush). prefix tags every line,
+    # e.g. "[shard 2] " in worker processes.
+    q = queue.Queue(max_queue)
+    handler = DroppingQueueHandler(q)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)-7s {prefix}%(message)s", "%H:%M:%S"))
+    listener = logging.handlers.QueueListener(q, output, respect_handler_level=False)
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    listener.start()
+    return handler, listener
@@ -0,0 +1,215 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# In-process metrics with a Prometheus-style text endpoint
+#
+# Counters, gauges and fixed-bucket histograms, each optionally split by one
+# label (endpoint, message type, ...). Recording is a dict lookup plus an add
+# under a lock, cheap enough for the serial loop. MetricsServer serves
+# everything at http://127.0.0.1:<port>/metrics in the Prometheus text format,
+# so it can be scraped or just read with curl. No extra dependency.
+# Extra local control endpoints (e.g. /profile) can be added with route().
+
+# Seconds; covers sub-ms serial work up to slow HTTP/provisioning calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Metric:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+
+    def _labels(self, value):
+        return f'{{{self.label}="{value}"}}' if self.label and value is not None else ""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, label)
+        self._values = {}
+
+    def inc(self, label=None, amount=1):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def value(self, label=None):
+        return self._values.get(label, 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda kv: str(kv[0]))
+        return [f"{self.name}{self._labels(label)} {value}" for label, value in items]
+
+
+class Gauge(_Metric):
+    """Value read from a callback at scrape time (queue depths and the like)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        super().__init__(name, help)
+        self.read = read
+
+    def render(self):
+        try:
+            return [f"{self.name} {self.read()}"]
+        except Exception:
+            return []
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+        self._series = {}  # { label: [bucket counts..., +Inf], sum }
+
+    def observe(self, value, label=None):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, label=None):
+        return _Timer(self, label)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            items = sorted(((k, (list(v[0]), v[1])) for k, v in self._series.items()), key=lambda kv: str(kv[0]))
+        for label, (counts, total) in items:
+            prefix = f'{self.label}="{label}",' if self.label and label is not None else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{self._labels(label)} {total:.6f}")
+            lines.append(f"{self.name}_count{self._labels(label)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.label)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(name, help, read))
+
+    def histogram(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, label, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves registry.render() at /metrics on a background thread."""
+
+    def __init__(self, registry, port=9108, host="127.0.0.1"):
+        self.registry = registry
+        self.routes = {}  # { path: handler(query dict) → text }; ValueError → 400
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                status = 200
+                if url.path in ("/", "/metrics"):
+                    body = registry.render()
+                elif url.path in routes:
+                    try:
+                        body = routes[url.path]({k: v[0] for k, v in parse_qs(url.query).items()})
+                    except ValueError as e:
+                        status, body = 400, f"{e}\n"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}/metrics"
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+        return self
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ---------------- gateway metrics ----------------
+
+REGISTRY = Registry()
+
+SERIAL_MESSAGES = REGISTRY.counter(
+    "gateway_serial_messages_total", "Decoded serial messages by type", "type")
+TB_REQUEST_SECONDS = REGISTRY.histogram(
+    "gateway_tb_request_seconds", "ThingsBoard request latency by endpoint", "endpoint")
+TB_REQUEST_ERRORS = REGISTRY.counter(
+    "gateway_tb_request_errors_total", "Failed ThingsBoard requests by endpoint", "endpoint")
+POLL_CYCLE_SECONDS = REGISTRY.histogram(
+    "gateway_get_msg_cycle_seconds", "GET_MSG cycle duration, fetch to last downlink write")
+DOWNLINK_LINES = REGISTRY.histogram(
+    "gateway_downlink_lines", "Lines written to the receiver per GET_MSG cycle",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 250))
+PROVISION_SECONDS = REGISTRY.histogram(
+    "gateway_provision_seconds", "Time to create one ThingsBoard device")
+STAGE_SECONDS = REGISTRY.histogram(
+    "gateway_stage_seconds", "Worker step durations while stage timing is on", "stage")
+
+
+def observe_tb_request(endpoint, seconds, status):
+    # ThingsBoardClient.on_request hook
+    TB_REQUEST_SECONDS.observe(seconds, endpoint)
+    if not isinstance(status, int) or status >= 400:
+        TB_REQUEST_ERRORS.inc(endpoint)
@@ -0,0 +1,210 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+# On-demand profiling for the running gateway
+#
+# StageTimers wraps the worker steps (fetch, parse, schedule, write, persist,
+# decode) in `with stages("fetch"):` blocks. While disabled that is one
+# attribute check returning a shared no-op context; while enabled each block is
+# timed into a histogram and into per-capture totals.
+#
+# SamplingProfiler.capture(seconds, path) samples every thread's Python stack
+# (sys._current_frames) every `interval` seconds on a background thread, with
+# stage timing switched on for the duration. The dump has the stage totals, the
+# top functions by self and inclusive samples, and collapsed stacks
+# ("thread;outer;...;inner count") for flamegraph.pl or speedscope. Nothing runs
+# between captures. Sampling is used instead of cProfile because the serial
+# loop, GET_MSG worker and upload threads all matter and cProfile only sees
+# the thread it was enabled in.
+#
+# install_controls() wires the triggers: SIGUSR1, and /profile + /stages on the
+# local metrics endpoint (the only option on Windows).
+
+log = logging.getLogger(__name__)
+
+_IDLE = nullcontext()
+
+
+class StageTimers:
+    """`with stages(name):` timing that is a no-op unless enabled."""
+
+    def __init__(self, observe=None, enabled=False):
+        self.observe = observe  # observe(seconds, stage), e.g. a metrics histogram
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._totals = {}       # { stage: [count, total seconds, max seconds] }
+
+    def __call__(self, name):
+        return _StageTimer(self, name) if self.enabled else _IDLE
+
+    def record(self, name, seconds):
+        if self.observe is not None:
+            self.observe(seconds, name)
+        with self._lock:
+            t = self._totals.get(name)
+            if t is None:
+                t = self._totals[name] = [0, 0.0, 0.0]
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+    def take_totals(self):
+        # Totals since the last call, then reset
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        return totals
+
+
+class _StageTimer:
+    __slots__ = ("timers", "name", "start")
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timers.record(self.name, time.perf_counter() - self.start)
+
+
+class SamplingProfiler:
+    """Samples all threads' stacks for a fixed time and writes a text report."""
+
+    def __init__(self, stages=None, interval=0.005, top=30):
+        self.stages = stages
+        self.interval = interval
+        self.top = top
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def capture(self, seconds, path):
+        # Start a capture in the background; False if one is already running
+        with self._lock:
+            if self.running:
+                return False
+            self._thread = threading.Thread(target=self._run, args=(seconds, path),
+                                            name="profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def _run(self, seconds, path):
+        stages_were_on = self.stages is not None and self.stages.enabled
+        if self.stages is not None:
+            self.stages.take_totals()
+            self.stages.enabled = True
+        log.info(f"🔬 Profiling for {seconds:g}s → {path}")
+
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        try:
+            while time.perf_counter() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    stacks[tuple(reversed(stack))] += 1
+                samples += 1
+                time.sleep(self.interval)
+        finally:
+            elapsed = time.perf_counter() - started
+            totals = {}
+            if self.stages is not None:
+                totals = self.stages.take_totals()
+                self.stages.enabled = stages_were_on
+
+        try:
+            self._write(path, elapsed, samples, stacks, totals)
+            log.info(f"🔬 Profile written to {path} ({samples} samples)")
+        except OSError as e:
+            log.error(f"❌ Could not write profile {path}: {e}")
+
+    def _write(self, path, elapsed, samples, stacks, totals):
+        # Shares are of all thread samples; idle threads show up as their wait call
+        total = max(sum(stacks.values()), 1)
+        own, inclusive, threads = Counter(), Counter(), {}
+        for stack, n in stacks.items():
+            own[stack[-1]] += n
+            for fn in set(stack[1:]):
+                inclusive[fn] += n
+            threads.setdefault(stack[0], Counter())[stack[-1]] += n
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# {elapsed:.1f}s, {samples} samples every {self.interval * 1000:g} ms, "
+                    f"{len(threads)} threads\n\n")
+
+            f.write("## Stages (count, total s, mean ms, max ms)\n")
+            for name, (count, spent, worst) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+                f.write(f"{name:<12} {count:>8} {spent:>9.3f} {spent / count * 1000:>9.2f} {worst * 1000:>9.2f}\n")
+
+            f.write("\n## Threads (samples, most frequent innermost frames)\n")
+            for name, leaves in sorted(threads.items(), key=lambda kv: -sum(kv[1].values())):
+                top = ", ".join(f"{fn} {n / sum(leaves.values()):.0%}" for fn, n in leaves.most_common(3))
+                f.write(f"{name:<32} {sum(leaves.values()):>7}  {top}\n")
+
+            f.write("\n## Top functions by own samples\n")
+            for fn, n in own.most_common(self.top):
+                f.write(f"{n:>8} {n / total:>7.1%}  {fn}\n")
+
+            f.write("\n## Top functions by inclusive samples\n")
+            for fn, n in inclusive.most_common(self.top):
+                f.write(f"{n:>8} {n / total:>7.1%}  {fn}\n")
+
+            f.write("\n## Collapsed stacks\n")
+            for stack, n in stacks.most_common():
+                f.write(f"{';'.join(stack)} {n}\n")
+
+
+def install_controls(profiler, server=None, seconds=30, directory="profiles", prefix="gateway"):
+    # Triggers: SIGUSR1 (POSIX) profiles for `seconds`; with a MetricsServer also
+    #   GET /profile?seconds=N   start a capture
+    #   GET /stages?on=1|0       keep stage timers on/off outside captures
+    def start(duration):
+        path = os.path.join(directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        return path if profiler.capture(duration, path) else None
+
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: start(seconds))
+
+    if server is None:
+        return
+
+    def profile_route(query):
+        duration = float(query.get("seconds", seconds))
+        if not 0 < duration <= 3600:
+            raise ValueError("seconds must be between 0 and 3600")
+        path = start(duration)
+        return f"profiling {duration:g}s → {path}\n" if path else "a profile is already running\n"
+
+    def stages_route(query):
+        if profiler.stages is None:
+            raise ValueError("no stage timers")
+        if "on" in query:
+            profiler.stages.enabled = query["on"].lower() in ("1", "true", "on")
+        return f"stage timers {'on' if profiler.stages.enabled else 'off'}\n"
+
+    server.route("/profile", profile_route).route("/stages", stages_route)
@@ -0,0 +1,93 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Background device provisioning for the blocking gateway loop
+#
+# Creating a ThingsBoard device takes several HTTP round trips (device, credentials,
+# mac_address attribute, dashboard). Instead of running them on the serial ingest
+# thread, the first reading from an unknown MAC is parked here and the MAC is
+# handed to a worker pool; later readings for that MAC join the parked list.
+# Once provision(mac) returns a token, on_ready(mac, token, readings) is called
+# with everything parked so far, in arrival order. After a failed attempt the
+# parked readings are kept and the next reading for that MAC retries.
+
+log = logging.getLogger(__name__)
+
+
+class DeviceProvisioner:
+    """Provisions unknown MACs on a thread pool and parks their readings meanwhile.
+
+    provision(mac) -> token is a blocking callable (get_or_create_device);
+    on_ready(mac, token, readings) receives the parked readings once it succeeds.
+    """
+
+    def __init__(self, provision, on_ready, workers=4, max_parked=1000):
+        self.provision = provision
+        self.on_ready = on_ready
+        self.max_parked = max_parked  # readings kept per MAC; oldest dropped beyond this
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="provision")
+        self._lock = threading.Lock()
+        self._parked = {}        # { mac: [reading, ...] }
+        self._in_flight = set()  # MACs with a provision() call running or queued
+        self.stats = {"provisioned": 0, "errors": 0, "parked": 0, "dropped": 0}
+
+    def submit(self, mac, reading):
+        # Park a reading for a MAC without a token; start provisioning it if idle
+        with self._lock:
+            parked = self._parked.setdefault(mac, [])
+            parked.append(reading)
+            self.stats["parked"] += 1
+            if len(parked) > self.max_parked:
+                del parked[0]
+                self.stats["dropped"] += 1
+            if mac in self._in_flight:
+                return
+            self._in_flight.add(mac)
+        self._pool.submit(self._provision_one, mac)
+
+    def provision_many(self, macs):
+        # Bulk pre-provisioning: create all devices concurrently, wait for them.
+        # Returns { mac: token or the exception that stopped it }.
+        results = {}
+        futures = {}
+        for mac in dict.fromkeys(macs):
+            futures[self._pool.submit(self.provision, mac)] = mac
+        for future in as_completed(futures):
+            mac = futures[future]
+            try:
+                results[mac] = future.result()
+                self.stats["provisioned"] += 1
+            except Exception as e:
+                results[mac] = e
+                self.stats["errors"] += 1
+        return results
+
+    def pending(self):
+        # { mac: number of parked readings } for MACs still waiting on a token
+        with self._lock:
+            return {mac: len(readings) for mac, readings in self._parked.items()}
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    # ---------------- internals ----------------
+
+    def _provision_one(self, mac):
+        try:
+            token = self.provision(mac)
+        except Exception as e:
+            with self._lock:
+                self._in_flight.discard(mac)
+            self.stats["errors"] += 1
+            log.error(f"❌ Provisioning error for MAC {mac}: {e}")
+            return
+
+        with self._lock:
+            readings = self._parked.pop(mac, [])
+            self._in_flight.discard(mac)
+        self.stats["provisioned"] += 1
+        try:
+            self.on_ready(mac, token, readings)
+        except Exception as e:
+            log.error(f"❌ Could not flush parked readings for MAC {mac}: {e}")
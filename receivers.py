@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+
+import serial
+
+from downlink import Downlink
+from serial_protocol import SerialDecoder
+
+# USB receivers attached to one gateway process
+#
+# Each Receiver owns one serial port: a reader thread that reopens the port with
+# backoff whenever it disappears (unplugged, ESP32 reset), its own decoder, its
+# own GET_MSG event and a write lock shared by its GET_MSG cycle and the event
+# dispatcher. A Receiver also acts as the `ser` a Downlink writes to, so a cycle's
+# lines go to whatever port object is current and a write while disconnected
+# fails with SerialException instead of hitting a stale handle.
+#
+# ReceiverRouter remembers which receiver last heard each MAC (its "home"). A
+# device's downlink goes to its home receiver only; devices not heard since the
+# start are served by every receiver until they are. With a single receiver
+# that is every device, as before.
+
+log = logging.getLogger(__name__)
+
+
+def parse_ports(value):
+    # "COM7,COM8" or ["COM7", "COM8"] → list of port names
+    if isinstance(value, str):
+        value = value.split(",")
+    return [port.strip() for port in value if port.strip()]
+
+
+class Receiver:
+    """One serial-attached receiver with its own reader, GET_MSG event and write lock."""
+
+    def __init__(self, port, baud=115200, name=None, timeout=1,
+                 reconnect_delay=1.0, max_reconnect_delay=30.0, open_port=serial.Serial):
+        self.port = port
+        self.baud = baud
+        self.name = name or os.path.basename(port)
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.open_port = open_port
+
+        self.ser = None
+        self.lock = threading.Lock()           # one writer at a time on this port
+        self.get_msg_event = threading.Event()
+        self.connected = threading.Event()
+        self.decoder = SerialDecoder()
+        self.stats = {"connects": 0, "disconnects": 0, "open_failures": 0}
+        self._stop = threading.Event()
+
+    def __repr__(self):
+        return f"Receiver({self.name!r})"
+
+    # ---------------- writing ----------------
+
+    def write(self, data):
+        ser = self.ser
+        if ser is None:
+            raise serial.SerialException(f"receiver {self.name} is not connected")
+        return ser.write(data)
+
+    def flush(self):
+        ser = self.ser
+        if ser is not None:
+            ser.flush()
+
+    def write_line(self, line):
+        with self.lock:
+            self.write(line.encode())
+
+    def downlink(self, **kwargs):
+        # A Downlink for one GET_MSG cycle on this port
+        return Downlink(self, self.lock, **kwargs)
+
+    # ---------------- reading ----------------
+
+    def open(self):
+        self.ser = self.open_port(self.port, self.baud, timeout=self.timeout)
+        self.stats["connects"] += 1
+        self.connected.set()
+        return self.ser
+
+    def close(self):
+        self._stop.set()
+
+    def read_forever(self, on_data):
+        # Blocking: on_data(self, bytes) for everything read; reconnects on errors
+        delay = self.reconnect_delay
+        while not self._stop.is_set():
+            try:
+                ser = self.open()
+            except (serial.SerialException, OSError) as e:
+                self.stats["open_failures"] += 1
+                log.warning(f"⚠ Receiver {self.name}: cannot open {self.port} ({e}), retrying in {delay:g}s")
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+
+            log.info(f"🔌 Receiver {self.name} connected on {self.port}")
+            delay = self.reconnect_delay
+            try:
+                while not self._stop.is_set():
+                    data = ser.read(ser.in_waiting or 1)
+                    if not data:
+                        continue
+                    try:
+                        on_data(self, data)
+                    except Exception as e:
+                        log.error(f"❌ Receiver {self.name}: {e}")
+            except (serial.SerialException, OSError) as e:
+                self.stats["disconnects"] += 1
+                log.warning(f"⚠ Receiver {self.name} disconnected: {e}")
+            finally:
+                self.connected.clear()
+                with self.lock:
+                    self.ser = None
+                try:
+                    ser.close()
+                except Exception:
+                    pass
+                # A partial line from before the drop can't be completed
+                self.decoder = SerialDecoder()
+
+    def start(self, on_data):
+        threading.Thread(target=self.read_forever, args=(on_data,),
+                         name=f"serial-{self.name}", daemon=True).start()
+        return self
+
+
+class ReceiverRouter:
+    """Tracks each MAC's home receiver (the last one that heard it)."""
+
+    def __init__(self, receivers):
+        self.receivers = list(receivers)
+        self._home = {}  # { mac: Receiver }
+
+    def heard(self, mac, receiver):
+        self._home[mac] = receiver
+
+    def home(self, mac):
+        return self._home.get(mac)
+
+    def serves(self, receiver, mac):
+        # Does `receiver` deliver this device's downlink?
+        home = self._home.get(mac)
+        return home is None or home is receiver
+
+    def targets(self, mac):
+        home = self._home.get(mac)
+        return [home] if home is not None else self.receivers
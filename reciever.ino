@@ -21,6 +21,11 @@
 #define EEPROM_SIZE 256
 #define MSG_ADDR 0
 
+// Serial record format for readings:
+// 1 = one framed line "#1:<len>:<mac>,<id>,<battery>*<CRC16 hex>"
+// 0 = legacy "MAC:" / "ID:" / "Battery:" lines
+#define SERIAL_FRAMED_RECORDS 1
+
 #define SCREEN_WIDTH 128
 #define SCREEN_HEIGHT 64
 #define OLED_RESET -1
@@ -177,6 +182,29 @@ void handleSerialInput() {
   }
 }
 
+// CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF), must match serial_protocol.py
+uint16_t crc16Ccitt(const String &data) {
+  uint16_t crc = 0xFFFF;
+  for (unsigned int i = 0; i < data.length(); i++) {
+    crc ^= (uint16_t)(uint8_t)data.charAt(i) << 8;
+    for (int b = 0; b < 8; b++) crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+void sendReadingRecord(const String &mac, const String &deviceID, const String &battStr) {
+#if SERIAL_FRAMED_RECORDS
+  String payload = mac + "," + deviceID + "," + battStr;
+  char crcHex[5];
+  snprintf(crcHex, sizeof(crcHex), "%04X", crc16Ccitt(payload));
+  Serial.println("#1:" + String(payload.length()) + ":" + payload + "*" + crcHex);
+#else
+  Serial.println("MAC:" + mac);
+  Serial.println("ID:" + deviceID);
+  Serial.println("Battery:" + battStr);
+#endif
+}
+
 void handleLoRa() {
   int packetSize = LoRa.parsePacket();
   if (packetSize) {
@@ -218,9 +246,7 @@ void handleLoRa() {
       String battStr = incoming.substring(indices[6] + 1);
 
       // 🟢 Forward readings to Python over Serial
-      Serial.println("MAC:" + lastMac);
-      Serial.println("ID:" + deviceID);
-      Serial.println("Battery:" + battStr);
+      sendReadingRecord(lastMac, deviceID, battStr);
 
       messages.push_back({ "ID " + deviceID, "Battery " + battStr + "%", millis() });
 
@@ -255,6 +281,8 @@ void sendGetMsgAndStartWindow() {
 }
 
 void setup() {
+  // Room for a whole downlink burst (the PC writes <= 240 bytes at a time)
+  Serial.setRxBufferSize(1024);
   Serial.begin(115200);
 
   if (!display.begin(SSD1306_SWITCHCAPVCC, 0x3C)) while (1);
@@ -273,7 +301,8 @@ void setup() {
 }
 
 void loop() {
-  handleSerialInput();
+  // Drain every buffered downlink line, not just one per loop
+  while (Serial.available()) handleSerialInput();
   handleLoRa();
 
   // 🔄 Request new messages from server every 2 seconds
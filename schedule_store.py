@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+
+# Journaled store for scheduled calendar events
+#
+# State is { mac: { label: {"start": int, "end": int, "sent": bool} } }, the same
+# shape scheduled_events.json always had. Changes are buffered as small records
+# (upsert / sent / remove) and commit() appends them to a JSON-lines journal in
+# one write, so per-cycle disk I/O is proportional to what changed. Once the
+# journal grows past compact_every records the full state is written as an atomic
+# snapshot (temp file + fsync + os.replace) and the journal is truncated.
+# On startup the snapshot is loaded and the journal replayed; a torn last line
+# from a crash mid-append is cut off.
+
+log = logging.getLogger(__name__)
+
+
+class ScheduleStore:
+    """Scheduled events per MAC, persisted as snapshot + append-only journal."""
+
+    def __init__(self, snapshot_path, journal_path=None, compact_every=1000):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or os.path.splitext(snapshot_path)[0] + ".journal"
+        self.compact_every = compact_every
+
+        self._events = {}
+        self._buffer = []        # records not yet written to the journal
+        self._journal_len = 0    # records currently in the journal file
+        self.stats = {"replayed": 0, "appended": 0, "compactions": 0}
+        self._load()
+
+    # ---------------- reads ----------------
+
+    def events(self, mac):
+        # Live view of one MAC's events; change it only through the methods below
+        return self._events.get(mac, {})
+
+    def macs(self):
+        return list(self._events)
+
+    def to_dict(self):
+        return {mac: {label: dict(rec) for label, rec in labels.items()}
+                for mac, labels in self._events.items()}
+
+    # ---------------- writes ----------------
+
+    def upsert(self, mac, label, start, end):
+        # Add an event or update its times; keeps the 'sent' flag of an existing one.
+        # Returns True if anything changed.
+        rec = self._events.get(mac, {}).get(label)
+        if rec is not None and rec["start"] == start and rec["end"] == end:
+            return False
+        self._apply({"op": "upsert", "mac": mac, "label": label, "start": start, "end": end})
+        return True
+
+    def mark_sent(self, mac, label):
+        rec = self._events.get(mac, {}).get(label)
+        if rec is not None and not rec.get("sent", False):
+            self._apply({"op": "sent", "mac": mac, "label": label})
+
+    def remove(self, mac, label):
+        if label in self._events.get(mac, {}):
+            self._apply({"op": "remove", "mac": mac, "label": label})
+
+    def commit(self):
+        # Append everything changed since the last commit in a single write
+        if not self._buffer:
+            return
+        data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in self._buffer)
+        with open(self.journal_path, "a") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_len += len(self._buffer)
+        self.stats["appended"] += len(self._buffer)
+        self._buffer = []
+        if self._journal_len >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        # Atomic snapshot of the full state (buffered changes included), then a fresh journal
+        tmp = f"{self.snapshot_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._events, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        open(self.journal_path, "w").close()
+        self._buffer = []
+        self._journal_len = 0
+        self.stats["compactions"] += 1
+
+    # ---------------- internals ----------------
+
+    def _apply(self, record, journal=True):
+        op, mac, label = record["op"], record["mac"], record["label"]
+        if op == "upsert":
+            bucket = self._events.setdefault(mac, {})
+            rec = bucket.get(label, {"sent": False})
+            rec["start"] = record["start"]
+            rec["end"] = record["end"]
+            bucket[label] = rec
+        elif op == "sent":
+            rec = self._events.get(mac, {}).get(label)
+            if rec is not None:
+                rec["sent"] = True
+        elif op == "remove":
+            bucket = self._events.get(mac)
+            if bucket is not None:
+                bucket.pop(label, None)
+                if not bucket:
+                    del self._events[mac]
+        if journal:
+            self._buffer.append(record)
+
+    def _load(self):
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "r") as f:
+                    self._events = json.load(f)
+            except Exception as e:
+                # Keep the unreadable file for inspection instead of silently starting empty
+                corrupt = f"{self.snapshot_path}.corrupt"
+                os.replace(self.snapshot_path, corrupt)
+                log.warning(f"⚠ Schedule snapshot unreadable ({e}); moved to {corrupt}")
+                self._events = {}
+
+        if not os.path.exists(self.journal_path):
+            return
+        good_end = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if record is None or not line.endswith(b"\n"):
+                    # Torn write at the tail from a crash; everything before it is good
+                    log.warning("⚠ Dropping incomplete schedule journal record")
+                    break
+                self._apply(record, journal=False)
+                good_end += len(line)
+                self._journal_len += 1
+                self.stats["replayed"] += 1
+        if good_end != os.path.getsize(self.journal_path):
+            # Cut the torn tail so new records don't get appended after it
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_end)
@@ -0,0 +1,134 @@
+# Receiver → PC serial protocol
+#
+# Version 1 sends each reading as one framed line:
+#
+#     #1:<len>:<payload>*<crc>\n
+#
+#   <len>      decimal byte length of <payload>
+#   <payload>  <mac>,<id>,<battery>   (the MAC contains ':' but never ',')
+#   <crc>      CRC-16/CCITT-FALSE of <payload>, 4 uppercase hex digits
+#
+# SerialDecoder consumes raw bytes incrementally (any chunking) and yields parsed
+# messages, validating each record in a single pass. It still understands the
+# legacy MAC:/ID:/Battery: triplets, but only pairs them in that order so a lost
+# line drops one reading instead of mis-pairing two.
+
+RECORD_VERSION = 1
+RECORD_PREFIX = b"#1:"
+
+
+def crc16_ccitt(data, crc=0xFFFF):
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+
+def encode_record(mac, device_id, battery):
+    payload = f"{mac},{device_id},{battery}".encode()
+    return b"%s%d:%s*%04X\n" % (RECORD_PREFIX, len(payload), payload, crc16_ccitt(payload))
+
+
+class SerialDecoder:
+    """Incremental decoder for framed records, legacy triplets and GET_MSG.
+
+    feed(data) returns a list of messages:
+      ("get_msg",)
+      ("reading", mac, device_id, battery)
+      ("line", text)    any other line, e.g. receiver debug output
+    """
+
+    def __init__(self, max_line=512):
+        self.max_line = max_line
+        self._buf = bytearray()
+        self._triplet = {}
+        self.stats = {"records": 0, "legacy_readings": 0, "crc_errors": 0,
+                      "malformed": 0, "orphan_lines": 0}
+
+    def feed(self, data):
+        self._buf += data
+        out = []
+        start = 0
+        while True:
+            end = self._buf.find(b"\n", start)
+            if end < 0:
+                break
+            self._line(bytes(self._buf[start:end]).rstrip(b"\r"), out)
+            start = end + 1
+        del self._buf[:start]
+        if len(self._buf) > self.max_line:
+            # No newline in sight: garbage or a desynced stream, resync on the next one
+            self._buf.clear()
+            self.stats["malformed"] += 1
+        return out
+
+    # ---------------- internals ----------------
+
+    def _line(self, raw, out):
+        if raw.startswith(b"#"):
+            reading = self._record(raw)
+            if reading is not None:
+                out.append(reading)
+            return
+
+        line = raw.decode(errors="ignore").strip()
+        if line == "GET_MSG":
+            out.append(("get_msg",))
+        elif line.startswith("MAC:"):
+            self._triplet = {"mac": line[4:].strip()}
+        elif line.startswith("ID:"):
+            if "mac" in self._triplet and "id" not in self._triplet:
+                self._triplet["id"] = line[3:].strip()
+            else:
+                self._orphan()
+        elif line.startswith("Battery:"):
+            if "id" in self._triplet:
+                t = self._triplet
+                self._triplet = {}
+                self.stats["legacy_readings"] += 1
+                out.append(("reading", t["mac"], t["id"], line[8:].strip().replace("%", "")))
+            else:
+                self._orphan()
+        elif line:
+            out.append(("line", line))
+
+    def _orphan(self):
+        self._triplet = {}
+        self.stats["orphan_lines"] += 1
+
+    def _record(self, raw):
+        # "#1:<len>:<payload>*<crc>" → ("reading", ...) or None if invalid
+        if not raw.startswith(RECORD_PREFIX):
+            self.stats["malformed"] += 1
+            return None
+        sep = raw.find(b":", len(RECORD_PREFIX))
+        try:
+            length = int(raw[len(RECORD_PREFIX):sep])
+        except ValueError:
+            self.stats["malformed"] += 1
+            return None
+        body = sep + 1
+        payload = raw[body:body + length]
+        trailer = raw[body + length:]
+        if len(payload) != length or len(trailer) != 5 or trailer[:1] != b"*":
+            self.stats["malformed"] += 1
+            return None
+        try:
+            crc = int(trailer[1:], 16)
+        except ValueError:
+            self.stats["malformed"] += 1
+            return None
+        if crc != crc16_ccitt(payload):
+            self.stats["crc_errors"] += 1
+            return None
+
+        text = payload.decode(errors="ignore")
+        first = text.find(",")
+        last = text.rfind(",")
+        if first < 0 or first == last:
+            self.stats["malformed"] += 1
+            return None
+        self.stats["records"] += 1
+        return ("reading", text[:first], text[first + 1:last], text[last + 1:].replace("%", ""))
@@ -0,0 +1,128 @@
+import os
+import select
+import threading
+import time
+import tty
+
+from serial_protocol import encode_record
+
+# Virtual LoRa receiver on a pseudo-terminal (POSIX only)
+#
+# Opens a pty pair and plays the receiver's side of the serial protocol on the
+# master end: badge readings at a fixed total rate (legacy MAC:/ID:/Battery:
+# triplets, or framed "#1:" records with framed=True) and a GET_MSG every
+# get_msg_interval seconds, like reciever.ino. The gateway opens `port` (the
+# slave end) as if it were the USB serial device.
+#
+# Every reading carries a unique ID, so the load test can match what arrives at
+# ThingsBoard to its write time here. Downlink lines coming back are recorded;
+# a "time:" line ends a GET_MSG cycle (one time sync per cycle), which gives the
+# GET_MSG-to-last-downlink time. Several simulators can feed one multi-receiver
+# gateway; give each its own badge_offset/id_offset so MACs and IDs don't collide.
+
+
+class ReceiverSimulator:
+    """Receiver stand-in on a pty: writes readings + GET_MSG, records downlinks."""
+
+    def __init__(self, badges, rate, get_msg_interval=2.0, framed=False, badge_offset=0, id_offset=0):
+        self.badges = badges
+        self.rate = rate
+        self.get_msg_interval = get_msg_interval
+        self.framed = framed
+        self.badge_offset = badge_offset
+        self.id_offset = id_offset
+
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # no echo / newline translation before the gateway opens it
+        self.port = os.ttyname(self._slave)
+
+        self.sent = {}              # { reading id: monotonic write time }
+        self.write_lag = []         # seconds a write was late vs its schedule (pty full = backpressure)
+        self.downlinks = []         # [(monotonic, line)]
+        self.cycle_times = []       # GET_MSG → "time:" line, seconds
+        self._open_get_msgs = []    # GET_MSG write times not answered yet
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=self._read, name="sim-reader", daemon=True)
+        self._reader.start()
+
+    def mac(self, badge):
+        return f"AA:BB:{badge >> 16 & 0xFF:02X}:{badge >> 8 & 0xFF:02X}:{badge & 0xFF:02X}:01"
+
+    def run(self, duration):
+        # Write readings and GET_MSGs on schedule for `duration` seconds (blocking)
+        interval = 1.0 / self.rate
+        start = time.monotonic()
+        next_get_msg = start
+        seq = 0
+        while True:
+            due = start + seq * interval
+            if due - start >= duration:
+                break
+            if next_get_msg <= due:
+                self._sleep_until(next_get_msg)
+                with self._lock:
+                    self._open_get_msgs.append(time.monotonic())
+                self._write(b"GET_MSG\n")
+                next_get_msg += self.get_msg_interval
+                continue
+
+            self._sleep_until(due)
+            self.write_lag.append(max(0.0, time.monotonic() - due))
+            badge = self.badge_offset + seq % self.badges
+            reading_id = self.id_offset + seq + 1
+            battery = 50 + badge % 50
+            if self.framed:
+                data = encode_record(self.mac(badge), reading_id, battery)
+            else:
+                data = f"MAC:{self.mac(badge)}\nID:{reading_id}\nBattery:{battery}%\n".encode()
+            self.sent[reading_id] = time.monotonic()
+            self._write(data)
+            seq += 1
+
+    def close(self):
+        self._stop.set()
+        self._reader.join(1)
+        for fd in (self.master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    # ---------------- internals ----------------
+
+    @staticmethod
+    def _sleep_until(t):
+        delay = t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.master, view)
+            view = view[written:]
+
+    def _read(self):
+        buf = b""
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                chunk = os.read(self.master, 4096)
+            except OSError:
+                return
+            now = time.monotonic()
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for raw in lines:
+                line = raw.decode(errors="ignore").strip()
+                if not line:
+                    continue
+                with self._lock:
+                    self.downlinks.append((now, line))
+                    if line.startswith("time:") and self._open_get_msgs:
+                        # Coalesced GET_MSGs are all answered by this cycle
+                        self.cycle_times.append(now - self._open_get_msgs[0])
+                        self._open_get_msgs = []
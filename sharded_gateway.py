@@ -0,0 +1,234 @@
+import logging
+import multiprocessing
+import os
+import threading
+import zlib
+from collections.abc import Mapping
+
+from downlink import Downlink
+
+# Process-sharded gateway mode (python tempServer.py --shards N)
+#
+# The front process keeps the serial ports: it reads and decodes every receiver
+# and writes every downlink. Everything per device runs in N worker processes:
+# provisioning, telemetry batching/spooling, the schedule and the shared
+# attribute polling of a GET_MSG cycle. A device always lands on the same
+# worker, shard_of(mac) = crc32(mac) % N, stable across restarts, so each worker
+# owns a fixed slice of the fleet and its own schedule/delete/spool files
+# (shard_path). The device registry and the JWT cache are shared files that are
+# already safe to use from several processes; a worker only ever looks at its own
+# devices in it (ShardView), so its polling, schedule and deletes never touch
+# another worker's, also for devices that were registered before a restart.
+#
+# Readings are handed over in one message per shard and serial read, not one
+# per reading, to keep pickling/IPC small. On GET_MSG the front asks every
+# worker to run its part of the cycle for that receiver, merges the lines they
+# return and writes them as one downlink with one time sync. Due calendar
+# events a worker's dispatcher fires between cycles come back as direct writes.
+
+log = logging.getLogger(__name__)
+
+SHARD_ENV = "GATEWAY_SHARD"
+SHARDS_ENV = "GATEWAY_SHARDS"
+
+
+def shard_of(mac, shards):
+    return zlib.crc32(mac.encode()) % shards
+
+
+def shard_path(path, shard):
+    # scheduled_events.json → scheduled_events.shard2.json (unchanged outside sharded mode)
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+
+class ShardPool:
+    """Front-process side: worker processes addressed by MAC, plus cycle fan-out/fan-in."""
+
+    def __init__(self, shards, target, on_write, cycle_timeout=10.0):
+        # target(inbox, outbox) runs in each worker; GATEWAY_SHARD tells it which one it
+        # is and GATEWAY_SHARDS out of how many
+        self.shards = shards
+        self.on_write = on_write            # on_write(receiver_index, line) for direct writes
+        self.cycle_timeout = cycle_timeout
+        ctx = multiprocessing.get_context("spawn")  # no inherited threads, ports or sockets
+        self.outbox = ctx.Queue()
+        self.inboxes = [ctx.Queue() for _ in range(shards)]
+        self.processes = []
+        for shard, inbox in enumerate(self.inboxes):
+            env = {SHARD_ENV: str(shard), SHARDS_ENV: str(shards)}
+            previous = {name: os.environ.get(name) for name in env}
+            os.environ.update(env)
+            try:
+                process = ctx.Process(target=target, args=(inbox, self.outbox),
+                                      name=f"shard-{shard}", daemon=True)
+                process.start()
+            finally:
+                for name, value in previous.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+            self.processes.append(process)
+
+        self._lock = threading.Lock()
+        self._pending = [[] for _ in range(shards)]   # readings not handed over yet
+        self._cond = threading.Condition()
+        self._replies = {}                            # { cycle id: [lines from each shard] }
+        self._next_cycle = 0
+        self.stats = {"readings": 0, "handoffs": 0, "cycles": 0, "cycle_timeouts": 0}
+        threading.Thread(target=self._collect, name="shard-collector", daemon=True).start()
+
+    def add_reading(self, receiver_index, mac, device_id, battery, ts):
+        with self._lock:
+            self._pending[shard_of(mac, self.shards)].append((receiver_index, mac, device_id, battery, ts))
+            self.stats["readings"] += 1
+
+    def flush(self):
+        # One message per shard for everything added since the last flush
+        with self._lock:
+            batches, self._pending = self._pending, [[] for _ in range(self.shards)]
+        for inbox, batch in zip(self.inboxes, batches):
+            if batch:
+                inbox.put(("readings", batch))
+                self.stats["handoffs"] += 1
+
+    def cycle(self, receiver_index):
+        # Every shard's downlink lines for this receiver's GET_MSG, in shard order
+        self.flush()
+        with self._cond:
+            cycle_id = self._next_cycle
+            self._next_cycle += 1
+            self._replies[cycle_id] = [None] * self.shards
+        for inbox in self.inboxes:
+            inbox.put(("cycle", cycle_id, receiver_index))
+        with self._cond:
+            done = self._cond.wait_for(lambda: None not in self._replies[cycle_id], self.cycle_timeout)
+            replies = self._replies.pop(cycle_id)
+        self.stats["cycles"] += 1
+        if not done:
+            self.stats["cycle_timeouts"] += 1
+            missing = [shard for shard, lines in enumerate(replies) if lines is None]
+            log.warning(f"⚠ GET_MSG cycle went out without shard(s) {missing} (no reply in {self.cycle_timeout:g}s)")
+        return [line for lines in replies if lines for line in lines]
+
+    def alive(self):
+        return sum(process.is_alive() for process in self.processes)
+
+    def close(self, timeout=30):
+        # Workers flush their batchers on the way out
+        self.flush()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def _collect(self):
+        while True:
+            try:
+                msg = self.outbox.get()
+            except (EOFError, OSError):
+                return
+            if msg[0] == "write":
+                _, receiver_index, line = msg
+                try:
+                    self.on_write(receiver_index, line)
+                except Exception as e:
+                    log.error(f"❌ Shard write failed: {e}")
+            elif msg[0] == "cycle":
+                _, cycle_id, shard, lines = msg
+                with self._cond:
+                    if cycle_id in self._replies:  # late replies after a timeout are dropped
+                        self._replies[cycle_id][shard] = lines
+                        self._cond.notify_all()
+
+
+class ShardView(Mapping):
+    """One worker's slice of the shared device registry: the MACs with shard_of(mac) == shard."""
+
+    def __init__(self, registry, shard, shards):
+        self.registry = registry
+        self.shard = shard
+        self.shards = shards
+        self._owned = {}  # { mac: bool }, crc32 once per MAC
+
+    def owns(self, mac):
+        owned = self._owned.get(mac)
+        if owned is None:
+            owned = self._owned[mac] = shard_of(mac, self.shards) == self.shard
+        return owned
+
+    def __getitem__(self, mac):
+        if not self.owns(mac):
+            raise KeyError(mac)
+        return self.registry[mac]
+
+    def __iter__(self):
+        return (mac for mac in self.registry if self.owns(mac))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, mac):
+        return self.owns(mac) and mac in self.registry
+
+    def name(self, mac):
+        return self.registry.name(mac) if self.owns(mac) else None
+
+    def device_id(self, mac):
+        return self.registry.device_id(mac) if self.owns(mac) else None
+
+    def mac_for_token(self, token):
+        mac = self.registry.mac_for_token(token)
+        return mac if mac is not None and self.owns(mac) else None
+
+    def reserve_number(self):
+        return self.registry.reserve_number()
+
+    def add(self, mac, token, device_id, name):
+        self.registry.add(mac, token, device_id, name)
+
+
+class ShardLink:
+    """Worker-side stand-in for a front-process Receiver.
+
+    A GET_MSG cycle's downlink is collected and returned with the cycle reply;
+    direct writes (due events) are forwarded to the front right away.
+    """
+
+    def __init__(self, index, name, outbox):
+        self.index = index
+        self.name = name
+        self.outbox = outbox
+        self._lines = []
+
+    def __repr__(self):
+        return f"ShardLink({self.name!r})"
+
+    def downlink(self, **kwargs):
+        return _CollectedDownlink(self)
+
+    def write_line(self, line):
+        self.outbox.put(("write", self.index, line))
+
+    def reply(self, cycle_id, shard):
+        lines, self._lines = self._lines, []
+        self.outbox.put(("cycle", cycle_id, shard, lines))
+
+
+class _CollectedDownlink(Downlink):
+    # Same add() as a real Downlink; send() hands the lines to the front instead,
+    # which adds the time sync once for all shards
+    def __init__(self, link):
+        super().__init__(ser=None)
+        self.link = link
+
+    def send(self, time_sync=True):
+        lines = [line.decode() for line in self._lines]
+        self.link._lines.extend(lines)
+        self._lines = []
+        return len(lines), None
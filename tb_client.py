@@ -0,0 +1,176 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from token_manager import TokenManager
+
+# Shared ThingsBoard REST client
+#
+# All scripts talk to ThingsBoard through one pooled requests.Session so TCP/TLS
+# connections are kept alive and reused. Every call has a per-endpoint timeout and
+# transient failures (connection errors, 429/502/503/504) are retried a bounded
+# number of times with exponential backoff. POSTs are only retried for telemetry
+# and attribute writes, which just overwrite the same values when repeated;
+# creating a device or dashboard is never retried, since a request ThingsBoard
+# completed before a proxy answered 502/504 would create a second one. Tenant API
+# calls get their JWT from a TokenManager (refreshed before expiry, optionally
+# shared on disk) and are retried once with a new token if ThingsBoard answers 401.
+
+DEFAULT_TIMEOUTS = {
+    # (connect, read) in seconds
+    "login": (5, 10),
+    "device": (5, 10),
+    "credentials": (5, 10),
+    "attributes": (5, 10),
+    "telemetry": (5, 10),
+    "delete": (5, 10),
+    "dashboard": (5, 20),
+    # Long-poll: the read timeout must outlast the server-side wait
+    "updates": (5, 90),
+}
+
+# POSTs under these paths only overwrite telemetry/attribute values and are safe to repeat
+IDEMPOTENT_POST_PATHS = ("/api/v1/", "/api/plugins/telemetry/")
+
+
+class ThingsBoardClient:
+    """Pooled, retrying client for the ThingsBoard REST and device APIs."""
+
+    def __init__(self, host, pool_size=10, retries=3, backoff=0.3, timeouts=None, token_cache=None):
+        self.host = host.rstrip("/")
+        self.token_cache = token_cache  # JSON file shared by processes, or None (memory only)
+        self.auth = None                # TokenManager, set by login()
+        self.on_request = None          # Optional callable(endpoint, seconds, status or error name)
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+
+        def adapter(allowed_methods):
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods=allowed_methods,
+                raise_on_status=False,
+            )
+            return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        # urllib3's idempotent methods (GET, PUT, DELETE, ...) everywhere; POST as well
+        # only under the telemetry/attribute write paths (the longest mounted prefix wins)
+        self.session = requests.Session()
+        default = adapter(Retry.DEFAULT_ALLOWED_METHODS)
+        self.session.mount("http://", default)
+        self.session.mount("https://", default)
+        writes = adapter(None)
+        for prefix in IDEMPOTENT_POST_PATHS:
+            self.session.mount(f"{self.host}{prefix}", writes)
+
+    def close(self):
+        self.session.close()
+
+    # ---------------- plumbing ----------------
+
+    @property
+    def jwt(self):
+        return self.auth.token() if self.auth else None
+
+    def _post_auth(self, path, body):
+        return self._request("POST", path, "login", json=body).json()
+
+    def _send(self, method, path, endpoint, token, headers, kwargs):
+        if token is not None:
+            headers = {**headers, "X-Authorization": f"Bearer {token}"}
+        return self.session.request(method, f"{self.host}{path}", headers=headers,
+                                    timeout=self.timeouts[endpoint], **kwargs)
+
+    def _request(self, method, path, endpoint, auth=False, **kwargs):
+        if self.on_request is None:
+            return self._do_request(method, path, endpoint, auth, kwargs)
+        started = time.perf_counter()
+        try:
+            resp = self._do_request(method, path, endpoint, auth, kwargs)
+        except requests.HTTPError as e:
+            self.on_request(endpoint, time.perf_counter() - started, e.response.status_code)
+            raise
+        except Exception as e:
+            self.on_request(endpoint, time.perf_counter() - started, type(e).__name__)
+            raise
+        self.on_request(endpoint, time.perf_counter() - started, resp.status_code)
+        return resp
+
+    def _do_request(self, method, path, endpoint, auth, kwargs):
+        headers = kwargs.pop("headers", {})
+        token = None
+        if auth:
+            if self.auth is None:
+                raise RuntimeError("login() must be called before tenant API requests")
+            token = self.auth.token()
+        resp = self._send(method, path, endpoint, token, headers, kwargs)
+        if auth and resp.status_code == 401:
+            # Expired or revoked JWT: re-authenticate and retry once
+            token = self.auth.invalidate(token)
+            resp = self._send(method, path, endpoint, token, headers, kwargs)
+        resp.raise_for_status()
+        return resp
+
+    # ---------------- tenant API (JWT) ----------------
+
+    def login(self, username, password):
+        # Reuses a cached/refreshable JWT when there is one; logs in only if needed
+        if self.auth is None or (self.auth.username, self.auth.password) != (username, password):
+            self.auth = TokenManager(self._post_auth, self.host, username, password,
+                                     cache_path=self.token_cache)
+        return self.auth.login()
+
+    def create_device(self, name):
+        resp = self._request("POST", "/api/device", "device", auth=True, json={"name": name})
+        return resp.json()["id"]["id"]
+
+    def get_device_token(self, device_id):
+        resp = self._request("GET", f"/api/device/{device_id}/credentials", "credentials", auth=True)
+        return resp.json()["credentialsId"]
+
+    def create_dashboard(self, dashboard):
+        resp = self._request("POST", "/api/dashboard", "dashboard", auth=True, json=dashboard)
+        return resp.json()["id"]["id"]
+
+    def assign_dashboard(self, dashboard_id, device_id):
+        self._request("POST", f"/api/dashboard/{dashboard_id}/assignToEntity?entityId={device_id}",
+                      "dashboard", auth=True)
+
+    def save_shared_attributes(self, device_id, attributes):
+        self._request("POST", f"/api/plugins/telemetry/DEVICE/{device_id}/SHARED_SCOPE",
+                      "attributes", auth=True, json=attributes)
+
+    def delete_shared_attributes(self, device_id, keys):
+        if isinstance(keys, str):
+            keys = [keys]
+        self._request("DELETE", f"/api/plugins/telemetry/DEVICE/{device_id}/SHARED_SCOPE",
+                      "delete", auth=True, params={"keys": ",".join(keys)})
+
+    # ---------------- device API (access token) ----------------
+
+    def get_attributes(self, token, client_keys="", shared_keys=""):
+        resp = self._request("GET", f"/api/v1/{token}/attributes", "attributes",
+                             params={"clientKeys": client_keys, "sharedKeys": shared_keys})
+        return resp.json()
+
+    def wait_attribute_updates(self, token, timeout=30):
+        # Long-poll for shared attribute changes. Returns {} when nothing changed
+        # within `timeout` seconds (ThingsBoard answers 408 in that case).
+        resp = self.session.get(f"{self.host}/api/v1/{token}/attributes/updates",
+                                params={"timeout": int(timeout * 1000)},
+                                timeout=self.timeouts["updates"])
+        if resp.status_code == 408 or not resp.content:
+            return {}
+        resp.raise_for_status()
+        return resp.json()
+
+    def post_attributes(self, token, attributes):
+        self._request("POST", f"/api/v1/{token}/attributes", "attributes", json=attributes)
+
+    def post_telemetry(self, token, payload):
+        # payload: {"key": value} or {"ts": ms, "values": {...}} or a list of those
+        self._request("POST", f"/api/v1/{token}/telemetry", "telemetry", json=payload)
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from collections import deque
+
+# Batched, timestamped telemetry uploads
+#
+# Readings are buffered per device token as ThingsBoard timeseries records
+# ([{"ts": <ms>, "values": {...}}, ...]) stamped with the time they arrived over
+# serial. A background thread posts a token's buffer as one request once it holds
+# max_batch readings or its oldest reading is max_age seconds old, and close()
+# flushes whatever is left on shutdown. Records of a failed post are passed to
+# on_failure(token, records) (e.g. TelemetrySpool.put) instead of being dropped.
+
+log = logging.getLogger(__name__)
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class TelemetryBatcher:
+    """Buffers readings per token and posts them in batches via post_batch(token, records)."""
+
+    def __init__(self, post_batch, max_batch=50, max_age=2.0, latency_window=1000, on_failure=None):
+        self.post_batch = post_batch
+        self.on_failure = on_failure
+        self.max_batch = max_batch
+        self.max_age = max_age
+
+        # { token: [(record, added_monotonic), ...] }
+        self._buffers = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._latencies = deque(maxlen=latency_window)
+        self.stats = {
+            "readings": 0,
+            "batches": 0,
+            "posted": 0,
+            "failed": 0,
+            "handed_off": 0,
+            "size_flushes": 0,
+            "age_flushes": 0,
+            "shutdown_flushes": 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name="telemetry-batcher", daemon=True)
+        self._thread.start()
+
+    def add(self, token, values, ts=None):
+        # ts defaults to now, i.e. the moment the reading came in over serial
+        record = {"ts": ts if ts is not None else now_ms(), "values": values}
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("TelemetryBatcher is closed")
+            buf = self._buffers.setdefault(token, [])
+            buf.append((record, time.monotonic()))
+            self.stats["readings"] += 1
+            if len(buf) == 1 or len(buf) >= self.max_batch:
+                # New oldest reading (the flusher may be sleeping with no deadline) or a full batch
+                self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return sum(len(buf) for buf in self._buffers.values())
+
+    def latency_percentiles(self, pcts=(50, 95, 99)):
+        # Seconds from add() to a successful post, over the most recent readings
+        values = sorted(self._latencies)
+        if not values:
+            return {p: None for p in pcts}
+        return {p: values[min(len(values) - 1, int(len(values) * p / 100))] for p in pcts}
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    # ---------------- flusher thread ----------------
+
+    def _take_ready(self):
+        # Returns [(token, entries, reason)] for every buffer that should go out now
+        ready = []
+        now = time.monotonic()
+        for token, buf in list(self._buffers.items()):
+            if not buf:
+                continue
+            if self._closed:
+                reason = "shutdown_flushes"
+            elif len(buf) >= self.max_batch:
+                reason = "size_flushes"
+            elif now - buf[0][1] >= self.max_age:
+                reason = "age_flushes"
+            else:
+                continue
+            ready.append((token, buf[:self.max_batch], reason))
+            del buf[:self.max_batch]
+            if not buf:
+                del self._buffers[token]
+        return ready
+
+    def _next_deadline(self):
+        oldest = [buf[0][1] for buf in self._buffers.values() if buf]
+        if not oldest:
+            return None
+        return max(0.0, min(oldest) + self.max_age - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                ready = self._take_ready()
+                while not ready and not self._closed:
+                    self._cond.wait(self._next_deadline())
+                    ready = self._take_ready()
+                if not ready and self._closed and not self._buffers:
+                    return
+
+            for token, entries, reason in ready:
+                self._post(token, entries, reason)
+
+    def _post(self, token, entries, reason):
+        records = [record for record, _ in entries]
+        try:
+            self.post_batch(token, records)
+        except Exception as e:
+            self.stats["failed"] += len(records)
+            log.error(f"❌ Telemetry batch of {len(records)} failed for token {token}: {e}")
+            if self.on_failure is not None:
+                try:
+                    self.on_failure(token, records)
+                    self.stats["handed_off"] += len(records)
+                except Exception as spool_error:
+                    log.error(f"❌ Could not keep failed telemetry for token {token}: {spool_error}")
+            return
+        done = time.monotonic()
+        self._latencies.extend(done - added for _, added in entries)
+        self.stats["batches"] += 1
+        self.stats["posted"] += len(records)
+        self.stats[reason] += 1
@@ -0,0 +1,204 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Store-and-forward buffer for telemetry ThingsBoard didn't accept
+#
+# When a batch post fails (outage, timeout, 5xx after retries) the batcher hands
+# its records here instead of dropping them. They go into a SQLite table with
+# their original timestamps; the file is bounded at max_records, dropping the
+# oldest readings first once full. A replay thread drains the table in batches of
+# up to replay_batch records per token, oldest-first within a token and taking
+# the tokens in turn, so one device ThingsBoard keeps refusing can't hold back the
+# others. Rows are deleted only after ThingsBoard accepted them. It pauses
+# replay_gap seconds between batches so live uploads keep most of the connection
+# pool, and backs off exponentially while ThingsBoard is still failing.
+#
+# A batch rejected with a 4xx other than 408/429 (a deleted device's token, a
+# payload ThingsBoard will never take) is not retried: it moves to the
+# dead_letter table, also bounded at max_records, and counts as dead_lettered.
+
+log = logging.getLogger(__name__)
+
+
+def permanent_failure(error):
+    # True for HTTP errors a retry can't fix: 4xx except 408 Request Timeout and 429 Too Many Requests
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+class TelemetrySpool:
+    """Bounded on-disk queue of timeseries records, replayed via post_batch(token, records)."""
+
+    def __init__(self, path, post_batch, max_records=1_000_000, replay_batch=500,
+                 replay_gap=0.2, retry_delay=5, max_retry_delay=300):
+        self.path = path
+        self.post_batch = post_batch
+        self.max_records = max_records
+        self.replay_batch = replay_batch
+        self.replay_gap = replay_gap
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS telemetry (
+                id     INTEGER PRIMARY KEY AUTOINCREMENT,
+                token  TEXT NOT NULL,
+                record TEXT NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS telemetry_token ON telemetry (token, id)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letter (
+                id     INTEGER PRIMARY KEY AUTOINCREMENT,
+                token  TEXT NOT NULL,
+                record TEXT NOT NULL,
+                status INTEGER
+            )""")
+        self._depth = self._conn.execute("SELECT COUNT(*) FROM telemetry").fetchone()[0]
+        self._dead = self._conn.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+        self._last_token = ""  # replay takes the next token after this one
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stop = threading.Event()  # wakes the pause between batches only on close()
+        self._replayed_at = deque()  # (monotonic, n) for the replay rate
+        self.stats = {"spooled": 0, "replayed": 0, "dropped": 0, "replay_failures": 0, "dead_lettered": 0}
+
+        self._thread = threading.Thread(target=self._run, name="telemetry-spool", daemon=True)
+        self._thread.start()
+        if self._depth:
+            log.info(f"💾 {self._depth} spooled reading(s) from a previous run will be replayed")
+
+    def put(self, token, records):
+        # Store records a post failed for; oldest readings are dropped once full
+        rows = [(token, json.dumps(record, separators=(",", ":"))) for record in records]
+        with self._cond:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT INTO telemetry (token, record) VALUES (?, ?)", rows)
+                overflow = self._depth + len(rows) - self.max_records
+                if overflow > 0:
+                    self._conn.execute(
+                        "DELETE FROM telemetry WHERE id IN (SELECT id FROM telemetry ORDER BY id LIMIT ?)",
+                        (overflow,))
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            if overflow > 0:
+                self.stats["dropped"] += overflow
+            self._depth += len(rows) - max(overflow, 0)
+            self.stats["spooled"] += len(rows)
+            self._cond.notify()
+
+    def depth(self):
+        return self._depth
+
+    def dead_letters(self):
+        return self._dead
+
+    def replay_rate(self, window=60.0):
+        # Records replayed per second over the last `window` seconds
+        cutoff = time.monotonic() - window
+        with self._cond:
+            return sum(n for t, n in self._replayed_at if t >= cutoff) / window
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._stop.set()
+        self._thread.join(timeout)
+        self._conn.close()
+
+    # ---------------- replay thread ----------------
+
+    def _next_batch(self):
+        # The next token's oldest records, up to replay_batch of them: ([row ids], token, [records])
+        with self._cond:
+            token = self._conn.execute("SELECT MIN(token) FROM telemetry WHERE token > ?",
+                                       (self._last_token,)).fetchone()[0]
+            if token is None:
+                token = self._conn.execute("SELECT MIN(token) FROM telemetry").fetchone()[0]
+            if token is None:
+                return None
+            self._last_token = token
+            rows = self._conn.execute(
+                "SELECT id, record FROM telemetry WHERE token = ? ORDER BY id LIMIT ?",
+                (token, self.replay_batch)).fetchall()
+        return [r[0] for r in rows], token, [json.loads(r[1]) for r in rows]
+
+    def _delete(self, ids):
+        with self._cond:
+            cur = self._conn.executemany("DELETE FROM telemetry WHERE id = ?", [(i,) for i in ids])
+            # Some rows may already have been dropped as overflow in the meantime
+            self._depth -= cur.rowcount
+            now = time.monotonic()
+            self._replayed_at.append((now, len(ids)))
+            while self._replayed_at and self._replayed_at[0][0] < now - 300:
+                self._replayed_at.popleft()
+        self.stats["replayed"] += len(ids)
+
+    def _dead_letter(self, ids, status):
+        # Move rows ThingsBoard refused for good out of the replay queue
+        marks = ",".join("?" * len(ids))
+        with self._cond:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                moved = self._conn.execute(
+                    f"INSERT INTO dead_letter (token, record, status) "
+                    f"SELECT token, record, ? FROM telemetry WHERE id IN ({marks}) ORDER BY id",
+                    (status, *ids)).rowcount
+                self._conn.execute(f"DELETE FROM telemetry WHERE id IN ({marks})", ids)
+                overflow = self._dead + moved - self.max_records
+                if overflow > 0:
+                    self._conn.execute(
+                        "DELETE FROM dead_letter WHERE id IN (SELECT id FROM dead_letter ORDER BY id LIMIT ?)",
+                        (overflow,))
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._depth -= moved
+            self._dead += moved - max(overflow, 0)
+        self.stats["dead_lettered"] += moved
+        return moved
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            with self._cond:
+                while not self._depth and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+            batch = self._next_batch()
+            if batch is None:
+                continue
+            ids, token, records = batch
+            try:
+                self.post_batch(token, records)
+            except Exception as e:
+                if permanent_failure(e):
+                    moved = self._dead_letter(ids, e.response.status_code)
+                    log.error(f"❌ ThingsBoard refused {moved} spooled reading(s) "
+                              f"({e.response.status_code}), moved to dead_letter: {e}")
+                    self._stop.wait(self.replay_gap)
+                    continue
+                self.stats["replay_failures"] += 1
+                log.warning(f"⚠ Spool replay failed ({self._depth} queued), retrying in {delay}s: {e}")
+                wait, delay = delay, min(delay * 2, self.max_retry_delay)
+            else:
+                self._delete(ids)
+                delay = self.retry_delay
+                log.info(f"↻ Replayed {len(ids)} spooled reading(s), {self._depth} left "
+                         f"({self.replay_rate():.0f}/s)")
+                wait = self.replay_gap
+
+            self._stop.wait(wait)
@@ -1,102 +1,186 @@
 import threading
-import serial, json, requests, os, time
+import logging
+import serial, os, sys, time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from tb_client import ThingsBoardClient
+from attribute_mirror import AttributeMirror
+from delete_queue import SharedDeleteQueue
+from schedule_store import ScheduleStore
+from event_scheduler import EventScheduler
+from change_tracker import ChangeTracker, next_calendar_recheck
+from functools import lru_cache
+import math
+from telemetry_batcher import TelemetryBatcher, now_ms
+from telemetry_spool import TelemetrySpool
+from provisioner import DeviceProvisioner
+from device_registry import DeviceRegistry
+from receivers import Receiver, ReceiverRouter, parse_ports
+from sharded_gateway import SHARD_ENV, SHARDS_ENV, ShardLink, ShardView, shard_of, shard_path
+from log_setup import setup_logging
+import metrics
+from profiler import SamplingProfiler, StageTimers, install_controls
 from datetime import datetime, timedelta
 
-SERIAL_PORT = "COM7"
+# One entry per USB receiver (e.g. one per floor). SERIAL_PORTS="COM7,COM8" (or a single
+# SERIAL_PORT) and TB_HOST can be overridden from the environment (used by bench_load.py)
+SERIAL_PORTS = parse_ports(os.environ.get("SERIAL_PORTS") or os.environ.get("SERIAL_PORT") or ["COM7"])
 BAUD = 115200
-TB_HOST = "http://demo.thingsboard.io"
+RECONNECT_DELAY = 1.0       # First retry after a receiver disappears (s), doubles per failure
+MAX_RECONNECT_DELAY = 30.0
+TB_HOST = os.environ.get("TB_HOST", "http://demo.thingsboard.io")
 TB_USER = "youareaverygoodpersontrustme@gmail.com"
 TB_PASS = "Thingsboard"
 UUID = "8aa29b50-658a-11f0-83dd-65e1b21422bc"  # Tenant device UUID (for delete calls)
-JWT = None
-
-MAP_FILE = "device_mac_token_map.json"
-SCHEDULE_FILE = "scheduled_events.json"
-
-ser = None  # Global serial object
-get_msg_event = threading.Event()
+TB_POOL_SIZE = 10  # Keep-alive connections shared by all worker threads
+POLL_WORKERS = 8   # Concurrent shared-attribute fetches per GET_MSG cycle (≤ TB_POOL_SIZE)
+
+# Attribute mirror (python tempServer.py --mirror): long-poll shared attributes in
+# the background and answer GET_MSG from memory
+MIRROR_POOL_SIZE = 64         # One long-poll connection per device
+MIRROR_POLL_TIMEOUT = 30      # Seconds ThingsBoard holds each long-poll open
+MIRROR_RESYNC_INTERVAL = 300  # Full refetch per device as a fallback (s)
+MIRROR_MAX_STALENESS = 120    # Older than this → fetch over HTTP instead (s)
+
+REGISTRY_FILE = "devices.db"                   # MAC → token / device id / display name (SQLite)
+LEGACY_MAP_FILE = "device_mac_token_map.json"  # Imported into the registry on first start
+LEGACY_COUNTER_FILE = "device_counter.txt"
+SCHEDULE_FILE = "scheduled_events.json"        # Snapshot; changes go to scheduled_events.journal
+SCHEDULE_COMPACT_EVERY = 1000                  # Journal records before a new snapshot
+PARSE_CACHE_SIZE = 4096                        # Parsed calendar values kept, keyed by raw string
+PENDING_DELETES_FILE = "pending_deletes.json"
+TOKEN_CACHE_FILE = "tb_token_cache.json"       # JWT + refresh token, shared with the uploaders
+
+# Telemetry batching: flush a device's buffer at this many readings or this age (s)
+TELEMETRY_BATCH_SIZE = 50
+TELEMETRY_BATCH_MAX_AGE = 2.0
+
+# Store-and-forward: failed telemetry is kept on disk and replayed once ThingsBoard is back
+SPOOL_FILE = "telemetry_spool.db"
+SPOOL_MAX_RECORDS = 1_000_000  # Oldest readings are dropped beyond this
+SPOOL_REPLAY_BATCH = 500       # Records per replayed request
+SPOOL_REPLAY_GAP = 0.2         # Pause between replayed requests (s), leaves room for live uploads
+
+# New devices are created on this many background threads; their readings wait in memory
+PROVISION_WORKERS = 4
+
+# Sharded mode (python tempServer.py --shards N): devices are split over N worker processes by
+# hash of MAC. Workers get GATEWAY_SHARD=k, GATEWAY_SHARDS=N and their own schedule,
+# pending-delete and spool files; the registry and token cache are shared, but each worker
+# only sees its own MACs in them. Worker k serves metrics on METRICS_PORT+1+k.
+SHARD = os.environ.get(SHARD_ENV)
+SHARDS = os.environ.get(SHARDS_ENV)
+SHARD_CYCLE_TIMEOUT = 10  # A GET_MSG cycle goes out without shards that haven't answered (s)
+
+# Observability: Prometheus-style metrics on http://127.0.0.1:METRICS_PORT/metrics (0 = off)
+# and the log level (DEBUG adds one line per reading / GET_MSG)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# Profiling: `kill -USR1 <pid>` or GET /profile?seconds=N on the metrics port samples every
+# thread and writes PROFILE_DIR/gateway-<time>.txt; PROFILE_STAGES=1 keeps stage timers on
+PROFILE_SECONDS = 30
+PROFILE_DIR = "profiles"
+PROFILE_STAGES = os.environ.get("PROFILE_STAGES") == "1"
+
+# Downlink: bytes per serial write (below the receiver's RX buffer) and pause between writes (s)
+DOWNLINK_CHUNK = 240
+DOWNLINK_CHUNK_GAP = 0.0
+
+log = logging.getLogger("gateway")
+
+# Each receiver has its own reader thread, GET_MSG event and write lock; downlink for a
+# device goes to the receiver that last heard it
+receivers = [Receiver(port, BAUD, reconnect_delay=RECONNECT_DELAY, max_reconnect_delay=MAX_RECONNECT_DELAY)
+             for port in SERIAL_PORTS]
+router = ReceiverRouter(receivers)
+
+tb = ThingsBoardClient(TB_HOST, pool_size=TB_POOL_SIZE, token_cache=TOKEN_CACHE_FILE)
+tb.on_request = metrics.observe_tb_request
+
+# Per-step timers (fetch, parse, schedule, write, persist, decode); no-ops unless enabled
+stages = StageTimers(metrics.STAGE_SECONDS.observe, enabled=PROFILE_STAGES)
+profiler = SamplingProfiler(stages)
+attribute_mirror = None  # AttributeMirror when running with --mirror
 
 # ---------------- Auth / device mapping ----------------
 
 def login():
-    global JWT
-    resp = requests.post(f"{TB_HOST}/api/auth/login",
-                         json={"username": TB_USER, "password": TB_PASS})
-    resp.raise_for_status()
-    JWT = resp.json()["token"]
-
-def load_map():
-    if os.path.exists(MAP_FILE):
-        with open(MAP_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_map(mac_token_map):
-    with open(MAP_FILE, "w") as f:
-        json.dump(mac_token_map, f, indent=2)
+    # Reuses a cached JWT if one is still valid; refreshed automatically afterwards
+    tb.login(TB_USER, TB_PASS)
+    stats = tb.auth.stats
+    log.info(f"🔑 ThingsBoard auth ready ({stats['logins']} login(s), {stats['logins_avoided']} avoided)")
 
-# --------------- schedule persistence ------------------
+def load_registry():
+    return DeviceRegistry(REGISTRY_FILE, LEGACY_MAP_FILE, LEGACY_COUNTER_FILE)
 
-def load_schedule():
-    if os.path.exists(SCHEDULE_FILE):
-        with open(SCHEDULE_FILE, "r") as f:
-            try:
-                return json.load(f)
-            except Exception:
-                return {}
-    return {}
-
-def save_schedule(scheduled_events):
-    with open(SCHEDULE_FILE, "w") as f:
-        json.dump(scheduled_events, f, indent=2)
+# --------------- schedule persistence ------------------
 
-# In-memory schedule: { mac: { label: {"start": int, "end": int, "sent": bool} } }
-scheduled_events = load_schedule()
+# In-memory schedule: { mac: { label: {"start": int, "end": int, "sent": bool} } },
+# persisted as an atomic snapshot plus an append-only journal of changes
+scheduled_events = ScheduleStore(shard_path(SCHEDULE_FILE, SHARD), compact_every=SCHEDULE_COMPACT_EVERY)
+
+def write_to_receivers(mac, line, skip=None):
+    # Direct write to the device's home receiver (all receivers until it has been heard).
+    # Raises only if no receiver took it; the event dispatcher then leaves the event
+    # unsent and tries again EventScheduler.RETRY_DELAY seconds later.
+    error = None
+    delivered = False
+    for receiver in router.targets(mac):
+        if receiver is skip:
+            continue
+        try:
+            receiver.write_line(line)
+            delivered = True
+        except serial.SerialException as e:
+            error = e
+    if error is not None and not delivered:
+        raise error
+
+def calendar_line(label, rec):
+    return f"calendar:{label}:Start={rec['start']}:End={rec['end']}\n"
+
+def send_due_event(mac, label, rec):
+    # Called by the event dispatcher when an event's start time arrives
+    msg = calendar_line(label, rec)
+    write_to_receivers(mac, msg)
+    log.info(f"📅 Sent DUE event: {msg.strip()}")
+
+# Start/end time index over the schedule; dispatches events at their start time
+event_scheduler = EventScheduler(scheduled_events, on_start=send_due_event)
+event_scheduler.track_all()
 
 # ---------------- ThingsBoard helpers ------------------
 
-def get_or_create_device(mac, mac_token_map):
-    if mac in mac_token_map:
-        return mac_token_map[mac]
+def get_or_create_device(mac, registry):
+    if mac in registry:
+        return registry[mac]
 
-    hdr = {"X-Authorization": f"Bearer {JWT}"}
+    started = time.perf_counter()
 
-    # Generate display name like lora_1, lora_2...
-    counter_file = "device_counter.txt"
-    if os.path.exists(counter_file):
-        with open(counter_file, "r") as f:
-            counter = int(f.read().strip())
-    else:
-        counter = 1
-
-    device_name = f"lora_{counter}"
+    # Reserve a display name like lora_1, lora_2... (provisioning workers run concurrently)
+    device_name = f"lora_{registry.reserve_number()}"
 
     # Create the device
-    resp = requests.post(f"{TB_HOST}/api/device", headers=hdr, json={"name": device_name})
-    resp.raise_for_status()
-    dev_id = resp.json()["id"]["id"]
-
-    # Save counter
-    with open(counter_file, "w") as f:
-        f.write(str(counter + 1))
+    dev_id = tb.create_device(device_name)
 
-    # Store MAC → token mapping
-    token_resp = requests.get(f"{TB_HOST}/api/device/{dev_id}/credentials", headers=hdr)
-    token_resp.raise_for_status()
-    token = token_resp.json()["credentialsId"]
-    mac_token_map[mac] = token
-    save_map(mac_token_map)
+    # Store MAC → token / device id / name in one transaction
+    token = tb.get_device_token(dev_id)
+    registry.add(mac, token, dev_id, device_name)
 
     # Optional attribute
-    requests.post(f"{TB_HOST}/api/v1/{token}/attributes", json={"mac_address": mac})
+    try:
+        tb.post_attributes(token, {"mac_address": mac})
+    except Exception as e:
+        log.warning(f"⚠ Could not set mac_address attribute for {device_name}: {e}")
 
     # Optional dashboard creation
     create_dashboard(dev_id, device_name)
 
+    metrics.PROVISION_SECONDS.observe(time.perf_counter() - started)
     return token
 
 def create_dashboard(device_id, device_name):
-    hdr = {"X-Authorization": f"Bearer {JWT}", "Content-Type": "application/json"}
     db = {
         "title": f"Dashboard {device_name}",
         "configuration": {
@@ -106,24 +190,42 @@ def create_dashboard(device_id, device_name):
         "assignToCustomer": False
     }
     try:
-        resp = requests.post(f"{TB_HOST}/api/dashboard", headers=hdr, json=db)
-        resp.raise_for_status()
-        did = resp.json()["id"]["id"]
-        requests.post(f"{TB_HOST}/api/dashboard/{did}/assignToEntity?entityId={device_id}", headers=hdr)
+        did = tb.create_dashboard(db)
+        tb.assign_dashboard(did, device_id)
     except Exception:
         # Non-fatal if dashboard creation fails
         pass
 
-def send_telemetry(token, data_value, battery_value):
-    payload = {"data": data_value, "battery": float(battery_value)}
-    requests.post(f"{TB_HOST}/api/v1/{token}/telemetry", json=payload)
+def send_telemetry_batch(token, records):
+    # records: [{"ts": <ms>, "values": {...}}, ...] → one request for the whole batch
+    tb.post_telemetry(token, records)
+
+def discard_from_mirror(mac, keys):
+    if attribute_mirror is not None:
+        attribute_mirror.discard(mac, keys)
+
+# Shared-scope deletes are queued during the cycle and sent in batches afterwards
+delete_queue = SharedDeleteQueue(tb.delete_shared_attributes, path=shard_path(PENDING_DELETES_FILE, SHARD),
+                                 on_deleted=discard_from_mirror,
+                                 owns=(lambda mac: shard_of(mac, int(SHARDS)) == int(SHARD)) if SHARD else None)
 
 # --------------- one-time TB message filter ------------
 
+# Skips shared attributes that haven't changed since they were last processed
+change_tracker = ChangeTracker()
+
+def report_cache_stats():
+    parse = parse_calendar_value.cache_info()
+    st = change_tracker.stats
+    log.debug(f"🧮 Change cache: devices {st['device_hits']} hit/{st['device_misses']} miss, "
+          f"keys {st['key_hits']} hit/{st['key_misses']} miss; "
+          f"parse cache {parse.hits} hit/{parse.misses} miss ({parse.currsize}/{parse.maxsize})")
+
 def is_calendar_value(value: str) -> bool:
     # Expecting "Start:YYYY-MM-DD HH:MM\nEnd:YYYY-MM-DD HH:MM"
     return isinstance(value, str) and value.startswith("Start:") and "\nEnd:" in value
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
 def parse_calendar_value(value: str):
     # Returns (start_ts, end_ts)
     start = value.split("\n")[0].split("Start:")[1].strip()
@@ -134,156 +236,517 @@ def parse_calendar_value(value: str):
 
 # ----------------- GET_MSG worker thread ---------------
 
-def check_for_extra_fields(mac_token_map):
-    global ser, scheduled_events
-    while True:
-        # Wait for ESP32 request
-        get_msg_event.wait()
-        get_msg_event.clear()
+poll_pool = ThreadPoolExecutor(POLL_WORKERS, thread_name_prefix="tb-poll")
+
+def fetch_all_shared(registry, receiver=None):
+    # Fan the per-device GETs out over the pool; results come back in map order
+    # so the serial writes that follow stay deterministic. Devices with a fresh
+    # attribute mirror entry are answered from memory. With a receiver, only the
+    # devices it delivers to are fetched.
+    pending = []
+    for mac, token in list(registry.items()):
+        if receiver is not None and not router.serves(receiver, mac):
+            continue
+        mirrored = None
+        if attribute_mirror is not None:
+            mirrored = attribute_mirror.get(mac, max_staleness=MIRROR_MAX_STALENESS)
+        if mirrored is not None:
+            pending.append((mac, mirrored))
+        else:
+            pending.append((mac, poll_pool.submit(tb.get_attributes, token)))
+
+    results = []
+    for mac, item in pending:
+        if isinstance(item, dict):
+            results.append((mac, item, None))
+            continue
+        try:
+            results.append((mac, item.result().get("shared", {}), None))
+        except Exception as e:
+            results.append((mac, None, e))
+    return results
+
+def start_attribute_mirror(registry):
+    global attribute_mirror
+    mirror_tb = ThingsBoardClient(TB_HOST, pool_size=MIRROR_POOL_SIZE)
+    attribute_mirror = AttributeMirror(mirror_tb, registry,
+                                       poll_timeout=MIRROR_POLL_TIMEOUT,
+                                       resync_interval=MIRROR_RESYNC_INTERVAL)
+    attribute_mirror.start()
+
+def mirror_staleness():
+    # (worst-case seconds since a device's mirror was confirmed, devices never synced)
+    ages = [age for age in attribute_mirror.staleness().values() if age is not None]
+    return (max(ages) if ages else 0.0), len(attribute_mirror.mac_token_map) - len(ages)
+
+def report_mirror_staleness():
+    worst, missing = mirror_staleness()
+    if missing < len(attribute_mirror.mac_token_map):
+        log.debug(f"🪞 Mirror staleness: max {worst:.1f}s, {missing} device(s) not synced yet")
+    else:
+        log.debug(f"🪞 Mirror not synced yet for {missing} device(s)")
+
+def run_poll_cycle(registry, receiver):
+    # One GET_MSG cycle of one receiver: refresh schedule from TB and push due items over serial
+    global scheduled_events
+    cycle_started = time.perf_counter()
+    now_dt = datetime.now()
+    now_ts = int(now_dt.timestamp())
+    horizon_ts = now_ts + 2 * 3600
+
+    # 1) Fetch shared attributes from TB for every device at once
+    with stages("fetch"):
+        if attribute_mirror is not None:
+            report_mirror_staleness()
+        fetched = fetch_all_shared(registry, receiver)
+
+    # Everything for the receiver this cycle goes out in one buffered write at the end
+    downlink = receiver.downlink(max_chunk=DOWNLINK_CHUNK, chunk_gap=DOWNLINK_CHUNK_GAP)
+
+    def queue_due_event(mac, label, rec):
+        # Due events of devices on other receivers are written to those directly; if
+        # none of them takes it, the error reaches the dispatcher, which retries it
+        msg = calendar_line(label, rec)
+        if not router.serves(receiver, mac):
+            write_to_receivers(mac, msg)
+            return
+        downlink.add(msg)
+        log.debug(f"📅 Queued DUE event: {msg.strip()}")
+        try:
+            # Not heard yet: the other receivers get it too
+            write_to_receivers(mac, msg, skip=receiver)
+        except serial.SerialException as e:
+            log.warning(f"⚠ DUE event for MAC {mac} only queued on {receiver.name}: {e}")
+
+    # The dispatcher thread shares the schedule; keep it out while we update it
+    with event_scheduler.lock:
+        with stages("parse"):
+            for mac, shared, error in fetched:
+                if error is not None:
+                    log.error(f"❌ Polling error for MAC {mac}: {error}")
+                    continue
+                try:
+                    # 2) Update local schedule with only events in next 2 hours. Only keys
+                    #    that are new, edited or have a start/end boundary due are processed.
+                    items = []
+                    if not change_tracker.device_unchanged(mac, shared, now_ts):
+                        items = change_tracker.changed_items(mac, shared, now_ts)
+                    for key, value in items:
+                        recheck_at = math.inf  # When this key's handling can next change
+                        try:
+                            lower = key.lower()
+                            if lower in {"battery", "id", "mac_address", "data"}:
+                                continue
 
-        now_dt = datetime.now()
-        now_ts = int(now_dt.timestamp())
-        horizon_ts = now_ts + 2 * 3600
+                            # Already handled, TB just hasn't confirmed the delete yet
+                            if delete_queue.is_pending(mac, key):
+                                recheck_at = None  # look again until the delete lands
+                                continue
 
-        for mac, token in mac_token_map.items():
+                            if is_calendar_value(value):
+                                try:
+                                    start_ts, end_ts = parse_calendar_value(value)
+                                    recheck_at = next_calendar_recheck(start_ts, end_ts, now_ts)
+
+                                    # Delete expired events from TB
+                                    if end_ts < now_ts:
+                                        recheck_at = math.inf
+                                        delete_queue.enqueue(UUID, key, mac)
+                                        log.info(f"🗑 Queued expired TB event '{key}' for deletion")
+                                        # Also drop from local schedule if present
+                                        scheduled_events.remove(mac, key)
+                                        continue
+
+                                    # Keep only within next 2 hours in local schedule
+                                    if now_ts <= start_ts <= horizon_ts:
+                                        # Update times in case edited in TB; doesn't reset 'sent'
+                                        if scheduled_events.upsert(mac, key, start_ts, end_ts):
+                                            event_scheduler.track(mac, key, start_ts, end_ts)
+                                    else:
+                                        # Not within the next two hours → drop from local schedule if exists
+                                        scheduled_events.remove(mac, key)
+
+                                except Exception as e:
+                                    log.warning(f"⚠ Calendar parse error for key '{key}': {e}")
+
+                            elif isinstance(value, str):
+                                # One-time plain message: send now and delete key in TB
+                                dev_name = registry.name(mac)
+                                line = f"{dev_name}:{value}\n"
+                                downlink.add(line)
+                                log.info(f"📡 Queued one-time msg: {line.strip()}")
+
+                                # Goes out this cycle: never send it again, delete it after the writes
+                                delete_queue.enqueue(UUID, key, mac)
+                                discard_from_mirror(mac, [key])
+                        finally:
+                            if recheck_at is not None:
+                                change_tracker.mark(mac, key, value, recheck_at)
+                    change_tracker.finish_device(mac)
+
+                except Exception as e:
+                    log.error(f"❌ Polling error for MAC {mac}: {e}")
+                    change_tracker.forget(mac)
+
+        # 3) Queue due events (start ≤ now ≤ end) not sent yet and drop ended ones
+        with stages("schedule"):
+            event_scheduler.dispatch_due(now_ts, on_start=queue_due_event, commit=False)
+
+        # ...and persist only what changed this cycle to the schedule journal
+        with stages("persist"):
+            scheduled_events.commit()
+
+    # 4) One buffered write of the cycle's lines, ending with a single time sync
+    #    stamped right before it goes out
+    with stages("write"):
+        try:
+            lines, synced_ts = downlink.send()
+            log.debug(f"⏰ Synced time {synced_ts} with ESP32 ({lines} downlink line(s))")
+            metrics.DOWNLINK_LINES.observe(lines)
+        except serial.SerialException as e:
+            log.error(f"❌ Downlink write to {receiver.name} failed: {e}")
+    metrics.POLL_CYCLE_SECONDS.observe(time.perf_counter() - cycle_started)
+
+    # 5) Downlink writes are done: send the queued deletes in batches
+    with stages("persist"):
+        delete_queue.flush()
+
+    report_cache_stats()
+
+def check_for_extra_fields(registry, receiver):
+    while True:
+        # Wait for this receiver's request
+        receiver.get_msg_event.wait()
+        receiver.get_msg_event.clear()
+        run_poll_cycle(registry, receiver)
+
+# ------------------ asyncio gateway mode ---------------
+
+def run_async_gateway(registry, batcher, receiver):
+    from async_gateway import AsyncGateway
+
+    def upload(mac, token, device_id, battery, ts):
+        batcher.add(token, {"data": float(device_id), "battery": float(battery)}, ts)
+        log.debug("✅ Queued data=%s, battery=%s%% for MAC %s", device_id, battery, mac)
+
+    gateway = AsyncGateway(
+        receiver.ser,
+        registry,
+        provision=lambda mac: get_or_create_device(mac, registry),
+        upload=upload,
+        poll_cycle=lambda: run_poll_cycle(registry, receiver),
+        provision_workers=PROVISION_WORKERS,
+    )
+    asyncio.run(gateway.run())
+
+# ------------------- device provisioning ---------------
+
+def make_provisioner(registry, batcher):
+    def flush_parked(mac, token, readings):
+        for values, ts in readings:
+            batcher.add(token, values, ts)
+        log.info(f"✅ Provisioned MAC {mac}, queued {len(readings)} parked reading(s)")
+
+    return DeviceProvisioner(lambda mac: get_or_create_device(mac, registry),
+                             flush_parked, workers=PROVISION_WORKERS)
+
+def read_mac_list(path):
+    # One MAC per line ('-' = stdin); blank lines and '#' comments are skipped
+    f = sys.stdin if path == "-" else open(path, "r")
+    try:
+        return [line.split("#")[0].strip() for line in f if line.split("#")[0].strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def preprovision(registry, path):
+    # python tempServer.py --provision macs.txt → create all listed devices up front
+    macs = [mac for mac in read_mac_list(path) if mac not in registry]
+    print(f"🛠 Provisioning {len(macs)} new device(s) with {PROVISION_WORKERS} workers...")
+    provisioner = DeviceProvisioner(lambda mac: get_or_create_device(mac, registry),
+                                    on_ready=None, workers=PROVISION_WORKERS)
+    started = time.time()
+    try:
+        results = provisioner.provision_many(macs)
+    finally:
+        provisioner.close()
+    failed = {mac: e for mac, e in results.items() if isinstance(e, Exception)}
+    for mac, e in failed.items():
+        print(f"❌ {mac}: {e}")
+    print(f"✅ {len(results) - len(failed)} provisioned, {len(failed)} failed "
+          f"in {time.time() - started:.1f}s")
+    return not failed
+
+# ---------------------- serial input -------------------
+
+def serial_handler(on_reading, after=None):
+    # Builds the on_data callback run on each receiver's reader thread: decodes framed
+    # "#1:" records and legacy MAC:/ID:/Battery: lines (any chunking), wakes that
+    # receiver's GET_MSG worker and passes readings to on_reading(receiver, mac, id, battery)
+    def on_serial_data(receiver, data):
+        with stages("decode"):
+            messages = receiver.decoder.feed(data)
+
+        for msg in messages:
+            metrics.SERIAL_MESSAGES.inc(msg[0])
             try:
-                # Ensure schedule bucket for this mac
-                scheduled_events.setdefault(mac, {})
-
-                # 1) Fetch shared attributes from TB
-                url = f"{TB_HOST}/api/v1/{token}/attributes?clientKeys=&sharedKeys="
-                response = requests.get(url)
-                response.raise_for_status()
-                data = response.json()
-                shared = data.get("shared", {})
-
-                # 2) Update local schedule with only events in next 2 hours
-                for key, value in list(shared.items()):
-                    lower = key.lower()
-                    if lower in {"battery", "id", "mac_address", "data"}:
-                        continue
-
-                    if is_calendar_value(value):
-                        try:
-                            start_ts, end_ts = parse_calendar_value(value)
-
-                            # Delete expired events from TB
-                            if end_ts < now_ts:
-                                del_url = f"{TB_HOST}/api/plugins/telemetry/DEVICE/{UUID}/SHARED_SCOPE?keys={key}"
-                                headers = {"X-Authorization": f"Bearer {JWT}"}
-                                requests.delete(del_url, headers=headers)
-                                print(f"🗑 Deleted expired TB event '{key}'")
-                                # Also drop from local schedule if present
-                                scheduled_events[mac].pop(key, None)
-                                continue
+                # Trigger this receiver's worker on GET_MSG
+                if msg[0] == "get_msg":
+                    log.debug("🔄 Received GET_MSG from %s → update schedule & send due events", receiver.name)
+                    receiver.get_msg_event.set()
+                    continue
+
+                if msg[0] != "reading":
+                    continue  # Ignore unrelated lines
 
-                            # Keep only within next 2 hours in local schedule
-                            if now_ts <= start_ts <= horizon_ts:
-                                rec = scheduled_events[mac].get(key, {"start": start_ts, "end": end_ts, "sent": False})
-                                # Update times in case edited in TB
-                                rec["start"] = start_ts
-                                rec["end"] = end_ts
-                                # Don't reset 'sent' if already sent
-                                scheduled_events[mac][key] = rec
-                            else:
-                                # Not within the next two hours → drop from local schedule if exists
-                                if key in scheduled_events[mac]:
-                                    scheduled_events[mac].pop(key, None)
-
-                        except Exception as e:
-                            print(f"⚠ Calendar parse error for key '{key}': {e}")
-
-                    elif isinstance(value, str):
-                        # One-time plain message: send now and delete key in TB
-                        dev_number = list(mac_token_map.keys()).index(mac) + 1
-                        dev_name = f"lora_{dev_number}"
-                        line = f"{dev_name}:{value}\n"
-                        ser.write(line.encode())
-                        print(f"📡 Sent one-time msg: {line.strip()}")
-
-                        del_url = f"{TB_HOST}/api/plugins/telemetry/DEVICE/{UUID}/SHARED_SCOPE?keys={key}"
-                        headers = {"X-Authorization": f"Bearer {JWT}"}
-                        requests.delete(del_url, headers=headers)
-                        print(f"🗑 Deleted TB key '{key}' after sending")
-
-                # 3) Now send ONLY due events (start ≤ now ≤ end) that haven't been sent yet
-                due_labels = []
-                for label, rec in list(scheduled_events[mac].items()):
-                    start_ts = rec["start"]
-                    end_ts = rec["end"]
-                    sent = rec.get("sent", False)
-
-                    # Clean up expired locals
-                    if end_ts < now_ts:
-                        scheduled_events[mac].pop(label, None)
-                        continue
-
-                    # Send when it's time (edge inclusive at start)
-                    if (start_ts <= now_ts <= end_ts) and not sent:
-                        msg = f"calendar:{label}:Start={start_ts}:End={end_ts}\n"
-                        ser.write(msg.encode())
-                        print(f"📅 Sent DUE event: {msg.strip()}")
-                        rec["sent"] = True
-                        due_labels.append(label)
-
-                # (Optional) If you want to re-notify on every GET_MSG while active window, comment out the 'sent' flag logic above.
-
-                # 4) Persist schedule to disk
-                save_schedule(scheduled_events)
-
-                # 5) Sync time at the end
-                ser.write(f"time:{now_ts}\n".encode())
-                print(f"⏰ Synced time {now_ts} with ESP32")
+                _, mac, device_id, battery = msg
+                on_reading(receiver, mac, device_id, battery)
 
             except Exception as e:
-                print(f"❌ Polling error for MAC {mac}: {e}")
+                log.error("❌ Error: %s", e)
 
-# --------------------------- main ----------------------
+        if after is not None:
+            after()
 
-if __name__ == "__main__":
+    return on_serial_data
+
+# ------------------- sharded gateway mode ---------------
+
+def run_shard_worker(inbox, outbox):
+    # Entry point of one --shards worker process (GATEWAY_SHARD is set, so the schedule,
+    # pending deletes and spool below are this shard's own files)
+    global router
+    shard = int(SHARD)
+    _, log_listener = setup_logging(LOG_LEVEL, prefix=f"[shard {shard}] ")
     login()
-    mac_token_map = load_map()
+    # Only this worker's devices: after a restart the shared registry holds every shard's
+    registry = ShardView(load_registry(), shard, int(SHARDS))
+
+    # Downlink goes back to the front process, which owns the serial ports
+    links = [ShardLink(i, r.name, outbox) for i, r in enumerate(receivers)]
+    router = ReceiverRouter(links)
+    event_scheduler.start()
+
+    spool = TelemetrySpool(shard_path(SPOOL_FILE, shard), send_telemetry_batch, SPOOL_MAX_RECORDS,
+                           SPOOL_REPLAY_BATCH, SPOOL_REPLAY_GAP)
+    batcher = TelemetryBatcher(send_telemetry_batch, TELEMETRY_BATCH_SIZE, TELEMETRY_BATCH_MAX_AGE,
+                               on_failure=spool.put)
+    provisioner = make_provisioner(registry, batcher)
+    start_metrics(
+        METRICS_PORT and METRICS_PORT + 1 + shard,
+        telemetry_pending=batcher.pending,
+        spool_depth=spool.depth,
+        spool_dead_letters=spool.dead_letters,
+        delete_queue_depth=delete_queue.depth,
+        provision_parked=lambda: sum(provisioner.pending().values()),
+    )
 
-    with serial.Serial(SERIAL_PORT, BAUD, timeout=1) as s:
-        ser = s  # Assign to global
+    try:
+        while True:
+            msg = inbox.get()
+            if msg is None:
+                break
+            if msg[0] == "readings":
+                # (receiver index, mac, id, battery, serial receipt time in ms)
+                for receiver_index, mac, device_id, battery, ts in msg[1]:
+                    try:
+                        router.heard(mac, links[receiver_index])
+                        values = {"data": float(device_id), "battery": float(battery)}
+                        token = registry.get(mac)
+                        if token is None:
+                            provisioner.submit(mac, (values, ts))
+                        else:
+                            batcher.add(token, values, ts)
+                    except Exception as e:
+                        # One bad reading must not take the worker (and its devices) down
+                        log.error("❌ Error: %s", e)
+            elif msg[0] == "cycle":
+                _, cycle_id, receiver_index = msg
+                try:
+                    run_poll_cycle(registry, links[receiver_index])
+                except Exception as e:
+                    log.error(f"❌ GET_MSG cycle error: {e}")
+                finally:
+                    links[receiver_index].reply(cycle_id, shard)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        provisioner.close()
+        batcher.close()
+        spool.close()
+        log_listener.stop()
 
-        # Start background worker
-        threading.Thread(target=check_for_extra_fields, args=(mac_token_map,), daemon=True).start()
+def run_sharded_gateway(shards, log_handler):
+    # Front process: serial ports and downlink writes only; devices live in the workers
+    from sharded_gateway import ShardPool
 
-        buffer = {"mac": None, "id": None, "battery": None}
+    pool = ShardPool(shards, run_shard_worker, cycle_timeout=SHARD_CYCLE_TIMEOUT,
+                     on_write=lambda index, line: receivers[index].write_line(line))
+    index_of = {receiver: i for i, receiver in enumerate(receivers)}
 
-        while True:
-            try:
-                raw = ser.readline()
-                if not raw:
-                    continue
-                line = raw.decode(errors='ignore').strip()
+    def on_reading(receiver, mac, device_id, battery):
+        pool.add_reading(index_of[receiver], mac, device_id, battery, now_ms())
 
-                # Trigger worker on GET_MSG
-                if line == "GET_MSG":
-                    print("🔄 Received GET_MSG → update schedule & send due events")
-                    get_msg_event.set()
-                    continue
+    def cycle_loop(receiver):
+        while True:
+            receiver.get_msg_event.wait()
+            receiver.get_msg_event.clear()
+            started = time.perf_counter()
+            downlink = receiver.downlink(max_chunk=DOWNLINK_CHUNK, chunk_gap=DOWNLINK_CHUNK_GAP)
+            for line in pool.cycle(index_of[receiver]):
+                downlink.add(line)
+            with stages("write"):
+                try:
+                    lines, _ = downlink.send()
+                    metrics.DOWNLINK_LINES.observe(lines)
+                except serial.SerialException as e:
+                    log.error(f"❌ Downlink write to {receiver.name} failed: {e}")
+            metrics.POLL_CYCLE_SECONDS.observe(time.perf_counter() - started)
+
+    start_metrics(
+        shards_alive=pool.alive,
+        receivers_connected=lambda: sum(r.connected.is_set() for r in receivers),
+        serial_decode_errors=lambda: sum(r.decoder.stats["crc_errors"] + r.decoder.stats["malformed"]
+                                         for r in receivers),
+        log_records_dropped=lambda: log_handler.dropped,
+    )
+    if attribute_mirror is not None:
+        common_gauges.update(
+            mirror_max_staleness_seconds=lambda: round(mirror_staleness()[0], 1),
+            mirror_unsynced_devices=lambda: mirror_staleness()[1],
+        )
+
+    # Readings of one serial read go to the workers as one message per shard
+    for receiver in receivers:
+        threading.Thread(target=cycle_loop, args=(receiver,), name=f"get-msg-{receiver.name}",
+                         daemon=True).start()
+        receiver.start(serial_handler(on_reading, after=pool.flush))
+    log.info(f"📻 Serving {len(receivers)} receiver(s) with {shards} worker process(es)")
 
-                # Parse MAC/ID/Battery triplet from ESP32 (then upload to TB)
-                if line.startswith("MAC:"):
-                    buffer["mac"] = line.split("MAC:", 1)[1].strip()
-                elif line.startswith("ID:"):
-                    buffer["id"] = line.split("ID:", 1)[1].strip()
-                elif line.startswith("Battery:"):
-                    buffer["battery"] = line.split("Battery:", 1)[1].strip().replace("%", "")
-                else:
-                    continue  # Ignore unrelated lines
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        for receiver in receivers:
+            receiver.close()
+        pool.close()
+
+# ------------------------ metrics ----------------------
+
+def start_metrics(port=METRICS_PORT, **gauges):
+    # gauges: name → zero-argument callable read at scrape time
+    for name, read in gauges.items():
+        metrics.REGISTRY.gauge(f"gateway_{name}", name.replace("_", " "), read)
+    server = None
+    if port:
+        server = metrics.MetricsServer(metrics.REGISTRY, port).start()
+        log.info(f"📈 Metrics on {server.url}")
+    # SIGUSR1 and /profile, /stages on the metrics port
+    install_controls(profiler, server, PROFILE_SECONDS, PROFILE_DIR)
 
-                if all(buffer.values()):
-                    mac = buffer["mac"]
-                    device_id = buffer["id"]
-                    battery = buffer["battery"]
+# --------------------------- main ----------------------
 
-                    token = get_or_create_device(mac, mac_token_map)
-                    send_telemetry(token, float(device_id), float(battery))
-                    print(f"✅ Uploaded data={device_id}, battery={battery}% for MAC {mac}")
-                    buffer = {"mac": None, "id": None, "battery": None}
+if __name__ == "__main__":
+    # Log calls only enqueue; a listener thread does the console I/O
+    log_handler, log_listener = setup_logging(LOG_LEVEL)
+    login()
+    registry = load_registry()
+
+    if "--provision" in sys.argv:
+        idx = sys.argv.index("--provision")
+        if idx + 1 >= len(sys.argv):
+            sys.exit("usage: python tempServer.py --provision <mac-list-file | ->")
+        sys.exit(0 if preprovision(registry, sys.argv[idx + 1]) else 1)
+
+    # python tempServer.py --shards 4 → per-device work in 4 worker processes
+    if "--shards" in sys.argv:
+        try:
+            run_sharded_gateway(int(sys.argv[sys.argv.index("--shards") + 1]), log_handler)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            log_listener.stop()
+        sys.exit(0)
+
+    # Push calendar events at their start time, not just on the next GET_MSG
+    event_scheduler.start()
+
+    # python tempServer.py --mirror → answer GET_MSG from a long-polled attribute mirror
+    if "--mirror" in sys.argv:
+        start_attribute_mirror(registry)
+
+    spool = TelemetrySpool(shard_path(SPOOL_FILE, SHARD), send_telemetry_batch, SPOOL_MAX_RECORDS,
+                           SPOOL_REPLAY_BATCH, SPOOL_REPLAY_GAP)
+    batcher = TelemetryBatcher(send_telemetry_batch, TELEMETRY_BATCH_SIZE, TELEMETRY_BATCH_MAX_AGE,
+                               on_failure=spool.put)
+
+    common_gauges = dict(
+        telemetry_pending=batcher.pending,
+        spool_depth=spool.depth,
+        spool_dead_letters=spool.dead_letters,
+        spool_replay_rate=spool.replay_rate,
+        delete_queue_depth=delete_queue.depth,
+        receivers_connected=lambda: sum(r.connected.is_set() for r in receivers),
+        log_records_dropped=lambda: log_handler.dropped,
+    )
+    if attribute_mirror is not None:
+        common_gauges.update(
+            mirror_max_staleness_seconds=lambda: round(mirror_staleness()[0], 1),
+            mirror_unsynced_devices=lambda: mirror_staleness()[1],
+        )
+
+    # python tempServer.py --async → serial ingest never waits on ThingsBoard HTTP
+    # (first receiver only, no reconnect)
+    if "--async" in sys.argv:
+        if len(receivers) > 1:
+            log.warning(f"⚠ --async drives only {receivers[0].name}; {len(receivers) - 1} receiver(s) ignored")
+        start_metrics(**common_gauges)
+        try:
+            receivers[0].open()
+            run_async_gateway(registry, batcher, receivers[0])
+        finally:
+            batcher.close()
+            spool.close()
+        sys.exit(0)
+
+    # Unknown MACs are created in the background; their readings wait until the token exists
+    provisioner = make_provisioner(registry, batcher)
+
+    def on_reading(receiver, mac, device_id, battery):
+        # Reading from ESP32 → upload to TB; downlink for this MAC now goes via this receiver
+        router.heard(mac, receiver)
+        values = {"data": float(device_id), "battery": float(battery)}
+        token = registry.get(mac)
+        if token is None:
+            provisioner.submit(mac, (values, now_ms()))
+            log.debug("⏳ Parked data=%s for MAC %s until it is provisioned", device_id, mac)
+            return
+        batcher.add(token, values)
+        log.debug("✅ Queued data=%s, battery=%s%% for MAC %s", device_id, battery, mac)
+
+    start_metrics(
+        serial_decode_errors=lambda: sum(r.decoder.stats["crc_errors"] + r.decoder.stats["malformed"]
+                                         for r in receivers),
+        provision_parked=lambda: sum(provisioner.pending().values()),
+        **common_gauges,
+    )
+
+    # One GET_MSG worker and one reader (reconnecting on its own) per receiver
+    for receiver in receivers:
+        threading.Thread(target=check_for_extra_fields, args=(registry, receiver),
+                         name=f"get-msg-{receiver.name}", daemon=True).start()
+        receiver.start(serial_handler(on_reading))
+    log.info(f"📻 Serving {len(receivers)} receiver(s): {', '.join(r.port for r in receivers)}")
 
-            except Exception as e:
-                print("❌ Error:", e)
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        # Stop reading, finish in-flight provisioning, then flush buffered readings on
+        # shutdown (Ctrl+C); anything ThingsBoard doesn't take stays in the spool for the next start
+        for receiver in receivers:
+            receiver.close()
+        provisioner.close()
+        batcher.close()
+        spool.close()
+        log_listener.stop()
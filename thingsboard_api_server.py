@@ -1,77 +1,115 @@
 import threading
-import serial, json, requests, os, time
+import logging
+import serial, os, time
 from datetime import datetime
-
-SERIAL_PORT = "COM7"
+from concurrent.futures import ThreadPoolExecutor
+from tb_client import ThingsBoardClient
+from delete_queue import SharedDeleteQueue
+from telemetry_batcher import TelemetryBatcher, now_ms
+from telemetry_spool import TelemetrySpool
+from provisioner import DeviceProvisioner
+from device_registry import DeviceRegistry
+from receivers import Receiver, ReceiverRouter, parse_ports
+from log_setup import setup_logging
+import metrics
+from profiler import SamplingProfiler, StageTimers, install_controls
+
+# One entry per USB receiver (e.g. one per floor). SERIAL_PORTS="COM7,COM8" (or a single
+# SERIAL_PORT) and TB_HOST can be overridden from the environment (used by bench_load.py)
+SERIAL_PORTS = parse_ports(os.environ.get("SERIAL_PORTS") or os.environ.get("SERIAL_PORT") or ["COM7"])
 BAUD = 115200
-TB_HOST = "http://demo.thingsboard.io"
+RECONNECT_DELAY = 1.0       # First retry after a receiver disappears (s), doubles per failure
+MAX_RECONNECT_DELAY = 30.0
+TB_HOST = os.environ.get("TB_HOST", "http://demo.thingsboard.io")
 TB_USER = "youareaverygoodpersontrustme@gmail.com"
 TB_PASS = "Thingsboard"
 UUID = "8aa29b50-658a-11f0-83dd-65e1b21422bc" # this is the UUID of the device (device ID)
-JWT = None
-
-MAP_FILE = "device_mac_token_map.json"
-ser = None  # Global serial object
-get_msg_event = threading.Event()
+TB_POOL_SIZE = 10  # Keep-alive connections shared by all worker threads
+POLL_WORKERS = 8   # Concurrent shared-attribute fetches per GET_MSG cycle (≤ TB_POOL_SIZE)
+
+REGISTRY_FILE = "devices.db"                   # MAC → token / device id / display name (SQLite)
+LEGACY_MAP_FILE = "device_mac_token_map.json"  # Imported into the registry on first start
+LEGACY_COUNTER_FILE = "device_counter.txt"
+PENDING_DELETES_FILE = "pending_deletes.json"
+TOKEN_CACHE_FILE = "tb_token_cache.json"       # JWT + refresh token, shared with the uploaders
+
+# Telemetry batching: flush a device's buffer at this many readings or this age (s)
+TELEMETRY_BATCH_SIZE = 50
+TELEMETRY_BATCH_MAX_AGE = 2.0
+
+# Store-and-forward: failed telemetry is kept on disk and replayed once ThingsBoard is back
+SPOOL_FILE = "telemetry_spool.db"
+SPOOL_MAX_RECORDS = 1_000_000  # Oldest readings are dropped beyond this
+SPOOL_REPLAY_BATCH = 500       # Records per replayed request
+SPOOL_REPLAY_GAP = 0.2         # Pause between replayed requests (s), leaves room for live uploads
+
+# New devices are created on this many background threads; their readings wait in memory
+PROVISION_WORKERS = 4
+
+# Observability: Prometheus-style metrics on http://127.0.0.1:METRICS_PORT/metrics (0 = off)
+# and the log level (DEBUG adds one line per reading / GET_MSG)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# Profiling: `kill -USR1 <pid>` or GET /profile?seconds=N on the metrics port samples every
+# thread and writes PROFILE_DIR/gateway-<time>.txt; PROFILE_STAGES=1 keeps stage timers on
+PROFILE_SECONDS = 30
+PROFILE_DIR = "profiles"
+PROFILE_STAGES = os.environ.get("PROFILE_STAGES") == "1"
+
+# Downlink: bytes per serial write (below the receiver's RX buffer) and pause between writes (s)
+DOWNLINK_CHUNK = 240
+DOWNLINK_CHUNK_GAP = 0.0
+
+log = logging.getLogger("gateway")
+
+# Each receiver has its own reader thread, GET_MSG event and write lock; downlink for a
+# device goes to the receiver that last heard it
+receivers = [Receiver(port, BAUD, reconnect_delay=RECONNECT_DELAY, max_reconnect_delay=MAX_RECONNECT_DELAY)
+             for port in SERIAL_PORTS]
+router = ReceiverRouter(receivers)
+
+tb = ThingsBoardClient(TB_HOST, pool_size=TB_POOL_SIZE, token_cache=TOKEN_CACHE_FILE)
+tb.on_request = metrics.observe_tb_request
+
+# Per-step timers (fetch, parse, write, persist, decode); no-ops unless enabled
+stages = StageTimers(metrics.STAGE_SECONDS.observe, enabled=PROFILE_STAGES)
+profiler = SamplingProfiler(stages)
 
 def login():
-    global JWT
-    resp = requests.post(f"{TB_HOST}/api/auth/login", json={"username": TB_USER, "password": TB_PASS})
-    JWT = resp.json()["token"]
-
-def load_map():
-    if os.path.exists(MAP_FILE):
-        with open(MAP_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_map(mac_token_map):
-    with open(MAP_FILE, "w") as f:
-        json.dump(mac_token_map, f, indent=2)
+    # Reuses a cached JWT if one is still valid; refreshed automatically afterwards
+    tb.login(TB_USER, TB_PASS)
+    stats = tb.auth.stats
+    log.info(f"🔑 ThingsBoard auth ready ({stats['logins']} login(s), {stats['logins_avoided']} avoided)")
 
-def get_or_create_device(mac, mac_token_map):
-    if mac in mac_token_map:
-        return mac_token_map[mac]
+def load_registry():
+    return DeviceRegistry(REGISTRY_FILE, LEGACY_MAP_FILE, LEGACY_COUNTER_FILE)
 
-    hdr = {"X-Authorization": f"Bearer {JWT}"}
+def get_or_create_device(mac, registry):
+    if mac in registry:
+        return registry[mac]
+    started = time.perf_counter()
 
-    # Generate display name like lora_1, lora_2...
-    counter_file = "device_counter.txt"
-    if os.path.exists(counter_file):
-        with open(counter_file, "r") as f:
-            counter = int(f.read().strip())
-    else:
-        counter = 1
-
-    device_name = f"lora_{counter}"
+    # Reserve a display name like lora_1, lora_2... (provisioning workers run concurrently)
+    device_name = f"lora_{registry.reserve_number()}"
 
     # Create the device
-    resp = requests.post(f"{TB_HOST}/api/device", headers=hdr, json={"name": device_name})
-    dev_id = resp.json()["id"]["id"]
-
-    # Save counter
-    with open(counter_file, "w") as f:
-        f.write(str(counter + 1))
+    dev_id = tb.create_device(device_name)
 
-    # Store MAC → token mapping
-    token_resp = requests.get(f"{TB_HOST}/api/device/{dev_id}/credentials", headers=hdr)
-    token = token_resp.json()["credentialsId"]
-    mac_token_map[mac] = token
-    save_map(mac_token_map)
+    # Store MAC → token / device id / name in one transaction
+    token = tb.get_device_token(dev_id)
+    registry.add(mac, token, dev_id, device_name)
 
     # Optionally: Add MAC as attribute for tracking
-    requests.post(
-        f"{TB_HOST}/api/v1/{token}/attributes",
-        json={"mac_address": mac}
-    )
+    tb.post_attributes(token, {"mac_address": mac})
 
     # Create dashboard
     create_dashboard(dev_id, device_name)
 
+    metrics.PROVISION_SECONDS.observe(time.perf_counter() - started)
     return token
 
 def create_dashboard(device_id, device_name):
-    hdr = {"X-Authorization": f"Bearer {JWT}", "Content-Type": "application/json"}
     db = {
         "title": f"Dashboard {device_name}",
         "configuration": {
@@ -114,16 +152,15 @@ def create_dashboard(device_id, device_name):
         },
         "assignToCustomer": False
     }
-    resp = requests.post(f"{TB_HOST}/api/dashboard", headers=hdr, json=db)
-    did = resp.json()["id"]["id"]
-    requests.post(f"{TB_HOST}/api/dashboard/{did}/assignToEntity?entityId={device_id}", headers=hdr)
-
-def send_telemetry(token, data_value, battery_value):
-    payload = {
-        "data": data_value,
-        "battery": float(battery_value)
-    }
-    requests.post(f"{TB_HOST}/api/v1/{token}/telemetry", json=payload)
+    did = tb.create_dashboard(db)
+    tb.assign_dashboard(did, device_id)
+
+def send_telemetry_batch(token, records):
+    # records: [{"ts": <ms>, "values": {...}}, ...] → one request for the whole batch
+    tb.post_telemetry(token, records)
+
+# Shared-scope deletes are queued during the cycle and sent in batches afterwards
+delete_queue = SharedDeleteQueue(tb.delete_shared_attributes, path=PENDING_DELETES_FILE)
 
 # # Time sync every X seconds
 # def sync_time_loop():
@@ -139,120 +176,198 @@ def send_telemetry(token, data_value, battery_value):
 
 # Dictionary to store last seen messages per MAC and key
 last_shared_values = {}
-
-def check_for_extra_fields(mac_token_map):
-    global ser
+parse_lock = threading.Lock()  # Receivers' cycles share last_shared_values
+
+poll_pool = ThreadPoolExecutor(POLL_WORKERS, thread_name_prefix="tb-poll")
+
+def fetch_all_shared(registry, receiver):
+    # Fan the per-device GETs out over the pool; results come back in map order
+    # so the serial writes that follow stay deterministic. Only the devices this
+    # receiver delivers to are fetched.
+    futures = [(mac, poll_pool.submit(tb.get_attributes, token))
+               for mac, token in list(registry.items()) if router.serves(receiver, mac)]
+    results = []
+    for mac, future in futures:
+        try:
+            results.append((mac, future.result().get("shared", {}), None))
+        except Exception as e:
+            results.append((mac, None, e))
+    return results
+
+def check_for_extra_fields(registry, receiver):
     while True:
-        get_msg_event.wait()  # Wait until GET_MSG is received
-        get_msg_event.clear()  # Reset the event so it waits again next time
+        receiver.get_msg_event.wait()  # Wait until this receiver sends GET_MSG
+        receiver.get_msg_event.clear()  # Reset the event so it waits again next time
+        cycle_started = time.perf_counter()
 
-        for mac, token in mac_token_map.items():
-            try:
-                url = f"https://demo.thingsboard.io/api/v1/{token}/attributes?clientKeys=&sharedKeys="
-                response = requests.get(url)
-                data = response.json()
-                shared = data.get("shared", {})
-
-                if mac not in last_shared_values:
-                    last_shared_values[mac] = {}
-
-                for key, value in shared.items():
-                    if key.lower() in {"battery", "id", "mac_address", "data"}:
-                        continue
-
-                    # Calendar
-                    if isinstance(value, str) and value.startswith("Start:"):
-                        try:
-                            start = value.split("\n")[0].split("Start:")[1].strip()
-                            end = value.split("\n")[1].split("End:")[1].strip()
-
-                            start_dt = datetime.strptime(start, "%Y-%m-%d %H:%M")
-                            end_dt = datetime.strptime(end, "%Y-%m-%d %H:%M")
-                            now = datetime.now()
-
-                            if end_dt < now:
-                                # Delete expired event
-                                del_url = f"https://demo.thingsboard.io/api/plugins/telemetry/DEVICE/{UUID}/SHARED_SCOPE?keys={key}"
-                                headers = {"X-Authorization": f"Bearer {JWT}"}
-                                requests.delete(del_url, headers=headers)
-                                print(f"🗑 Deleted expired event {key}")
-                                continue
-
-                            elif start_dt <= now <= end_dt and last_shared_values[mac].get(key) != value:
-                                msg = f"calendar:{key}:Start={int(start_dt.timestamp())}:End={int(end_dt.timestamp())}\n"
-                                ser.write(msg.encode())
-                                print(f"📅 Sent calendar: {msg.strip()}")
+        # Lines for the receiver are collected and written once at the end of the cycle
+        downlink = receiver.downlink(max_chunk=DOWNLINK_CHUNK, chunk_gap=DOWNLINK_CHUNK_GAP)
+
+        with stages("fetch"):
+            fetched = fetch_all_shared(registry, receiver)
+
+        with parse_lock, stages("parse"):
+            for mac, shared, error in fetched:
+                if error is not None:
+                    log.error(f"❌ Polling error: {error}")
+                    continue
+                try:
+                    if mac not in last_shared_values:
+                        last_shared_values[mac] = {}
+
+                    for key, value in shared.items():
+                        if key.lower() in {"battery", "id", "mac_address", "data"}:
+                            continue
+
+                        # Already handled, TB just hasn't confirmed the delete yet
+                        if delete_queue.is_pending(mac, key):
+                            continue
+
+                        # Calendar
+                        if isinstance(value, str) and value.startswith("Start:"):
+                            try:
+                                start = value.split("\n")[0].split("Start:")[1].strip()
+                                end = value.split("\n")[1].split("End:")[1].strip()
+
+                                start_dt = datetime.strptime(start, "%Y-%m-%d %H:%M")
+                                end_dt = datetime.strptime(end, "%Y-%m-%d %H:%M")
+                                now = datetime.now()
+
+                                if end_dt < now:
+                                    # Delete expired event
+                                    delete_queue.enqueue(UUID, key, mac)
+                                    log.info(f"🗑 Queued expired event {key} for deletion")
+                                    continue
+
+                                elif start_dt <= now <= end_dt and last_shared_values[mac].get(key) != value:
+                                    msg = f"calendar:{key}:Start={int(start_dt.timestamp())}:End={int(end_dt.timestamp())}\n"
+                                    downlink.add(msg)
+                                    log.info(f"📅 Queued calendar: {msg.strip()}")
+                                    last_shared_values[mac][key] = value
+
+                            except Exception as e:
+                                log.warning(f"⚠ Calendar parse error: {e}")
+
+                        elif isinstance(value, str):
+                            if last_shared_values[mac].get(key) != value:
+                                dev_name = registry.name(mac)
+                                line = f"{dev_name}:{value}\n"
+                                downlink.add(line)
+                                log.info(f"📡 Queued msg: {line.strip()}")
                                 last_shared_values[mac][key] = value
 
-                        except Exception as e:
-                            print(f"⚠ Calendar parse error: {e}")
+                                delete_queue.enqueue(UUID, key, mac)
 
-                    elif isinstance(value, str):
-                        if last_shared_values[mac].get(key) != value:
-                            dev_number = list(mac_token_map.keys()).index(mac) + 1
-                            dev_name = f"lora_{dev_number}"
-                            line = f"{dev_name}:{value}\n"
-                            ser.write(line.encode())
-                            print(f"📡 Sent msg: {line.strip()}")
-                            last_shared_values[mac][key] = value
+                except Exception as e:
+                    log.error(f"❌ Polling error: {e}")
 
-                            del_url = f"{TB_HOST}/api/plugins/telemetry/DEVICE/{UUID}/SHARED_SCOPE?keys={key}"
-                            headers = {"X-Authorization": f"Bearer {JWT}"}
-                            requests.delete(del_url, headers=headers)
-                            print(f"🗑 Deleted one-time message key '{key}' after use")
+        # One buffered write; the time sync is stamped after the HTTP work, just
+        # before it goes out, instead of when GET_MSG arrived
+        with stages("write"):
+            try:
+                lines, synced_ts = downlink.send()
+                log.debug(f"⏰ Synced time {synced_ts} with ESP32 ({lines} downlink line(s))")
+                metrics.DOWNLINK_LINES.observe(lines)
+            except serial.SerialException as e:
+                log.error(f"❌ Downlink write to {receiver.name} failed: {e}")
+        metrics.POLL_CYCLE_SECONDS.observe(time.perf_counter() - cycle_started)
 
-            except Exception as e:
-                print(f"❌ Polling error: {e}")
+        # Downlink writes are done: send the queued deletes in batches
+        with stages("persist"):
+            delete_queue.flush()
 
 if __name__ == "__main__":
+    # Log calls only enqueue; a listener thread does the console I/O
+    log_handler, log_listener = setup_logging(LOG_LEVEL)
     login()
-    mac_token_map = load_map()
-
-    with serial.Serial(SERIAL_PORT, BAUD, timeout=1) as s:
-        ser = s  # Assign to global
-
-        # Start background threads
-        threading.Thread(target=check_for_extra_fields, args=(mac_token_map,), daemon=True).start()
-        # threading.Thread(target=sync_time_loop, daemon=True).start()
-
-        buffer = {"mac": None, "id": None, "battery": None}
-
-        while True:
+    registry = load_registry()
+
+    # threading.Thread(target=sync_time_loop, daemon=True).start()
+
+    spool = TelemetrySpool(SPOOL_FILE, send_telemetry_batch, SPOOL_MAX_RECORDS,
+                           SPOOL_REPLAY_BATCH, SPOOL_REPLAY_GAP)
+    batcher = TelemetryBatcher(send_telemetry_batch, TELEMETRY_BATCH_SIZE, TELEMETRY_BATCH_MAX_AGE,
+                               on_failure=spool.put)
+
+    # Unknown MACs are created in the background; their readings wait until the token exists
+    def flush_parked(mac, token, readings):
+        for values, ts in readings:
+            batcher.add(token, values, ts)
+        log.info(f"✅ Provisioned MAC {mac}, queued {len(readings)} parked reading(s)")
+
+    provisioner = DeviceProvisioner(lambda mac: get_or_create_device(mac, registry),
+                                    flush_parked, workers=PROVISION_WORKERS)
+
+    # Scrape-time gauges next to the counters/histograms recorded inline
+    for name, read in dict(
+        telemetry_pending=batcher.pending,
+        spool_depth=spool.depth,
+        spool_dead_letters=spool.dead_letters,
+        spool_replay_rate=spool.replay_rate,
+        delete_queue_depth=delete_queue.depth,
+        provision_parked=lambda: sum(provisioner.pending().values()),
+        serial_decode_errors=lambda: sum(r.decoder.stats["crc_errors"] + r.decoder.stats["malformed"]
+                                         for r in receivers),
+        receivers_connected=lambda: sum(r.connected.is_set() for r in receivers),
+        log_records_dropped=lambda: log_handler.dropped,
+    ).items():
+        metrics.REGISTRY.gauge(f"gateway_{name}", name.replace("_", " "), read)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = metrics.MetricsServer(metrics.REGISTRY, METRICS_PORT).start()
+        log.info(f"📈 Metrics on {metrics_server.url}")
+    # SIGUSR1 and /profile, /stages on the metrics port
+    install_controls(profiler, metrics_server, PROFILE_SECONDS, PROFILE_DIR)
+
+    def on_serial_data(receiver, data):
+        # Called on each receiver's reader thread; framed "#1:" records and legacy
+        # MAC:/ID:/Battery: lines, any chunking
+        with stages("decode"):
+            messages = receiver.decoder.feed(data)
+
+        for msg in messages:
+            metrics.SERIAL_MESSAGES.inc(msg[0])
             try:
-                raw = ser.readline()
-                if not raw:
-                    continue
-                line = raw.decode(errors='ignore').strip()
-
                 # 👇 New behavior: Trigger event when "GET_MSG" is received
-                if line.strip() == "GET_MSG":
-                    print("🔄 Received GET_MSG, triggering attribute check...")
-                    get_msg_event.set()
-                     # After sending all messages/events
-                    unix_time = int(datetime.now().timestamp())
-                    ser.write(f"time:{unix_time}\n".encode())
+                if msg[0] == "get_msg":
+                    log.debug("🔄 Received GET_MSG from %s, triggering attribute check...", receiver.name)
+                    receiver.get_msg_event.set()  # The worker sends the time sync with its downlink
                     continue
 
-                # Existing data parsing
-                if line.startswith("MAC:"):
-                    buffer["mac"] = line.split("MAC:", 1)[1].strip()
-                elif line.startswith("ID:"):
-                    buffer["id"] = line.split("ID:", 1)[1].strip()
-                elif line.startswith("Battery:"):
-                    buffer["battery"] = line.split("Battery:", 1)[1].strip().replace("%", "")
-                else:
+                if msg[0] != "reading":
                     continue  # Ignore unrelated lines
 
-                # Once complete, send to ThingsBoard
-                if all(buffer.values()):
-                    mac = buffer["mac"]
-                    device_id = buffer["id"]
-                    battery = buffer["battery"]
-
-                    token = get_or_create_device(mac, mac_token_map)
-                    send_telemetry(token, float(device_id), float(battery))
-                    print(f"✅ Uploaded data={device_id}, battery={battery}% for MAC {mac}")
-                    buffer = {"mac": None, "id": None, "battery": None}
+                # Once complete, send to ThingsBoard; this MAC's messages now go via this receiver
+                _, mac, device_id, battery = msg
+                router.heard(mac, receiver)
+                values = {"data": float(device_id), "battery": float(battery)}
+                token = registry.get(mac)
+                if token is None:
+                    provisioner.submit(mac, (values, now_ms()))
+                    log.debug("⏳ Parked data=%s for MAC %s until it is provisioned", device_id, mac)
+                    continue
+                batcher.add(token, values)
+                log.debug("✅ Queued data=%s, battery=%s%% for MAC %s", device_id, battery, mac)
 
             except Exception as e:
-                print("❌ Error:", e)
+                log.error("❌ Error: %s", e)
+
+    # One GET_MSG worker and one reader (reconnecting on its own) per receiver
+    for receiver in receivers:
+        threading.Thread(target=check_for_extra_fields, args=(registry, receiver),
+                         name=f"get-msg-{receiver.name}", daemon=True).start()
+        receiver.start(on_serial_data)
+    log.info(f"📻 Serving {len(receivers)} receiver(s): {', '.join(r.port for r in receivers)}")
+
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        # Stop reading, finish in-flight provisioning, then flush buffered readings on
+        # shutdown (Ctrl+C); anything ThingsBoard doesn't take stays in the spool for the next start
+        for receiver in receivers:
+            receiver.close()
+        provisioner.close()
+        batcher.close()
+        spool.close()
+        log_listener.stop()
@@ -0,0 +1,176 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# ThingsBoard JWT cache with refresh
+#
+# Holds the JWT and refresh token of one tenant user. Tokens are also kept in a
+# small JSON file (keyed by host + username) so the servers and the uploaders,
+# and restarts of either, reuse a still-valid token instead of logging in again.
+# A token within refresh_margin seconds of its "exp" claim is renewed through
+# /api/auth/token with the refresh token; only if that fails is the password
+# login repeated. Refreshes are serialized across processes with a lock file and
+# the cache is re-read under the lock, so concurrent processes refresh once.
+
+log = logging.getLogger(__name__)
+
+
+def jwt_expiry(token):
+    # "exp" claim of a JWT (no signature check; only used to schedule refreshes)
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, ValueError, TypeError):
+        return 0.0
+
+
+class FileLock:
+    """Exclusive advisory lock on <path>.lock, across processes."""
+
+    def __init__(self, path):
+        self.path = f"{path}.lock"
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self.path, "a+")
+        if fcntl:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        else:
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            else:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._f.close()
+
+
+class TokenManager:
+    """JWT + refresh token for one user, cached in memory and on disk.
+
+    post(path, body) -> dict performs an unauthenticated JSON POST against
+    ThingsBoard (ThingsBoardClient passes its pooled session).
+    """
+
+    def __init__(self, post, host, username, password, cache_path=None, refresh_margin=300):
+        self.post = post
+        self.username = username
+        self.password = password
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self._key = f"{host}|{username}"
+        self._lock = threading.Lock()
+        self._token = None
+        self._refresh_token = None
+        self._expires = 0.0
+        self.stats = {"logins": 0, "refreshes": 0, "cache_hits": 0, "disk_hits": 0,
+                      "logins_avoided": 0, "unauthorized": 0}
+
+    def token(self):
+        # A JWT valid for at least refresh_margin more seconds
+        with self._lock:
+            if self._fresh():
+                self.stats["cache_hits"] += 1
+                return self._token
+            return self._renew(stale=None)
+
+    def login(self):
+        # Explicit login request (startup, each uploader sync): served from cache if possible
+        with self._lock:
+            if self._fresh() or self._load_from_disk():
+                self.stats["logins_avoided"] += 1
+                return self._token
+            return self._renew(stale=None)
+
+    def invalidate(self, token):
+        # ThingsBoard answered 401 for `token`: get a new one, unless another thread already did
+        with self._lock:
+            self.stats["unauthorized"] += 1
+            if token != self._token and self._fresh():
+                return self._token
+            return self._renew(stale=token)
+
+    # ---------------- internals ----------------
+
+    def _fresh(self):
+        return self._token is not None and time.time() < self._expires - self.refresh_margin
+
+    def _renew(self, stale):
+        if self.cache_path is None:
+            self._refresh_or_login()
+            return self._token
+        with FileLock(self.cache_path):
+            # Another process may have refreshed while we waited for the lock
+            if self._load_from_disk() and self._token != stale:
+                self.stats["logins_avoided"] += 1
+                return self._token
+            self._refresh_or_login()
+            self._save_to_disk()
+        return self._token
+
+    def _refresh_or_login(self):
+        if self._refresh_token:
+            try:
+                data = self.post("/api/auth/token", {"refreshToken": self._refresh_token})
+                self._set(data)
+                self.stats["refreshes"] += 1
+                self.stats["logins_avoided"] += 1
+                return
+            except Exception as e:
+                log.warning(f"⚠ JWT refresh failed, logging in again: {e}")
+        data = self.post("/api/auth/login", {"username": self.username, "password": self.password})
+        self._set(data)
+        self.stats["logins"] += 1
+
+    def _set(self, data):
+        self._token = data["token"]
+        self._refresh_token = data.get("refreshToken")
+        self._expires = jwt_expiry(self._token)
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_from_disk(self):
+        # Adopt the cached tokens if they are still fresh; True on success
+        if self.cache_path is None:
+            return False
+        entry = self._read_cache().get(self._key)
+        if not entry or time.time() >= jwt_expiry(entry["token"]) - self.refresh_margin:
+            if entry and not self._refresh_token:
+                # Expired JWT, but its refresh token may still be good
+                self._refresh_token = entry.get("refreshToken")
+            return False
+        self._set(entry)
+        self.stats["disk_hits"] += 1
+        return True
+
+    def _save_to_disk(self):
+        cache = self._read_cache()
+        cache[self._key] = {"token": self._token, "refreshToken": self._refresh_token}
+        tmp = f"{self.cache_path}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)  # holds credentials
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.cache_path)
@@ -0,0 +1,105 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Background calendar uploads for the Tk uploaders
+#
+# Tk widgets may only be touched from the main loop, and a login, a large .ics
+# file or a slow ThingsBoard used to freeze the window while it ran there.
+# UploadJobs runs uploads on worker threads instead. A job (one dropped file, the
+# Google calendar) logs in and builds its payload once on the job pool, then
+# syncs it to every target device at the same time on the device pool.
+# AttributeSync keeps one sync at a time per device and source, so a job
+# submitted twice never races itself. Several jobs run side by side: one file's
+# parsing overlaps another's uploads.
+#
+# Workers never call Tk. They report on a queue that the window drains with
+# poll() from an after() loop:
+#
+#   ("progress", job, text)
+#   ("done", job, {"stats": payload stats, "keys": n, "devices": { device_id: sync result or exception }})
+#   ("error", job, exception)     login or payload failed, nothing was uploaded
+
+
+class UploadJobs:
+    """Runs payload builds and per-device syncs on worker pools, reporting through a queue."""
+
+    def __init__(self, attribute_sync, device_ids, workers=4, login=None):
+        self.attribute_sync = attribute_sync
+        self.device_ids = list(device_ids)
+        self.login = login  # called at the start of every job; raises if ThingsBoard refuses
+        self._jobs = ThreadPoolExecutor(workers, thread_name_prefix="upload-job")
+        self._devices = ThreadPoolExecutor(workers, thread_name_prefix="upload-device")
+        self._messages = queue.Queue()
+        self._lock = threading.Lock()
+        self._active = set()
+        self.stats = {"jobs": 0, "errors": 0, "device_syncs": 0, "device_errors": 0}
+
+    def submit(self, job, source, build):
+        # build(stats) → payload (None: nothing to upload), run on a worker. Returns False
+        # if `job` is already queued or running (a file dropped twice, a resync still going).
+        with self._lock:
+            if job in self._active:
+                return False
+            self._active.add(job)
+        self._messages.put(("progress", job, "queued"))
+        self._jobs.submit(self._run, job, source, build)
+        return True
+
+    def poll(self):
+        # Every message reported since the last call, oldest first; never blocks
+        messages = []
+        while True:
+            try:
+                messages.append(self._messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def busy(self, job=None):
+        with self._lock:
+            return job in self._active if job is not None else bool(self._active)
+
+    def close(self, wait=False):
+        self._jobs.shutdown(wait=wait)
+        self._devices.shutdown(wait=wait)
+
+    # ---------------- workers ----------------
+
+    def _run(self, job, source, build):
+        try:
+            if self.login is not None:
+                self._messages.put(("progress", job, "logging in"))
+                self.login()
+            self._messages.put(("progress", job, "reading events"))
+            stats = {}
+            payload = build(stats)
+        except Exception as e:
+            self._finish(job, ("error", job, e), error=True)
+            return
+
+        results = {}
+        if payload is not None:
+            futures = {self._devices.submit(self.attribute_sync.sync, device_id, source, payload): device_id
+                       for device_id in self.device_ids}
+            self._messages.put(("progress", job, f"uploading {len(payload)} events to "
+                                                 f"{len(futures)} device(s)"))
+            for done, future in enumerate(as_completed(futures), 1):
+                device_id = futures[future]
+                try:
+                    results[device_id] = future.result()
+                except Exception as e:
+                    results[device_id] = e
+                self._messages.put(("progress", job, f"{done}/{len(futures)} device(s) done"))
+
+        failed = sum(isinstance(result, Exception) for result in results.values())
+        with self._lock:
+            self.stats["device_syncs"] += len(results)
+            self.stats["device_errors"] += failed
+        self._finish(job, ("done", job, {"stats": stats, "keys": len(payload or {}), "devices": results}))
+
+    def _finish(self, job, message, error=False):
+        with self._lock:
+            self._active.discard(job)
+            self.stats["jobs"] += 1
+            self.stats["errors"] += error
+        self._messages.put(message)